@@ -0,0 +1,52 @@
+import numpy as np
+
+# Closed-form sampling of the single qubit circuits used by BB84, as they run on Aer.
+# A qubit prepared as bits in prepBases and measured in measBases gives back the prepared
+# bit when the bases match and a uniformly random bit when they differ. With noise, each
+# noisy gate depolarizes the qubit with probability depolarizing_rate (which makes the
+# outcome uniformly random), and the readout flips the result with probability readout_rate.
+# After transpiling, the only noisy gates are the X applied when preparing |1> and a single
+# Hadamard when the bases differ (two Hadamards in the same basis cancel out).
+
+def measure_qubits(bits, prepBases, measBases, depolarizing_rate=0.0, readout_rate=0.0, rng=None, uniforms=None):
+    # The arrays can have any shape, such as (trials, qubits) in trials.py. uniforms replaces
+    # the draws from rng with three arrays of uniform numbers of that shape: whether the qubit
+    # depolarizes, its random outcome and the readout flip
+    rng = np.random.default_rng() if rng is None else rng
+    bits = np.asarray(bits, dtype=np.uint8)
+    prepBases = np.asarray(prepBases, dtype=np.uint8)
+    measBases = np.asarray(measBases, dtype=np.uint8)
+    shape = bits.shape
+
+    # Probability that none of the noisy gates depolarized the qubit
+    nGates = bits.astype(np.int64) + (prepBases != measBases)
+    intact = (1 - depolarizing_rate) ** nGates
+
+    if uniforms is None:
+        randomOutcome = (prepBases != measBases) | (rng.random(shape) >= intact)
+        outcomes = np.where(randomOutcome, rng.integers(0, 2, shape, dtype=np.uint8), bits)
+        if readout_rate:
+            outcomes ^= (rng.random(shape) < readout_rate).astype(np.uint8)
+        return outcomes
+
+    depolarized, random_bits, flips = uniforms
+    randomOutcome = (prepBases != measBases) | (depolarized >= intact)
+    outcomes = np.where(randomOutcome, random_bits < 0.5, bits).astype(np.uint8)
+    return outcomes ^ (flips < readout_rate).astype(np.uint8)
+
+def expected_qber(depolarizing_rate=0.0, readout_rate=0.0):
+    # Error rate of the sifted key of an honest link: a prepared 1 goes through one noisy X,
+    # which depolarizes it half of the time it is a 1, and the readout flips the outcome
+    depolarized = depolarizing_rate / 4
+    return readout_rate + depolarized * (1 - 2 * readout_rate)
+
+def intercept_resend(bits, aBases, bBases, eBases, depolarizing_rate=0.0, readout_rate=0.0, rng=None, intercepts=None):
+    # Eve measures in her basis and resends her result prepared in the standard basis,
+    # as in bb84_eaves.quantumSend. With intercepts, she only does so where it is set and the
+    # other qubits reach Bob untouched. Returns Bob's outcomes
+    rng = np.random.default_rng() if rng is None else rng
+    eBits = measure_qubits(bits, aBases, eBases, depolarizing_rate, readout_rate, rng)
+    resent = measure_qubits(eBits, np.zeros(len(eBits), dtype=np.uint8), bBases, depolarizing_rate, readout_rate, rng)
+    if intercepts is None:
+        return resent
+    return np.where(np.asarray(intercepts, dtype=bool), resent, measure_qubits(bits, aBases, bBases, depolarizing_rate, readout_rate, rng))
@@ -1,19 +1,33 @@
-from qiskit import QuantumCircuit, transpile
-from qiskit_aer import AerSimulator
-from noise import noise_protocol
+from qiskit import QuantumCircuit
+from qkd_common.noise import noise_protocol, DEPOLARIZING_RATE, READOUT_RATE
 from spot_checking import spot_checking
+from qkd_common.circuit_cache import get_transpiled
+import analytic
+from key_reconciliation.key_buffer import KeyBuffer
+from key_reconciliation import metrics
+from qkd_common import backend_selection
+import numpy as np
 
 
-simulator = AerSimulator()
+# Circuits are transpiled to Clifford gates for the stabilizer method. Each job then runs on
+# the method picked by backend_selection
+simulator = backend_selection.simulator("stabilizer")
 
-def quantumSend(aBit, aBase, bBase, use_noise=False):
+# Error rates of the noise model used when use_noise is set
+depolarizing_rate = DEPOLARIZING_RATE
+readout_rate = READOUT_RATE
+
+# Number of circuits submitted to the simulator per job in batched mode
+BATCH_SIZE = 1000
+
+def buildCircuit(aBit, aBase, bBase):
     # Create a circuit with 1 qubit
     circuit = QuantumCircuit(1)
 
     # Alice's bit
     if(aBit):
-        # Resets to |0> to then initialize according to the given parameter = |1>
-        circuit.initialize(1)
+        # Flips |0> to |1> (an X gate instead of initialize keeps the circuit Clifford)
+        circuit.x(0)
 
     # Alice's basis
     if(aBase):
@@ -27,16 +41,42 @@ def quantumSend(aBit, aBase, bBase, use_noise=False):
     
     # Measure bits 
     circuit.measure_all()
+    return circuit
+
+def transpiledCircuit(aBit, aBase, bBase):
+    # Only 8 distinct circuits exist, so they are transpiled once and reused
+    key = ("bb84", int(aBit), int(aBase), int(bBase))
+    return get_transpiled(key, lambda: buildCircuit(aBit, aBase, bBase), simulator, backend_selection.STABILIZER_BASIS)
+
+def quantumSend(aBit, aBase, bBase, use_noise=False):
+    t = transpiledCircuit(aBit, aBase, bBase)
+    metrics.active.count("simulator_calls")
+
+    noise_model = noise_protocol(depolarizing_rate, readout_rate) if use_noise else None
+    return backend_selection.run(t, noise_model).get_counts(t)
 
-    t = transpile(circuit, simulator)
+def quantumSendBatch(aBits, aBases, bBases, use_noise=False, batch_size=BATCH_SIZE, rng=None):
+    # Same circuits as quantumSend, but submitted batch_size at a time so that
+    # the job overhead is paid once per batch instead of per qubit. With rng, every
+    # job gets a simulator seed drawn from it, which makes the outcomes reproducible
+    results = []
+    for start in range(0, len(aBits), batch_size):
+        t = [transpiledCircuit(aBits[i], aBases[i], bBases[i]) for i in range(start, min(start + batch_size, len(aBits)))]
+        seed = {} if rng is None else {"seed_simulator": int(rng.integers(1 << 31))}
+        metrics.active.count("simulator_calls")
 
-    if use_noise:
-        noise_model = noise_protocol()
-        return simulator.run(t, shots=1, memory=True, noise_model=noise_model).result().get_counts(t)
-    else: 
-        return simulator.run(t, shots=1, memory=True).result().get_counts(t)
+        noise_model = noise_protocol(depolarizing_rate, readout_rate) if use_noise else None
+        result = backend_selection.run(t, noise_model, 1, **seed)
+        results.extend(result.get_memory(i)[0] for i in range(len(t)))
+    return results
 
-def bb84_protocol(vObject, use_noise=False):
+def bb84_protocol(vObject, use_noise=False, batch_size=None, backend="aer"):
+    if backend == "analytic":
+        return bb84_protocol_analytic(vObject, use_noise)
+    if backend != "aer":
+        raise ValueError(f"Unknown backend: {backend}")
+    if batch_size:
+        return bb84_protocol_batched(vObject, use_noise, batch_size)
     aKey = []
     bKey = []
     # Key sifting
@@ -45,21 +85,47 @@ def bb84_protocol(vObject, use_noise=False):
             result = quantumSend(vObject.aBits[i], vObject.aBase[i], vObject.bBase[i], use_noise)
             aKey.append(int(vObject.aBits[i]))
             bKey.append(int(list(result.keys())[0][0]))
+    return KeyBuffer(aKey), KeyBuffer(bKey)
+
+def bb84_protocol_batched(vObject, use_noise=False, batch_size=BATCH_SIZE, rng=None):
+    # Key sifting happens before sending, so only the kept positions are simulated
+    sifted = [i for i in range(vObject.nBits) if vObject.aBase[i] == vObject.bBase[i]]
+    results = quantumSendBatch([vObject.aBits[i] for i in sifted],
+                               [vObject.aBase[i] for i in sifted],
+                               [vObject.bBase[i] for i in sifted],
+                               use_noise, batch_size, rng)
+    aKey = KeyBuffer(np.asarray(vObject.aBits)[sifted])
+    bKey = KeyBuffer([int(result[0]) for result in results])
     return aKey, bKey
 
-def main(vObject, use_noise=False):
-    # Call protocol
+def bb84_protocol_analytic(vObject, use_noise=False, rng=None):
+    # Samples every sifted qubit at once from the closed-form outcome probabilities
+    aBits = np.asarray(vObject.aBits[:vObject.nBits])
+    aBase = np.asarray(vObject.aBase[:vObject.nBits])
+    bBase = np.asarray(vObject.bBase[:vObject.nBits])
+    sifted = aBase == bBase
+    rates = (depolarizing_rate, readout_rate) if use_noise else (0.0, 0.0)
+    bKey = analytic.measure_qubits(aBits[sifted], aBase[sifted], bBase[sifted], *rates, rng=rng)
+    return KeyBuffer(aBits[sifted]), KeyBuffer(bKey)
 
-    (aKey, bKey) = bb84_protocol(vObject, use_noise)
+def main(vObject, use_noise=False, batch_size=None, backend="aer", print_keys=False):
+    # Call protocol
+    with metrics.active.stage("quantum"):
+        (aKey, bKey) = bb84_protocol(vObject, use_noise, batch_size, backend)
+    metrics.active.record("sifting_ratio", len(aKey) / vObject.nBits)
     
     # Spot check
-    (error, aSample, bSample) = spot_checking(aKey, bKey, int(len(aKey)/vObject.sampleDivisor))
+    with metrics.active.stage("spot_checking"):
+        (error, aSample, bSample, aKey, bKey, interval) = spot_checking(aKey, bKey, int(len(aKey)/vObject.sampleDivisor))
+    metrics.active.record("qber", error)
 
     # Output data
-    print(f"Alice's key: {aKey}")
-    print(f"Bob's key  : {bKey}")
+    if print_keys:
+        print(f"Alice's key: {aKey}")
+        print(f"Bob's key  : {bKey}")
     print(f"Number of bits sent: {vObject.nBits}")
     print(f"Number of bits in key: {len(aKey)}")
-    print(f"Error rate: {error}")
-    print(f"Alice's sample: {aSample}")
-    print(f"Bob's sample: {bSample}")
+    print(f"Error rate: {error} (95% confidence interval: {interval[0]:.3f} - {interval[1]:.3f})")
+    if print_keys:
+        print(f"Alice's sample: {aSample}")
+        print(f"Bob's sample: {bSample}")
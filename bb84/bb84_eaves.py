@@ -1,21 +1,34 @@
-from qiskit import QuantumCircuit, transpile
-from qiskit_aer import AerSimulator
-from noise import noise_protocol
+from qiskit import QuantumCircuit
+from qkd_common.noise import noise_protocol, DEPOLARIZING_RATE, READOUT_RATE
 from spot_checking import spot_checking
-import hashlib
 import random as rand
 import key_reconciliation
+from qkd_common.circuit_cache import get_transpiled
+import analytic
+from key_reconciliation.key_buffer import KeyBuffer
+from key_reconciliation import metrics
+from qkd_common import backend_selection
+import numpy as np
 
-simulator = AerSimulator()
+# Circuits are transpiled to Clifford gates for the stabilizer method. Each job then runs on
+# the method picked by backend_selection
+simulator = backend_selection.simulator("stabilizer")
 
-def quantumEavesDropping(aBit, aBase, eBase, use_noise=False):
+# Error rates of the noise model used when use_noise is set
+depolarizing_rate = DEPOLARIZING_RATE
+readout_rate = READOUT_RATE
+
+# Number of circuits submitted to the simulator per job in batched mode
+BATCH_SIZE = 1000
+
+def buildEavesCircuit(aBit, aBase, eBase):
     # Create a circuit with 1 qubit
     circuit = QuantumCircuit(1)
     
     # Alice's bit
     if(aBit):
-        # Resets to |0> to then initialize according to the given parameter = |1>
-        circuit.initialize(1)
+        # Flips |0> to |1> (an X gate instead of initialize keeps the circuit Clifford)
+        circuit.x(0)
     # Alice's basis
     if(aBase):
         # Add Hadamard gate to qubit
@@ -27,24 +40,15 @@ def quantumEavesDropping(aBit, aBase, eBase, use_noise=False):
     
     # Measure bits (before eve) 
     circuit.measure_all()    
-    t = transpile(circuit, simulator)
-    
-    if use_noise:
-        noise_model = noise_protocol()
-        eRes =  simulator.run(t, shots=1, memory=True, noise_model=noise_model).result().get_counts(t)
-    else: 
-        eRes = simulator.run(t, shots=1, memory=True).result().get_counts(t)
-    return list(eRes)[0]
-    
-def quantumSend(aBit, aBase, bBase, eBase, use_noise=False):
-    # Perform eavesdropping
-    eBit = quantumEavesDropping(aBit, aBase, eBase, use_noise)
+    return circuit
+
+def buildResendCircuit(eBit, bBase):
     # Reset circuit
     circuit = QuantumCircuit(1)  
     
     if(eBit):
-        # Resets to |0> to then initialize according to the given parameter = |1>
-        circuit.initialize(1)
+        # Flips |0> to |1> (an X gate instead of initialize keeps the circuit Clifford)
+        circuit.x(0)
     # Bob's basis
     if(bBase):
         # Add Hadamard gate to qubit 
@@ -52,50 +56,217 @@ def quantumSend(aBit, aBase, bBase, eBase, use_noise=False):
         
     # Measure bits 
     circuit.measure_all()
-    t = transpile(circuit, simulator)
+    return circuit
+
+def buildInterceptCircuit(aBit, aBase, eBase, bBase):
+    # Intercept-resend in one circuit: Eve measures into bit 0, then resends her result prepared
+    # in the standard basis (a reset and an X conditioned on her bit), and Bob measures into
+    # bit 1. Without eBase (None), Eve lets the qubit through
+    circuit = QuantumCircuit(1, 2)
+
+    # Alice's bit
+    if(aBit):
+        # Flips |0> to |1> (an X gate instead of initialize keeps the circuit Clifford)
+        circuit.x(0)
+    # Alice's basis
+    if(aBase):
+        circuit.h(0)
+
+    if eBase is not None:
+        # Eve's basis
+        if(eBase):
+            circuit.h(0)
+        circuit.measure(0, 0)
+        # Re-preparation
+        circuit.reset(0)
+        with circuit.if_test((circuit.clbits[0], 1)):
+            circuit.x(0)
+
+    # Bob's basis
+    if(bBase):
+        circuit.h(0)
+    circuit.measure(0, 1)
+    return circuit
+
+def transpiledEavesCircuit(aBit, aBase, eBase):
+    key = ("bb84_eaves", int(aBit), int(aBase), int(eBase))
+    return get_transpiled(key, lambda: buildEavesCircuit(aBit, aBase, eBase), simulator, backend_selection.STABILIZER_BASIS)
+
+def transpiledResendCircuit(eBit, bBase):
+    key = ("bb84_resend", int(eBit), int(bBase))
+    return get_transpiled(key, lambda: buildResendCircuit(eBit, bBase), simulator, backend_selection.STABILIZER_BASIS)
+
+def transpiledInterceptCircuit(aBit, aBase, eBase, bBase):
+    key = ("bb84_intercept", int(aBit), int(aBase), None if eBase is None else int(eBase), int(bBase))
+    return get_transpiled(key, lambda: buildInterceptCircuit(aBit, aBase, eBase, bBase), simulator, backend_selection.STABILIZER_BASIS)
+
+def runBatch(t, use_noise=False, rng=None):
+    # Submits all transpiled circuits as one job and returns one memory string per circuit.
+    # With rng, the job gets a simulator seed drawn from it
+    seed = {} if rng is None else {"seed_simulator": int(rng.integers(1 << 31))}
+    metrics.active.count("simulator_calls")
+
+    noise_model = noise_protocol(depolarizing_rate, readout_rate) if use_noise else None
+    result = backend_selection.run(t, noise_model, 1, **seed)
+    return [result.get_memory(i)[0] for i in range(len(t))]
+
+def quantumEavesDropping(aBit, aBase, eBase, use_noise=False):
+    t = transpiledEavesCircuit(aBit, aBase, eBase)
+    metrics.active.count("simulator_calls")
+    
+    noise_model = noise_protocol(depolarizing_rate, readout_rate) if use_noise else None
+    eRes = backend_selection.run(t, noise_model).get_counts(t)
+    return int(list(eRes)[0])
     
-    if use_noise:
-        noise_model = noise_protocol()
-        return simulator.run(t, shots=1, memory=True, noise_model=noise_model).result().get_counts(t)
-    else: 
-        return simulator.run(t, shots=1, memory=True).result().get_counts(t)
+def quantumSend(aBit, aBase, bBase, eBase, use_noise=False):
+    # Perform eavesdropping
+    eBit = quantumEavesDropping(aBit, aBase, eBase, use_noise)
+    t = transpiledResendCircuit(eBit, bBase)
+    metrics.active.count("simulator_calls")
+    
+    noise_model = noise_protocol(depolarizing_rate, readout_rate) if use_noise else None
+    return backend_selection.run(t, noise_model).get_counts(t)
+
+def quantumIntercept(aBit, aBase, bBase, eBase, use_noise=False):
+    # One qubit through the intercept-resend circuit, as one simulator job (eBase None: Eve lets
+    # it through). Returns Bob's bit
+    t = transpiledInterceptCircuit(aBit, aBase, eBase, bBase)
+    metrics.active.count("simulator_calls")
+
+    noise_model = noise_protocol(depolarizing_rate, readout_rate) if use_noise else None
+    # Memory strings are "<Bob's bit><Eve's bit>"
+    return int(backend_selection.run(t, noise_model).get_memory(t)[0][0])
+
+def quantumSendBatch(aBits, aBases, bBases, eBases, use_noise=False, batch_size=BATCH_SIZE, rng=None):
+    # Same circuits as quantumSend, but submitted batch_size at a time: Eve measures
+    # the whole batch in one job, then Bob measures all the resent qubits in another
+    results = []
+    for start in range(0, len(aBits), batch_size):
+        batch = range(start, min(start + batch_size, len(aBits)))
+        eBits = [int(eBit) for eBit in runBatch([transpiledEavesCircuit(aBits[i], aBases[i], eBases[i]) for i in batch], use_noise, rng)]
+        results.extend(runBatch([transpiledResendCircuit(eBits[j], bBases[i]) for j, i in enumerate(batch)], use_noise, rng))
+    return results
+
+def quantumInterceptBatch(aBits, aBases, bBases, eBases, eIntercepts, use_noise=False, batch_size=BATCH_SIZE, rng=None):
+    # Same outcomes as quantumSendBatch, with the intercept-resend circuit, and Eve only intercepts
+    # the qubits where eIntercepts is set. Qubits of a batch with the same circuit are run as
+    # shots of it, one job per circuit (at most 24 per batch) with as many shots as qubits.
+    # Returns Eve's bits (NaN where she did not intercept) and Bob's bits
+    eBits = []
+    bBits = []
+    for start in range(0, len(aBits), batch_size):
+        batch = range(start, min(start + batch_size, len(aBits)))
+        groups = {}
+        for i in batch:
+            eBase = int(eBases[i]) if eIntercepts[i] else None
+            groups.setdefault((int(aBits[i]), int(aBases[i]), eBase, int(bBases[i])), []).append(i)
+        noise_model = noise_protocol(depolarizing_rate, readout_rate) if use_noise else None
 
-def bb84_protocol(vObject, use_noise=False):
+        batchE = np.full(len(batch), np.nan)
+        batchB = np.zeros(len(batch), dtype=np.uint8)
+        for key, indices in groups.items():
+            t = transpiledInterceptCircuit(*key)
+            seed = {} if rng is None else {"seed_simulator": int(rng.integers(1 << 31))}
+            metrics.active.count("simulator_calls")
+            result = backend_selection.run(t, noise_model, len(indices), **seed)
+            # Memory strings are "<Bob's bit><Eve's bit>"
+            outcomes = np.array([int(memory, 2) for memory in result.get_memory(t)])
+            positions = np.asarray(indices) - start
+            batchB[positions] = outcomes >> 1
+            if key[2] is not None:
+                batchE[positions] = outcomes & 1
+        eBits.extend(batchE)
+        bBits.extend(batchB)
+    return eBits, bBits
+
+def createIntercepts(n, eveInterceptionRate=1, rng=None):
+    # Which qubits Eve intercepts, each with probability eveInterceptionRate
+    rng = np.random.default_rng() if rng is None else rng
+    return (rng.random(n) < eveInterceptionRate).astype(np.uint8)
+
+def interceptions(vObject):
+    # vObject.eIntercepts when set, otherwise Eve intercepts every qubit
+    return np.asarray(getattr(vObject, "eIntercepts", np.ones(vObject.nBits, dtype=np.uint8))[:vObject.nBits])
+
+def bb84_protocol(vObject, use_noise=False, batch_size=None, backend="aer"):
+    if backend == "analytic":
+        return bb84_protocol_analytic(vObject, use_noise)
+    if backend != "aer":
+        raise ValueError(f"Unknown backend: {backend}")
+    if batch_size:
+        return bb84_protocol_batched(vObject, use_noise, batch_size)
     aKey = []
     bKey = []
+    eIntercepts = interceptions(vObject)
     # Key sifting
     for i in range(vObject.nBits):
         if(vObject.aBase[i] == vObject.bBase[i]):
-            result = quantumSend(vObject.aBits[i], vObject.aBase[i], vObject.bBase[i], vObject.eBase[i], use_noise)
+            # Same intercept-resend circuit as the batched mode, one qubit at a time
+            eBase = vObject.eBase[i] if eIntercepts[i] else None
             aKey.append(int(vObject.aBits[i]))
-            bKey.append(int(list(result.keys())[0][0]))
+            bKey.append(quantumIntercept(vObject.aBits[i], vObject.aBase[i], vObject.bBase[i], eBase, use_noise))
+    return KeyBuffer(aKey), KeyBuffer(bKey)
+
+def bb84_protocol_batched(vObject, use_noise=False, batch_size=BATCH_SIZE, rng=None):
+    # Key sifting happens before sending, so only the kept positions are simulated
+    # Eve's measurement, her resend and Bob's measurement run as one circuit (quantumInterceptBatch)
+    sifted = [i for i in range(vObject.nBits) if vObject.aBase[i] == vObject.bBase[i]]
+    eIntercepts = interceptions(vObject)
+    _, bBits = quantumInterceptBatch([vObject.aBits[i] for i in sifted],
+                                     [vObject.aBase[i] for i in sifted],
+                                     [vObject.bBase[i] for i in sifted],
+                                     [vObject.eBase[i] for i in sifted],
+                                     eIntercepts[sifted],
+                                     use_noise, batch_size, rng)
+    aKey = KeyBuffer(np.asarray(vObject.aBits)[sifted])
+    bKey = KeyBuffer(bBits)
     return aKey, bKey
 
+def bb84_protocol_analytic(vObject, use_noise=False, rng=None):
+    # Samples every sifted qubit at once from the closed-form outcome probabilities
+    aBits = np.asarray(vObject.aBits[:vObject.nBits])
+    aBase = np.asarray(vObject.aBase[:vObject.nBits])
+    bBase = np.asarray(vObject.bBase[:vObject.nBits])
+    eBase = np.asarray(vObject.eBase[:vObject.nBits])
+    sifted = aBase == bBase
+    rates = (depolarizing_rate, readout_rate) if use_noise else (0.0, 0.0)
+    eIntercepts = interceptions(vObject)
+    bKey = analytic.intercept_resend(aBits[sifted], aBase[sifted], bBase[sifted], eBase[sifted], *rates, rng=rng, intercepts=eIntercepts[sifted])
+    return KeyBuffer(aBits[sifted]), KeyBuffer(bKey)
+
 def calc_risk(rate, threshold):
     return rate / threshold if rate <= threshold else 1
 
 
-def main(vObject, threshold, use_noise=False):
+def main(vObject, threshold, use_noise=False, batch_size=None, backend="aer", use_qber=False, print_keys=False):
     # Call protocol
-    (aKey, bKey) = bb84_protocol(vObject, use_noise)
+    with metrics.active.stage("quantum"):
+        (aKey, bKey) = bb84_protocol(vObject, use_noise, batch_size, backend)
+    metrics.active.record("sifting_ratio", len(aKey) / vObject.nBits)
     
     # Spot check
-    (error_eve, aSample, bSample) = spot_checking(aKey, bKey, int(len(aKey)/vObject.sampleDivisor))
+    with metrics.active.stage("spot_checking"):
+        (error_eve, aSample, bSample, aKey, bKey, interval) = spot_checking(aKey, bKey, int(len(aKey)/vObject.sampleDivisor))
+    metrics.active.record("qber", error_eve)
 
     # Calculate risk
     risk = calc_risk(error_eve, threshold)
 
     # key_reconciliation
-    fixedKey, newAliceKey, newBobKey = key_reconciliation.key_reconciliation(aKey, bKey)
+    # The multi-pass Cascade sizes its blocks from the error rate found by spot checking
+    fixedKey, newAliceKey, newBobKey = key_reconciliation.key_reconciliation(aKey, bKey, qber=error_eve if use_qber else None)
+    metrics.active.record("key_rate", len(newAliceKey) / vObject.nBits)
 
     # Output data
-    print(f"Alice's key: {aKey}")
-    print(f"Bob's key  : {bKey}")
+    if print_keys:
+        print(f"Alice's key: {aKey}")
+        print(f"Bob's key  : {bKey}")
     print(f"Number of bits sent: {vObject.nBits}")
     print(f"Number of bits in sifted key: {len(aKey)}")
-    print(f"Error rate: {error_eve}")
-    print(f"Alice's sample: {aSample}")
-    print(f"Bob's sample: {bSample}")
+    print(f"Error rate: {error_eve} (95% confidence interval: {interval[0]:.3f} - {interval[1]:.3f})")
+    if print_keys:
+        print(f"Alice's sample: {aSample}")
+        print(f"Bob's sample: {bSample}")
     print(f"Risk of eavesdropping: {risk}")
     
 
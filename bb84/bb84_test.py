@@ -2,6 +2,32 @@ import numpy as np
 import unittest
 import bb84_eaves
 import bb84
+from qkd_common import circuit_cache
+from qkd_common import noise
+import key_reconciliation
+import spot_checking
+import pipeline
+import parallel
+import monitor
+import benchmark
+from key_reconciliation import metrics
+import sweep
+from qkd_common import sweep_engine
+from qkd_common import backend_selection
+from key_reconciliation import classical_channel
+from key_reconciliation import key_pool
+import trials
+import analytic
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import json
+import subprocess
+import sys
+import os
+import tempfile
+from unittest import mock
+from types import SimpleNamespace
+from key_reconciliation.key_buffer import KeyBuffer
 
 class config():
      nBits = 32
@@ -12,6 +38,30 @@ class config():
      bBase = np.random.randint(2, size=nBits)
      eBase = np.random.randint(2, size=nBits)
 
+class largeConfig():
+     nBits = 4000
+     aBits = np.random.randint(2, size=nBits)
+     aBase = np.random.randint(2, size=nBits)
+     bBase = np.random.randint(2, size=nBits)
+     eBase = np.random.randint(2, size=nBits)
+
+def error_rate(aKey, bKey):
+     return np.mean(np.array(aKey) != np.array(bKey))
+
+def rate_delta(first, second, sigmas=4):
+     # sigmas standard deviations of the difference between the error rates of two pairs of
+     # keys, from their pooled error rate and their lengths (difference of two proportions)
+     n1, n2 = len(first[0]), len(second[0])
+     p = (error_rate(*first) * n1 + error_rate(*second) * n2) / (n1 + n2)
+     return sigmas * np.sqrt(p * (1 - p) * (1 / n1 + 1 / n2))
+
+def take_from_pool(path, count, length):
+    # Consumer process for case 29
+    pool = key_pool.KeyPool(path)
+    taken = [(offset, bytes(view)) for offset, view in (pool.take(length, timeout=60) for _ in range(count))]
+    pool.close()
+    return taken
+
 class test(unittest.TestCase, config):
      #Case 1 (bb84 without noise and eavesdropping)
     def test01(self):
@@ -35,6 +85,419 @@ class test(unittest.TestCase, config):
         print("\n" + f"Reconciliation key: {result['fixedKey']}")
         print(f"Hashed key: {result['newAliceKey']}")
         self.assertEqual(result['fixedKey'], result['alice_key'])
+    # Case 6 (batched simulation without noise and eavesdropping)
+    def test06(self):
+        print("\n" + "Case 6 (bb84: Batched Wo[Noise, Eavesdropping]")
+        aKey, bKey = bb84.bb84_protocol(config, False, batch_size=5)
+        self.assertEqual(aKey, bKey)
+        self.assertEqual(len(aKey), int(np.sum(config.aBase == config.bBase)))
+    # Case 7 (batched simulation with noise and eavesdropping)
+    def test07(self):
+        print("\n" + "Case 7 (bb84: Batched W[Noise, Eavesdropping]")
+        bb84_eaves.main(config, config.threshold, True, batch_size=5)
+    # Case 8 (transpiled circuits are reused)
+    def test08(self):
+        print("\n" + "Case 8 (bb84: Circuit cache)")
+        circuit_cache.clear_cache()
+        aKey, bKey = bb84.bb84_protocol(config, False)
+        info = circuit_cache.cache_info()
+        self.assertLessEqual(info["misses"], 8)
+        self.assertEqual(info["hits"] + info["misses"], len(aKey))
+    # Case 9 (noise models are built once per set of error rates)
+    def test09(self):
+        print("\n" + "Case 9 (bb84: Noise model cache)")
+        self.assertIs(noise.noise_protocol(), noise.noise_protocol(0.05, 0.05))
+        self.assertIsNot(noise.noise_protocol(0.01, 0.05), noise.noise_protocol())
+    # Case 10 (analytic backend without noise and eavesdropping)
+    def test10(self):
+        print("\n" + "Case 10 (bb84: Analytic Wo[Noise, Eavesdropping]")
+        aKey, bKey = bb84.bb84_protocol(config, False, backend="analytic")
+        self.assertEqual(aKey, bKey)
+        self.assertEqual(aKey, [int(config.aBits[i]) for i in range(config.nBits) if config.aBase[i] == config.bBase[i]])
+    # Case 11 (analytic backend gives the same error rate as Aer with noise)
+    def test11(self):
+        print("\n" + "Case 11 (bb84: Analytic vs Aer W[Noise])")
+        aerKeys = bb84.bb84_protocol(largeConfig, True, batch_size=1000)
+        analyticKeys = bb84.bb84_protocol(largeConfig, True, backend="analytic")
+        print(f"Error rate (Aer): {error_rate(*aerKeys)}, error rate (analytic): {error_rate(*analyticKeys)}")
+        self.assertAlmostEqual(error_rate(*aerKeys), error_rate(*analyticKeys), delta=rate_delta(aerKeys, analyticKeys))
+    # Case 12 (analytic backend gives the same error rate as Aer with eavesdropping)
+    def test12(self):
+        print("\n" + "Case 12 (bb84: Analytic vs Aer W[Noise, Eavesdropping])")
+        for use_noise in [False, True]:
+            aerKeys = bb84_eaves.bb84_protocol(largeConfig, use_noise, batch_size=1000)
+            analyticKeys = bb84_eaves.bb84_protocol(largeConfig, use_noise, backend="analytic")
+            print(f"Error rate (Aer): {error_rate(*aerKeys)}, error rate (analytic): {error_rate(*analyticKeys)}")
+            self.assertAlmostEqual(error_rate(*aerKeys), error_rate(*analyticKeys), delta=rate_delta(aerKeys, analyticKeys))
+    # Case 13 (cascade gives the same corrections as the list based reference)
+    def test13(self):
+        print("\n" + "Case 13 (Cascade vs reference)")
+        for block_size in [1, 3, 4, 8]:
+            aKey = np.random.randint(2, size=500).tolist()
+            bKey = [bit ^ int(np.random.rand() < 0.1) for bit in aKey]
+            self.assertEqual(key_reconciliation.cascade_error_correction(aKey, bKey, block_size),
+                             key_reconciliation.cascade_error_correction_reference(aKey, bKey, block_size))
+    # Case 14 (multi-pass cascade sized from the QBER)
+    def test14(self):
+        print("\n" + "Case 14 (Multi-pass cascade)")
+        aKey = np.random.randint(2, size=5000)
+        bKey = aKey ^ (np.random.rand(5000) < 0.05)
+        fixedKey, leakedBits, roundTrips = key_reconciliation.multi_pass_cascade(aKey, bKey, 0.05, seed=1)
+        print(f"Parity bits leaked: {leakedBits}, round trips: {roundTrips}")
+        self.assertEqual(fixedKey, aKey.tolist())
+        self.assertLess(leakedBits, len(aKey) / 2)
+        self.assertEqual(key_reconciliation.multi_pass_cascade(aKey, bKey, 0.05, seed=1), (fixedKey, leakedBits, roundTrips))
+    # Case 15 (bb84 with eavesdropping, reconciled with the multi-pass cascade)
+    def test15(self):
+        print("\n" + "Case 15 (bb84: Multi-pass cascade W[Eavesdropping])")
+        bb84_eaves.main(config, config.threshold, False, backend="analytic", use_qber=True)
+    # Case 16 (one-way LDPC reconciliation)
+    def test16(self):
+        print("\n" + "Case 16 (LDPC reconciliation)")
+        # The keys are seeded: at 5% a frame fails to decode in about one run out of ten
+        rng = np.random.default_rng(16)
+        aKey = rng.integers(0, 2, 20000)
+        bKey = aKey ^ (rng.random(20000) < 0.05)
+        fixedKey, leakedBits, failedFrames, roundTrips = key_reconciliation.ldpc_reconciliation(aKey, bKey, 0.05)
+        print(f"Bits disclosed: {leakedBits}, failed frames: {failedFrames}")
+        self.assertEqual(fixedKey, aKey.tolist())
+        self.assertLess(leakedBits, len(aKey) / 2)
+        self.assertEqual((failedFrames, roundTrips), (0, 1))
+        # Frames of a code with too little redundancy fall back to Cascade, and are reported
+        with metrics.recording(metrics.Recorder()) as recorder:
+            fixedKey = key_reconciliation.key_reconciliation(aKey, bKey, qber=0.05, seed=0, method="ldpc", rate=0.9)[0]
+        values = recorder.summary()["values"]
+        self.assertEqual(fixedKey, aKey.tolist())
+        self.assertEqual(values["ldpc_failed_frames"], 2)
+        self.assertGreater(values["round_trips"], 10)
+        self.assertEqual(key_reconciliation.key_reconciliation(aKey, bKey, qber=0.05, method="ldpc")[0], aKey.tolist())
+        with self.assertRaises(ValueError):
+            key_reconciliation.key_reconciliation(aKey, bKey, method="ldpc")
+    # Case 17 (Toeplitz privacy amplification)
+    def test17(self):
+        print("\n" + "Case 17 (Toeplitz privacy amplification)")
+        key = np.random.randint(2, size=200)
+        diagonals = np.random.default_rng(7).integers(0, 2, 80 + 200 - 1, dtype=np.uint8)
+        matrix = np.array([[diagonals[i - j + 199] for j in range(200)] for i in range(80)])
+        self.assertEqual(key_reconciliation.toeplitz_hash(key, 80, seed=7).tolist(), (matrix @ key % 2).tolist())
+
+        aKey = np.random.randint(2, size=5000)
+        bKey = aKey ^ (np.random.rand(5000) < 0.05)
+        fixedKey, newAliceKey, newBobKey = key_reconciliation.key_reconciliation(aKey, bKey, qber=0.05, seed=1)
+        leakedBits = key_reconciliation.multi_pass_cascade(aKey, bKey, 0.05, seed=1)[1]
+        self.assertEqual(newAliceKey, newBobKey)
+        self.assertEqual(len(newBobKey), key_reconciliation.privacy_amplification_length(5000, 0.05, leakedBits + key_reconciliation.reconciliation.VERIFICATION_BITS))
+        self.assertGreater(len(newBobKey), 0)
+        # Without a seed, a fresh one is drawn for every reconciliation, and Alice and Bob share it
+        otherAliceKey, otherBobKey = key_reconciliation.key_reconciliation(aKey, bKey, qber=0.05)[1:]
+        self.assertEqual(otherAliceKey, otherBobKey)
+        self.assertNotEqual(otherBobKey, key_reconciliation.key_reconciliation(aKey, bKey, qber=0.05)[1])
+        # Without a qber, Cascade sizes its blocks from the errors it finds
+        aKey = np.random.randint(2, size=2000)
+        bKey = aKey ^ (np.random.rand(2000) < 0.03)
+        fixedKey, newBobKey, newAliceKey = key_reconciliation.key_reconciliation(aKey, bKey)
+        self.assertEqual(fixedKey, aKey.tolist())
+        self.assertEqual(newAliceKey, newBobKey)
+        self.assertGreater(len(newBobKey), 500)
+    # Case 18 (index based spot checking)
+    def test18(self):
+        print("\n" + "Case 18 (Spot checking)")
+        aKey = np.random.randint(2, size=20000).tolist()
+        bKey = [bit ^ int(np.random.rand() < 0.1) for bit in aKey]
+        error, aSample, bSample, aRest, bRest, interval = spot_checking.spot_checking(aKey, bKey, 5000, seed=3)
+        print(f"Error rate: {error}, interval: {interval}")
+        self.assertEqual(len(aSample), 5000)
+        self.assertEqual(len(aRest), 15000)
+        self.assertEqual(len(aKey), 20000)
+        self.assertEqual(error, np.mean(np.array(aSample) != np.array(bSample)))
+        self.assertTrue(interval[0] < error < interval[1])
+        self.assertAlmostEqual(error, 0.1, delta=4 * np.sqrt(0.1 * 0.9 / 5000))
+        self.assertEqual(spot_checking.spot_checking(aKey, bKey, 5000, seed=3), (error, aSample, bSample, aRest, bRest, interval))
+        # The remaining bits keep their order
+        aRest, bRest = spot_checking.spot_checking(list(range(10)), list(range(10)), 4, seed=1)[3:5]
+        self.assertEqual(aRest, sorted(aRest))
+        self.assertEqual(aRest, bRest)
+    # Case 19 (keys are passed as bit buffers)
+    def test19(self):
+        print("\n" + "Case 19 (Key buffer)")
+        aKey, bKey = bb84.bb84_protocol(largeConfig, True, backend="analytic")
+        self.assertIsInstance(aKey, KeyBuffer)
+        # The bits are stored eight per byte, and a slice is a view of the same bytes
+        self.assertEqual(aKey.words.nbytes, (len(aKey) + 7) // 8)
+        view = bKey[10:20]
+        bit = bKey[10]
+        view[0] ^= 1
+        self.assertEqual(bKey[10], 1 - bit)
+        self.assertIs(view.words, bKey.words)
+        self.assertEqual((aKey ^ bKey).popcount(), int(np.sum(np.array(aKey) != np.array(bKey))))
+        self.assertEqual(aKey.parity(), sum(aKey) % 2)
+        self.assertEqual(KeyBuffer.unpack(aKey.pack(), len(aKey)), aKey)
+        self.assertEqual(len(aKey.pack()), (len(aKey) + 7) // 8)
+
+        eKey = KeyBuffer.from_values([1, np.nan, 0])
+        self.assertEqual(eKey.popcount(), 1)
+        self.assertTrue(np.isnan(eKey[1]))
+        self.assertEqual(eKey[::2], [1, 0])
+
+        # Unpacking the bits into an array always copies them, so np.array cannot skip the copy
+        self.assertEqual(np.asarray(aKey).tolist(), aKey.tolist())
+        self.assertFalse(np.shares_memory(np.asarray(aKey), aKey.words))
+        self.assertEqual(np.asarray(aKey, dtype=float).dtype, float)
+        with self.assertRaises(ValueError):
+            np.array(aKey, copy=False)
+    # Case 20 (streaming pipeline)
+    def test20(self):
+        print("\n" + "Case 20 (bb84: Streaming pipeline W[Noise])")
+        # Blocks are produced on demand, so a huge run only does the work for the blocks taken
+        blocks = pipeline.key_blocks(10 ** 9, block_size=20000, use_noise=True, seed=5)
+        for _ in range(3):
+            block = next(blocks)
+            print(f"Block {block['block']}: error rate {block['qber']}, final key length {len(block['alice_key'])}")
+            self.assertGreater(len(block["alice_key"]), 0)
+            self.assertEqual(block["alice_key"], block["bob_key"])
+        # With eavesdropping every block is discarded
+        for block in pipeline.key_blocks(40000, block_size=20000, eavesdropping=True, seed=5):
+            self.assertGreater(block["qber"], pipeline.MAX_QBER)
+            self.assertEqual(len(block["alice_key"]), 0)
+        # A block whose keys still differ after reconciliation fails verification and is dropped
+        uncorrected = lambda aKey, bKey, qber, seed=None: (KeyBuffer(np.array(bKey)), 0, 0)
+        with mock.patch.object(key_reconciliation, "multi_pass_cascade", uncorrected):
+            block = next(pipeline.key_blocks(20000, block_size=20000, use_noise=True, seed=5))
+        self.assertFalse(block["verified"])
+        self.assertEqual((len(block["alice_key"]), len(block["bob_key"])), (0, 0))
+        self.assertTrue(next(pipeline.key_blocks(20000, block_size=20000, use_noise=True, seed=5))["verified"])
+    # Case 21 (sharded runs are reproducible for any number of workers)
+    def test21(self):
+        print("\n" + "Case 21 (bb84: Sharded W[Noise])")
+        aKey, bKey = parallel.bb84_protocol(largeConfig, True, workers=1, shard_size=1000, seed=11)
+        self.assertEqual(len(aKey), int(np.sum(largeConfig.aBase == largeConfig.bBase)))
+        self.assertEqual(parallel.bb84_protocol(largeConfig, True, workers=2, shard_size=1000, seed=11), (aKey, bKey))
+        print(f"Error rate: {error_rate(aKey, bKey)}")
+        analyticKeys = bb84.bb84_protocol(largeConfig, True, backend="analytic")
+        self.assertAlmostEqual(error_rate(aKey, bKey), error_rate(*analyticKeys), delta=rate_delta((aKey, bKey), analyticKeys))
+    # Case 22 (sequential test stops an eavesdropped session early)
+    def test22(self):
+        print("\n" + "Case 22 (bb84: Early abort W[Eavesdropping])")
+        result = monitor.monitored_protocol(largeConfig, eavesdropping=True, chunk_size=256, seed=2)
+        print(f"Qubits sent: {result['qubits_sent']}, saved: {result['qubits_saved']}, error rate: {result['qber']}")
+        self.assertTrue(result["aborted"])
+        self.assertGreater(result["qubits_saved"], largeConfig.nBits / 2)
+        result = monitor.monitored_protocol(largeConfig, use_noise=True, chunk_size=256, seed=2)
+        self.assertFalse(result["aborted"])
+        self.assertEqual(result["qubits_saved"], 0)
+        # alpha bounds the false alarms of whole sessions, however long they are
+        rng = np.random.default_rng(3)
+        aborted = 0
+        for session in range(100):
+            bits = rng.integers(0, 2, (3, 200000))
+            vObject = SimpleNamespace(nBits=200000, aBits=bits[0], aBase=bits[1], bBase=bits[2])
+            aborted += monitor.monitored_protocol(vObject, use_noise=True, alpha=0.01, seed=session)["aborted"]
+        print(f"Honest sessions aborted: {aborted} of 100, p0: {monitor.honest_qber(bb84, True)}")
+        self.assertLessEqual(aborted, 3)
+        self.assertAlmostEqual(monitor.honest_qber(bb84, True), error_rate(*bb84.bb84_protocol(vObject, True, backend="analytic")), delta=0.003)
+        vObject.eBase = bits[0]
+        self.assertTrue(monitor.monitored_protocol(vObject, use_noise=True, eavesdropping=True, seed=0)["aborted"])
+    # Case 23 (benchmark records every stage and saves them as JSON)
+    def test23(self):
+        print("\n" + "Case 23 (bb84: Benchmark W[Noise, Eavesdropping])")
+        results = benchmark.run(200, "noise+eavesdropping", max_single=0, max_batched=200)
+        self.assertEqual([r["stage"] for r in results], ["sifting", "quantumSendBatch", "analytic", "spot_checking",
+                                                         "cascade_error_correction", "multi_pass_cascade", "privacy_amplification", "total"])
+        self.assertTrue(all(r["qubits"] == 200 and r["qubits_per_second"] > 0 for r in results))
+        self.assertIn("secret_bits_per_second", results[-1])
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "results.json")
+            benchmark.save_results(results, path)
+            with open(path) as file:
+                self.assertEqual(json.load(file)["results"], results)
+    # Case 24 (metrics of a run are recorded, and the default recorder keeps nothing)
+    def test24(self):
+        print("\n" + "Case 24 (bb84: Metrics W[Noise, Eavesdropping])")
+        circuit_cache.clear_cache()
+        with metrics.recording(metrics.Profiler()) as recorder:
+            bb84_eaves.main(config, config.threshold, True, batch_size=5, use_qber=True)
+        summary = recorder.summary()
+        print(summary)
+        self.assertEqual(set(summary["stages"]), {"quantum", "spot_checking", "error_correction", "privacy_amplification"})
+        # One job per distinct intercept-resend circuit of every batch of 5 sifted qubits
+        sifted = np.stack([config.aBits, config.aBase, config.eBase], axis=1)[config.aBase == config.bBase]
+        jobs = sum(len(np.unique(sifted[start:start + 5], axis=0)) for start in range(0, len(sifted), 5))
+        self.assertEqual(summary["counts"]["simulator_calls"], jobs)
+        self.assertEqual(summary["counts"]["transpile_cache_misses"], circuit_cache.cache_info()["misses"])
+        for name in ["sifting_ratio", "qber", "leaked_bits", "round_trips", "final_key_bits", "key_rate"]:
+            self.assertIn(name, summary["values"])
+        self.assertIn("quantum", recorder.profiles)
+        self.assertEqual(type(metrics.active), metrics.Metrics)
+        self.assertIs(metrics.active.stage("quantum"), metrics.NULL_STAGE)
+    # Case 25 (single circuit intercept-resend with partial interception)
+    def test25(self):
+        print("\n" + "Case 25 (bb84: Intercept-resend circuit W[Eavesdropping 50% of the time, Noise])")
+        sifted = largeConfig.aBase == largeConfig.bBase
+        n = int(np.sum(sifted))
+        with metrics.recording(metrics.Recorder()) as recorder:
+            eBits, bBits = bb84_eaves.quantumInterceptBatch(largeConfig.aBits[sifted], largeConfig.aBase[sifted], largeConfig.bBase[sifted],
+                                                            largeConfig.eBase[sifted], np.ones(n), True, 1000, np.random.default_rng(3))
+        # One job per distinct circuit of every batch, with as many shots as qubits
+        circuits = np.stack([largeConfig.aBits[sifted], largeConfig.aBase[sifted], largeConfig.eBase[sifted]], axis=1)
+        jobs = sum(len(np.unique(circuits[start:start + 1000], axis=0)) for start in range(0, n, 1000))
+        self.assertEqual(recorder.counts["simulator_calls"], jobs)
+        self.assertFalse(np.isnan(eBits).any())
+        # Where Eve guessed Alice's basis she knows the bit, up to noise
+        guessed = largeConfig.eBase[sifted] == largeConfig.aBase[sifted]
+        self.assertLess(np.mean(np.array(eBits)[guessed] != largeConfig.aBits[sifted][guessed]), 0.2)
+
+        half = SimpleNamespace(**{name: getattr(largeConfig, name) for name in ["nBits", "aBits", "aBase", "bBase", "eBase"]})
+        half.eIntercepts = bb84_eaves.createIntercepts(half.nBits, 0.5, np.random.default_rng(4))
+        aerKeys = bb84_eaves.bb84_protocol(half, True, batch_size=1000)
+        analyticKeys = bb84_eaves.bb84_protocol(half, True, backend="analytic")
+        fullKeys = bb84_eaves.bb84_protocol(largeConfig, True, backend="analytic")
+        print(f"Error rate (Aer): {error_rate(*aerKeys)}, error rate (analytic): {error_rate(*analyticKeys)}, with every qubit intercepted: {error_rate(*fullKeys)}")
+        self.assertAlmostEqual(error_rate(*aerKeys), error_rate(*analyticKeys), delta=rate_delta(aerKeys, analyticKeys))
+        self.assertLess(error_rate(*analyticKeys), error_rate(*fullKeys) - rate_delta(analyticKeys, fullKeys))
+        # The qubit by qubit mode uses the same interceptions
+        serialKeys = bb84_eaves.bb84_protocol(parallel.shard(half, 0, 2000), True)
+        print(f"Error rate (Aer, qubit by qubit): {error_rate(*serialKeys)}")
+        self.assertAlmostEqual(error_rate(*serialKeys), error_rate(*analyticKeys), delta=rate_delta(serialKeys, analyticKeys))
+        self.assertLess(error_rate(*serialKeys), error_rate(*fullKeys) - rate_delta(serialKeys, fullKeys))
+    # Case 26 (sweeps only compute the cells that are not cached)
+    def test26(self):
+        print("\n" + "Case 26 (bb84: Sweep W[Noise, Eavesdropping])")
+        with tempfile.TemporaryDirectory() as directory:
+            results = sweep.main({"eveInterceptionRate": [0, 1]}, sweep.DEFAULTS, directory, workers=1)
+            self.assertGreater(results[0]["secret_key_rate"], 0.3)
+            self.assertTrue(results[1]["aborted"])
+            # A cached result is returned as it is stored, without running the cell again
+            version = sweep.CODE_VERSION
+            sweep_engine.save_cell(directory, {**sweep.DEFAULTS, "eveInterceptionRate": 1}, {"cached": True}, version)
+            extended = sweep.sweep(sweep.run_cell, {"eveInterceptionRate": [0, 1], "depolarizing_rate": [0.05]}, sweep.DEFAULTS, directory, 1, version)
+            self.assertEqual(results[0], sweep.sweep(sweep.run_cell, {"eveInterceptionRate": [0]}, sweep.DEFAULTS, directory, version=version)[0])
+            self.assertTrue(sweep.sweep(sweep.run_cell, {"eveInterceptionRate": [1]}, sweep.DEFAULTS, directory, version=version)[0]["cached"])
+            self.assertEqual(len(os.listdir(directory)), 4)
+            self.assertLess(extended[0]["secret_key_rate"], results[0]["secret_key_rate"])
+            # Results of another version of the code are not taken
+            self.assertNotIn("cached", sweep.sweep(sweep.run_cell, {"eveInterceptionRate": [1]}, sweep.DEFAULTS, directory, 1, "former")[0])
+        # A cell only sets the error rates of the protocol for its own run
+        rates = (bb84_eaves.depolarizing_rate, bb84_eaves.readout_rate)
+        sweep.cell_keys({**sweep.DEFAULTS, "nBits": 200, "depolarizing_rate": 0.2, "readout_rate": 0.1, "backend": "aer"})
+        self.assertEqual((bb84_eaves.depolarizing_rate, bb84_eaves.readout_rate), rates)
+        # A cell whose keys still differ after reconciliation keeps no key
+        self.assertFalse(results[0]["verification_failed"])
+        uncorrected = lambda aKey, bKey, qber, seed=None: (KeyBuffer(np.array(bKey)), 0, 0)
+        with mock.patch.object(key_reconciliation, "multi_pass_cascade", uncorrected):
+            result, aliceKey, bobKey = sweep.cell_keys({**sweep.DEFAULTS, "depolarizing_rate": 0.05})
+        self.assertTrue(result["verification_failed"])
+        self.assertEqual((result["secret_bits"], len(aliceKey), len(bobKey)), (0, 0, 0))
+    # Case 27 (BB84 circuits are Clifford and run on the stabilizer method)
+    def test27(self):
+        print("\n" + "Case 27 (bb84: Aer method selection W[Noise, Eavesdropping])")
+        circuits = [bb84.transpiledCircuit(1, 1, 0), bb84_eaves.transpiledInterceptCircuit(1, 0, 1, 0), bb84_eaves.transpiledResendCircuit(1, 1)]
+        for circuit in circuits:
+            self.assertEqual(backend_selection.select_method(circuit, noise.noise_protocol(), 1000), "stabilizer")
+        with metrics.recording(metrics.Recorder()) as recorder:
+            aKey, bKey = bb84_eaves.bb84_protocol(largeConfig, True, batch_size=1000)
+        self.assertEqual(recorder.values["aer_method"], "stabilizer")
+        print(f"Error rate: {error_rate(aKey, bKey)}")
+        analyticKeys = bb84_eaves.bb84_protocol(largeConfig, True, backend="analytic")
+        self.assertAlmostEqual(error_rate(aKey, bKey), error_rate(*analyticKeys), delta=rate_delta((aKey, bKey), analyticKeys))
+    # Case 28 (Cascade over the classical channel)
+    def test28(self):
+        print("\n" + "Case 28 (bb84: reconciliation over the classical channel)")
+        rng = np.random.default_rng(0)
+        aKey = rng.integers(0, 2, 20000, dtype=np.uint8)
+        bKey = aKey ^ (rng.random(20000) < 0.03).astype(np.uint8)
+        _, _, round_trips = key_reconciliation.multi_pass_cascade(aKey, bKey, 0.03, seed=1)
+        fixedKey, leaked_bits, stats = classical_channel.reconcile(aKey, bKey, 0.03, seed=1)
+        print(f"Round trips: {stats.round_trips} (multi_pass_cascade: {round_trips}), messages: {stats.messages}, bytes: {stats.bytes}")
+        self.assertEqual(fixedKey, aKey.tolist())
+        self.assertEqual(stats.round_trips, round_trips)
+        self.assertEqual(stats.messages, 2 * stats.round_trips + 2)
+        tcpKey, tcp_leaked_bits, tcp_stats = classical_channel.reconcile(aKey, bKey, 0.03, seed=1, transport="tcp", latency=0.001)
+        self.assertEqual(tcpKey, fixedKey)
+        self.assertEqual(tcp_leaked_bits, leaked_bits)
+        self.assertEqual(tcp_stats.summary(), stats.summary())
+    # Case 29 (key pool shared by consumer processes while keys are appended)
+    def test29(self):
+        print("\n" + "Case 29 (bb84: persistent key pool with concurrent consumers)")
+        with tempfile.TemporaryDirectory() as directory:
+            alicePool, bobPool = key_pool.open_pools(directory)
+            with ProcessPoolExecutor(max_workers=2, mp_context=multiprocessing.get_context("spawn")) as executor:
+                consumers = [executor.submit(take_from_pool, alicePool.path, 10, 16) for _ in range(2)]
+                appended = pipeline.fill_pools(alicePool, bobPool, 2 ** 15, block_size=2 ** 12, use_noise=True, seed=0)
+                taken = sorted(sum((consumer.result() for consumer in consumers), []))
+            print(f"Bytes appended: {appended}, taken: {16 * len(taken)}")
+            self.assertEqual(len(alicePool), appended)
+            self.assertEqual(len(bobPool), appended)
+            self.assertEqual([offset for offset, _ in taken], list(range(0, 320, 16)))
+            self.assertEqual(alicePool.taken(), 320)
+            for offset, data in taken:
+                self.assertEqual(bytes(alicePool.read(offset, 16)), data)
+                self.assertEqual(bytes(bobPool.consume(offset, 16)), data)
+            self.assertEqual(bobPool.taken(), 320)
+            self.assertEqual(len(key_pool.key_bits(alicePool.read(0, 16))), 128)
+            with self.assertRaises(ValueError):
+                alicePool.take(appended)
+            alicePool.close()
+
+            # A reopened pool holds what was committed
+            reopened = key_pool.KeyPool(alicePool.path)
+            self.assertEqual((len(reopened), reopened.available()), (appended, appended - 320))
+            self.assertEqual(bytes(reopened.read(0, 16)), taken[0][1])
+            # Keys that differ are not appended to either pool, so the pools stay the same
+            with self.assertRaises(ValueError):
+                key_pool.append_keys(reopened, bobPool, [0] * 64, [0] * 63 + [1])
+            self.assertEqual((len(reopened), len(bobPool)), (appended, appended))
+            # Blocks that fail verification are not appended
+            uncorrected = lambda aKey, bKey, qber, seed=None: (KeyBuffer(np.array(bKey)), 0, 0)
+            with mock.patch.object(key_reconciliation, "multi_pass_cascade", uncorrected):
+                self.assertEqual(pipeline.fill_pools(reopened, bobPool, 2 ** 12, block_size=2 ** 12, use_noise=True, seed=0), 0)
+            self.assertEqual((len(reopened), len(bobPool)), (appended, appended))
+            reopened.close()
+            bobPool.close()
+    # Case 30 (the reconciliation package does not load the simulators)
+    def test30(self):
+        print("\n" + "Case 30 (bb84: lightweight key_reconciliation import)")
+        script = ("import sys, numpy as np, key_reconciliation\n"
+                  "key = np.random.default_rng(0).integers(0, 2, 1000, dtype=np.uint8)\n"
+                  "fixedKey, finalKey, aliceKey = key_reconciliation.key_reconciliation(key, key ^ (np.arange(1000) % 50 == 0), qber=0.02, seed=0)\n"
+                  "print(fixedKey == key.tolist(), finalKey == aliceKey, sorted(name for name in ['qiskit', 'qiskit_aer', 'asyncio'] if name in sys.modules))")
+        # The package is found where this process found it, installed or not
+        root = os.path.dirname(os.path.dirname(os.path.abspath(key_reconciliation.__file__)))
+        output = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)), env={**os.environ, "PYTHONPATH": root}).stdout
+        print(output)
+        self.assertEqual(output.split(), ["True", "True", "[]"])
+        self.assertIs(key_reconciliation.metrics, metrics)
+        self.assertIs(key_reconciliation.KeyBuffer, KeyBuffer)
+    # Case 31 (Monte Carlo trials of whole sessions)
+    def test31(self):
+        print("\n" + "Case 31 (bb84: Monte Carlo trials W[Noise, Eavesdropping])")
+        options = dict(depolarizing_rate=0.05, readout_rate=0.05, seed=1)
+        clean = trials.run_trials(200, 2000, **options)
+        attacked = trials.run_trials(200, 2000, eveInterceptionRate=1, reconcile=False, **options)
+        detection, false_alarm = trials.detection_rates(attacked, clean)
+        print(f"Detection: {detection}, false alarms: {false_alarm}, QBER: {clean['qber'].mean()}, key bits: {np.median(clean['final_key_bits'])}")
+        self.assertEqual(detection, 1.0)
+        self.assertLess(false_alarm, 0.05)
+        self.assertAlmostEqual(clean["qber"].mean(), 0.0625, delta=0.005)
+        self.assertAlmostEqual(attacked["qber"].mean(), 0.375 + 0.0625 * 0.5, delta=0.02)
+        self.assertGreater(np.median(clean["final_key_bits"]), 0)
+        self.assertTrue(np.all(clean["final_key_bits"][clean["aborted"]] == 0))
+        self.assertTrue(np.all(clean["sampled"] == clean["sifted"] // 8))
+        counts, edges = trials.histograms(clean)["estimated_qber"]
+        self.assertEqual(counts.sum(), 200)
+        detections, false_alarms = trials.threshold_curve(attacked, clean, [0.0, 0.11, 1.0])
+        self.assertEqual(list(detections), [1.0, 1.0, 0.0])
+        self.assertEqual(false_alarms[1], false_alarm)
+        # Chunks only bound the memory
+        chunked = trials.run_trials(200, 2000, max_elements=2000 * 30, **options)
+        for name in clean:
+            self.assertTrue(np.array_equal(clean[name], chunked[name]))
+        # The trials measure with analytic.measure_qubits, row by row or on the whole array
+        u, _ = trials.trial_numbers(np.random.SeedSequence(2).spawn(3), 100)
+        bits, bases = (u[0] < 0.5).astype(np.uint8), (u[1] < 0.5).astype(np.uint8)
+        whole = analytic.measure_qubits(bits, bases, 1 - bases, 0.05, 0.05, uniforms=u[5:8])
+        for row in range(3):
+            self.assertTrue(np.array_equal(whole[row], analytic.measure_qubits(bits[row], bases[row], 1 - bases[row], 0.05, 0.05, uniforms=u[5:8, row])))
 
 if __name__ == '__main__':
     unittest.main()
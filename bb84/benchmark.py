@@ -0,0 +1,106 @@
+import argparse
+import numpy as np
+import analytic
+import bb84
+import bb84_eaves
+import key_reconciliation
+from key_reconciliation.key_buffer import KeyBuffer
+from spot_checking import spot_checking
+from qkd_common.benchmark_harness import timed, record, save_results, compare_results, print_results
+
+# Times every stage of BB84 on its own, for each key size and variant: the Aer simulation
+# (qubit by qubit with quantumSend and in batches), the analytic simulation, sifting, spot
+# checking, Cascade and privacy amplification. Every record gives the qubits sent per second
+# through the stage, and the last one of each run ("total") the secret bits per second.
+# Usage: python benchmark.py [--sizes 100 1000 ...] [--output results.json] [--compare old.json]
+
+# Largest number of qubits simulated on Aer, qubit by qubit and in batches. Larger runs only
+# time the analytic simulation
+MAX_SINGLE_QUBITS = 1000
+MAX_BATCHED_QUBITS = 10000
+
+SIZES = [10 ** k for k in range(2, 8)]
+VARIANTS = {"clean": (False, False), "noise": (True, False), "eavesdropping": (False, True), "noise+eavesdropping": (True, True)}
+
+def sift(aBits, aBase, bBase, eBase):
+    # Keeps the positions where Alice and Bob chose the same basis
+    sifted = aBase == bBase
+    return aBits[sifted], aBase[sifted], bBase[sifted], eBase[sifted]
+
+def send_single(aBits, aBase, bBase, eBase, use_noise, eavesdropping):
+    # Same loop as bb84.bb84_protocol without batching
+    for i in range(len(aBits)):
+        if eavesdropping:
+            bb84_eaves.quantumSend(aBits[i], aBase[i], bBase[i], eBase[i], use_noise)
+        else:
+            bb84.quantumSend(aBits[i], aBase[i], bBase[i], use_noise)
+
+def send_batched(aBits, aBase, bBase, eBase, use_noise, eavesdropping, rng):
+    if eavesdropping:
+        return bb84_eaves.quantumSendBatch(aBits, aBase, bBase, eBase, use_noise, rng=rng)
+    return bb84.quantumSendBatch(aBits, aBase, bBase, use_noise, rng=rng)
+
+def send_analytic(aBits, aBase, bBase, eBase, use_noise, eavesdropping, rng):
+    rates = (bb84.depolarizing_rate, bb84.readout_rate) if use_noise else (0.0, 0.0)
+    if eavesdropping:
+        return analytic.intercept_resend(aBits, aBase, bBase, eBase, *rates, rng=rng)
+    return analytic.measure_qubits(aBits, aBase, bBase, *rates, rng=rng)
+
+def run(nBits, variant, max_single=MAX_SINGLE_QUBITS, max_batched=MAX_BATCHED_QUBITS, seed=0):
+    # Returns the records of every stage for nBits qubits sent
+    use_noise, eavesdropping = VARIANTS[variant]
+    rng = np.random.default_rng(seed)
+    aBits, aBase, bBase, eBase = (rng.integers(0, 2, nBits, dtype=np.uint8) for _ in range(4))
+    results = []
+
+    def add(stage, seconds, **extra):
+        results.append(record("bb84", stage, variant, nBits, seconds, **extra))
+
+    (aBits, aBase, bBase, eBase), seconds = timed(sift, aBits, aBase, bBase, eBase)
+    add("sifting", seconds)
+    total = seconds
+
+    if nBits <= max_single:
+        add("quantumSend", timed(send_single, aBits, aBase, bBase, eBase, use_noise, eavesdropping)[1])
+    if nBits <= max_batched:
+        add("quantumSendBatch", timed(send_batched, aBits, aBase, bBase, eBase, use_noise, eavesdropping, rng)[1])
+    bKey, seconds = timed(send_analytic, aBits, aBase, bBase, eBase, use_noise, eavesdropping, rng)
+    add("analytic", seconds)
+    total += seconds
+
+    (qber, _, _, aRest, bRest, _), seconds = timed(spot_checking, KeyBuffer(aBits), KeyBuffer(bKey), len(aBits) // 8, seed)
+    add("spot_checking", seconds, qber=qber)
+    total += seconds
+
+    # cascade_error_correction with the block size that fits the measured error rate, then
+    # the multi-pass Cascade, whose leakage is used for privacy amplification
+    block_size = key_reconciliation.qber_block_size(qber, len(aRest))
+    add("cascade_error_correction", timed(key_reconciliation.cascade_error_correction, aRest, bRest, block_size)[1])
+    (fixed_key, leaked_bits, _), seconds = timed(key_reconciliation.multi_pass_cascade, aRest, bRest, qber, seed=seed)
+    add("multi_pass_cascade", seconds, leaked_bits=leaked_bits)
+    total += seconds
+
+    final_key, seconds = timed(key_reconciliation.privacy_amplification, fixed_key, qber, leaked_bits, seed)
+    add("privacy_amplification", seconds)
+    total += seconds
+
+    add("total", total, secret_bits=len(final_key), secret_bits_per_second=len(final_key) / total)
+    return results
+
+def main(sizes=SIZES, variants=VARIANTS, output=None, compare=None):
+    results = [r for nBits in sizes for variant in variants for r in run(nBits, variant)]
+    print_results(results)
+    if output:
+        save_results(results, output)
+    if compare:
+        compare_results(compare, results)
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Times every stage of BB84")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES, help="numbers of qubits sent")
+    parser.add_argument("--variants", nargs="+", default=list(VARIANTS), choices=list(VARIANTS))
+    parser.add_argument("--output", help="JSON file the results are saved to")
+    parser.add_argument("--compare", help="JSON file of an earlier run to compare with")
+    args = parser.parse_args()
+    main(args.sizes, args.variants, args.output, args.compare)
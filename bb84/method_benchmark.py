@@ -0,0 +1,58 @@
+import sys
+import time
+import numpy as np
+from qiskit import QuantumCircuit, transpile
+from qiskit_aer import AerSimulator
+import bb84
+import bb84_eaves
+from qkd_common import backend_selection
+from qkd_common.noise import noise_protocol
+
+# Compares the Aer methods on the batched BB84 circuits: the default AerSimulator() running the
+# circuits prepared with initialize (as before backend_selection), and every method running the
+# Clifford circuits, with the one backend_selection picks marked. Prints the qubits simulated
+# per second. Usage: python method_benchmark.py [qubits]
+
+def baseline_circuit(aBit, aBase, bBase):
+    # bb84.buildCircuit as it was, preparing |1> with initialize
+    circuit = QuantumCircuit(1)
+    if aBit:
+        circuit.initialize(1)
+    if aBase:
+        circuit.h(0)
+    if bBase:
+        circuit.h(0)
+    circuit.measure_all()
+    return circuit
+
+def baseline_circuits(aBits, aBases, bBases):
+    # Transpiled for the default simulator, once per distinct circuit
+    simulator = AerSimulator()
+    circuits = {key: transpile(baseline_circuit(*key), simulator, optimization_level=1, seed_transpiler=0) for key in set(zip(aBits, aBases, bBases))}
+    return simulator, [circuits[key] for key in zip(aBits, aBases, bBases)]
+
+def timed_run(simulator, circuits, noise_model, shots=1):
+    options = {} if noise_model is None else {"noise_model": noise_model}
+    start = time.perf_counter()
+    simulator.run(circuits, shots=shots, memory=True, seed_simulator=0, **options).result()
+    return time.perf_counter() - start
+
+def main(nBits=10000):
+    rng = np.random.default_rng(0)
+    aBits, aBases, bBases, eBases = (rng.integers(0, 2, nBits).tolist() for _ in range(4))
+    default, baseline = baseline_circuits(aBits, aBases, bBases)
+    circuits = {"bb84": [bb84.transpiledCircuit(*key) for key in zip(aBits, aBases, bBases)],
+                "bb84_eaves": [bb84_eaves.transpiledInterceptCircuit(*key) for key in zip(aBits, aBases, eBases, bBases)]}
+
+    print(f"{'circuits':<11} {'noise':<6} {'method':<24} {'qubits/s':>10}")
+    for use_noise in [False, True]:
+        noise_model = noise_protocol() if use_noise else None
+        print(f"{'bb84':<11} {str(use_noise):<6} {'default (initialize)':<24} {nBits / timed_run(default, baseline, noise_model):>10.0f}")
+        for name, batch in circuits.items():
+            chosen = backend_selection.select_method(batch, noise_model)
+            for method in ["automatic", "stabilizer", "statevector", "density_matrix"]:
+                label = method + (" (selected)" if method == chosen else "")
+                print(f"{name:<11} {str(use_noise):<6} {label:<24} {nBits / timed_run(backend_selection.simulator(method), batch, noise_model):>10.0f}")
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
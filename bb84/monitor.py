@@ -0,0 +1,64 @@
+import numpy as np
+import bb84
+import bb84_eaves
+import analytic
+from key_reconciliation.key_buffer import KeyBuffer
+from parallel import shard
+from qkd_common.sequential_test import SequentialTest
+
+# Early abort for BB84. The qubits are sent in chunks, and a random share of the sifted bits of
+# every chunk (interleaved with the key instead of taken at the end) is compared as it arrives.
+# A sequential probability ratio test on these comparisons stops the session as soon as the
+# error rate is more likely to be the one of an attacked link than of an honest one
+
+# Error rate of an honest link assumed without noise (the test needs p0 > 0), and of a link
+# where Eve intercepts and resends every qubit
+HONEST_QBER = 0.05
+ATTACKED_QBER = 0.25
+
+def honest_qber(protocol, use_noise):
+    # p0 of the sequential test: the error rate the noise of the protocol module gives an honest
+    # link (analytic.expected_qber), and never less than HONEST_QBER
+    if not use_noise:
+        return HONEST_QBER
+    return max(analytic.expected_qber(protocol.depolarizing_rate, protocol.readout_rate), HONEST_QBER)
+
+def monitored_protocol(vObject, use_noise=False, eavesdropping=False, backend="analytic", chunk_size=1024,
+                       sample_rate=0.1, p0=None, p1=ATTACKED_QBER, alpha=0.01, beta=0.01, seed=None):
+    # Runs bb84_protocol (or bb84_eaves.bb84_protocol) chunk by chunk. Returns whether the session
+    # was aborted, the number of qubits sent and saved, the observed error rate, and the
+    # unsampled key bits gathered until then. alpha is the false alarm rate of the whole session
+    protocol = bb84_eaves if eavesdropping else bb84
+    p0 = honest_qber(protocol, use_noise) if p0 is None else p0
+    rng = np.random.default_rng(seed)
+    test = SequentialTest(p0, p1, alpha, beta)
+    aKeys = []
+    bKeys = []
+    sent = 0
+    aborted = False
+
+    for start in range(0, vObject.nBits, chunk_size):
+        chunk = shard(vObject, start, min(start + chunk_size, vObject.nBits))
+        if backend == "analytic":
+            aKey, bKey = protocol.bb84_protocol_analytic(chunk, use_noise, rng)
+        else:
+            aKey, bKey = protocol.bb84_protocol_batched(chunk, use_noise, bb84.BATCH_SIZE, rng)
+        sent += chunk.nBits
+
+        # Interleaved sample
+        mask = rng.random(len(aKey)) < sample_rate
+        errors = (KeyBuffer(aKey.bits[mask]) ^ KeyBuffer(bKey.bits[mask])).popcount()
+        aKeys.append(KeyBuffer(aKey.bits[~mask]))
+        bKeys.append(KeyBuffer(bKey.bits[~mask]))
+        if test.update(errors, int(np.count_nonzero(mask))):
+            aborted = True
+            break
+
+    return {
+        "aborted": aborted,
+        "qubits_sent": sent,
+        "qubits_saved": vObject.nBits - sent,
+        "qber": test.rate(),
+        "alice_key": KeyBuffer.concatenate(aKeys),
+        "bob_key": KeyBuffer.concatenate(bKeys),
+    }
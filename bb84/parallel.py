@@ -0,0 +1,50 @@
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+from types import SimpleNamespace
+import numpy as np
+import bb84
+import bb84_eaves
+from key_reconciliation.key_buffer import KeyBuffer
+
+# Runs the BB84 protocols over shards of the qubits in separate processes, each with its own
+# copy of the simulator. Every shard gets a seed spawned from the master seed, for the
+# simulator (Aer) or the random generator (analytic), and the sifted keys of the shards are
+# joined in order. Shards are cut by shard_size and not by the number of workers, so the keys
+# only depend on the seed and are the same for any number of workers
+
+# Number of qubits per shard
+SHARD_SIZE = 1 << 14
+
+def bb84_protocol(vObject, use_noise=False, eavesdropping=False, backend="aer", workers=None,
+                  shard_size=SHARD_SIZE, batch_size=bb84.BATCH_SIZE, seed=None):
+    # Same keys as bb84.bb84_protocol (or bb84_eaves.bb84_protocol with eavesdropping)
+    if backend not in ("aer", "analytic"):
+        raise ValueError(f"Unknown backend: {backend}")
+    starts = range(0, vObject.nBits, shard_size)
+    seeds = np.random.SeedSequence(seed).spawn(len(starts))
+    shards = [shard(vObject, start, min(start + shard_size, vObject.nBits)) for start in starts]
+
+    # Workers are spawned, as forking a process that already runs simulator threads can deadlock
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        keys = list(executor.map(run_shard, shards, seeds, [use_noise] * len(shards), [eavesdropping] * len(shards),
+                                 [backend] * len(shards), [batch_size] * len(shards)))
+    return KeyBuffer.concatenate([aKey for aKey, _ in keys]), KeyBuffer.concatenate([bKey for _, bKey in keys])
+
+def shard(vObject, start, end):
+    # The part of the run configuration for qubits [start, end)
+    part = SimpleNamespace(nBits=end - start,
+                           aBits=np.asarray(vObject.aBits[start:end]),
+                           aBase=np.asarray(vObject.aBase[start:end]),
+                           bBase=np.asarray(vObject.bBase[start:end]))
+    if hasattr(vObject, "eBase"):
+        part.eBase = np.asarray(vObject.eBase[start:end])
+    if hasattr(vObject, "eIntercepts"):
+        part.eIntercepts = np.asarray(vObject.eIntercepts[start:end])
+    return part
+
+def run_shard(vObject, seed, use_noise, eavesdropping, backend, batch_size):
+    protocol = bb84_eaves if eavesdropping else bb84
+    rng = np.random.default_rng(seed)
+    if backend == "analytic":
+        return protocol.bb84_protocol_analytic(vObject, use_noise, rng)
+    return protocol.bb84_protocol_batched(vObject, use_noise, batch_size, rng)
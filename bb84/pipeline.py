@@ -0,0 +1,71 @@
+from types import SimpleNamespace
+import numpy as np
+import bb84
+import bb84_eaves
+import key_reconciliation
+from spot_checking import spot_checking
+from key_reconciliation.key_buffer import KeyBuffer
+from key_reconciliation import key_pool
+
+# Streaming version of bb84.main and bb84_eaves.main. Instead of sending every qubit before
+# sifting, spot checking and reconciling, the qubits are processed in blocks of block_size,
+# and each block goes through every stage before the next one is generated. Memory therefore
+# depends on block_size and not on nBits, and the first key block is ready after one block
+
+# Number of qubits sent per block
+BLOCK_SIZE = 1 << 16
+
+# Blocks with a higher spot-checked error rate are discarded (about the BB84 security limit)
+MAX_QBER = 0.11
+
+def key_blocks(nBits, block_size=BLOCK_SIZE, sampleDivisor=8, use_noise=False, eavesdropping=False,
+               backend="analytic", batch_size=None, max_qber=MAX_QBER, seed=None):
+    # Yields one dict per block: its index, the spot-checked error rate and its confidence
+    # interval, the number of sifted bits, whether the reconciled keys passed verification, and
+    # Alice's and Bob's final keys (empty when the block was discarded for its error rate or
+    # because its keys still differ after reconciliation)
+    rng = np.random.default_rng(seed)
+    protocol = bb84_eaves if eavesdropping else bb84
+
+    for index, start in enumerate(range(0, nBits, block_size)):
+        n = min(block_size, nBits - start)
+        block = SimpleNamespace(nBits=n,
+                                aBits=rng.integers(0, 2, n, dtype=np.uint8),
+                                aBase=rng.integers(0, 2, n, dtype=np.uint8),
+                                bBase=rng.integers(0, 2, n, dtype=np.uint8),
+                                eBase=rng.integers(0, 2, n, dtype=np.uint8))
+        # Generate and sift
+        if backend == "analytic":
+            aKey, bKey = protocol.bb84_protocol_analytic(block, use_noise, rng)
+        else:
+            aKey, bKey = protocol.bb84_protocol(block, use_noise, batch_size, backend)
+
+        # Sample
+        sifted = len(aKey)
+        error, _, _, aKey, bKey, interval = spot_checking(aKey, bKey, sifted // sampleDivisor, seed=rng)
+        result = {"block": index, "qber": error, "interval": interval, "sifted": sifted, "verified": False}
+        if error > max_qber:
+            result["alice_key"] = result["bob_key"] = KeyBuffer([])
+            yield result
+            continue
+
+        # Reconcile, verify and amplify
+        block_seed = int(rng.integers(1 << 31))
+        fixedKey, leaked_bits, _ = key_reconciliation.multi_pass_cascade(aKey, bKey, error, seed=block_seed)
+        result["alice_key"], result["bob_key"], result["verified"] = key_reconciliation.verified_amplification(
+            aKey, fixedKey, error, leaked_bits, block_seed)
+        yield result
+
+def secret_key_stream(nBits, **options):
+    # Only the final keys, as Alice sees them
+    for result in key_blocks(nBits, **options):
+        yield result["alice_key"]
+
+def fill_pools(alice_pool, bob_pool, nBits, **options):
+    # Appends the final keys of every block that passed verification to Alice's and Bob's key
+    # pools (key_pool.KeyPool) as soon as the block is done, and returns the number of bytes appended
+    appended = 0
+    for result in key_blocks(nBits, **options):
+        if result["verified"]:
+            appended += key_pool.append_keys(alice_pool, bob_pool, result["alice_key"], result["bob_key"])[0]
+    return appended
@@ -1,18 +1,33 @@
-import random
+import numpy as np
+from statistics import NormalDist
+from key_reconciliation.key_buffer import KeyBuffer, as_key
+
+def spot_checking(aKey, bKey, numberOfBits, seed=None, confidence=0.95):
+    # Sacrifices numberOfBits positions, drawn with a seeded generator, to estimate the error rate.
+    # Returns the error rate, the samples of both keys, the remaining keys and a confidence
+    # interval on the error rate. The input keys are not modified
+    aKey = as_key(aKey)
+    bKey = as_key(bKey)
+    rng = np.random.default_rng(seed)
+    numberOfBits = min(numberOfBits, len(aKey))
 
-def spot_checking(aKey, bKey, numberOfBits):
-    nErrors = 0
     # Sample set
-    aSample = []
-    bSample = []
-    # Gather a sample
-    checkIndex = random.sample(aKey, numberOfBits)
-    # Remove sample 
-    for index in sorted(checkIndex, reverse=True):
-        if aKey[index] != bKey[index]: 
-            nErrors += 1
-        aSample.append(aKey[index])
-        bSample.append(bKey[index])
-        del aKey[index]
-        del bKey[index]
-    return nErrors / len(checkIndex), aSample, bSample
+    mask = np.zeros(len(aKey), dtype=bool)
+    mask[rng.choice(len(aKey), numberOfBits, replace=False)] = True
+    aSample = KeyBuffer(aKey.bits[mask])
+    bSample = KeyBuffer(bKey.bits[mask])
+    nErrors = (aSample ^ bSample).popcount()
+
+    error = nErrors / numberOfBits if numberOfBits else 0.0
+    interval = qber_interval(nErrors, numberOfBits, confidence)
+    return error, aSample, bSample, KeyBuffer(aKey.bits[~mask]), KeyBuffer(bKey.bits[~mask]), interval
+
+def qber_interval(nErrors, numberOfBits, confidence=0.95):
+    # Wilson score interval on the error rate, which stays inside [0, 1] for small samples
+    if numberOfBits == 0:
+        return 0.0, 1.0
+    z = NormalDist().inv_cdf((1 + confidence) / 2)
+    rate = nErrors / numberOfBits
+    center = (rate + z ** 2 / (2 * numberOfBits)) / (1 + z ** 2 / numberOfBits)
+    spread = z * np.sqrt(rate * (1 - rate) / numberOfBits + z ** 2 / (4 * numberOfBits ** 2)) / (1 + z ** 2 / numberOfBits)
+    return max(center - spread, 0.0), min(center + spread, 1.0)
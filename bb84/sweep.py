@@ -0,0 +1,89 @@
+import argparse
+import json
+import sys
+from types import SimpleNamespace
+import numpy as np
+import bb84_eaves
+import analytic
+import spot_checking as spot_checking_module
+import key_reconciliation
+import qkd_common
+from spot_checking import spot_checking
+from key_reconciliation.key_buffer import KeyBuffer
+from qkd_common.sweep_engine import sweep, parse_grid, print_table, code_version, module_settings
+
+# Parameter sweeps over BB84. Every cell runs the protocol with its error rates, interception
+# rate, sampleDivisor and threshold, then spot checking, the multi-pass Cascade and privacy
+# amplification, and stores the measured error rate, the bits leaked and the secret key rate.
+# Usage: python sweep.py depolarizing_rate=0,0.01,0.05 eveInterceptionRate=0,0.5,1 [--cache sweep_cache] [--output results.json]
+
+# Parameters of a cell that are not swept
+DEFAULTS = {
+    "protocol": "bb84",
+    "nBits": 10000,
+    "depolarizing_rate": 0.0,
+    "readout_rate": 0.0,
+    "eveInterceptionRate": 0.0,
+    "sampleDivisor": 8,
+    "threshold": 0.11,
+    "backend": "analytic",
+    "batch_size": bb84_eaves.BATCH_SIZE,
+    "seed": 0,
+}
+
+COLUMNS = ["depolarizing_rate", "readout_rate", "eveInterceptionRate", "nBits", "qber", "leaked_bits", "secret_key_rate"]
+
+# Version of the code the cells run, part of the cache key
+CODE_VERSION = code_version(sys.modules[__name__], bb84_eaves, analytic, spot_checking_module, key_reconciliation, qkd_common)
+
+def run_cell(cell):
+    return cell_keys(cell)[0]
+
+def cell_keys(cell):
+    # The results of a cell, and Alice's and Bob's final keys (empty when the cell was aborted)
+    rng = np.random.default_rng(cell["seed"])
+    n = cell["nBits"]
+    vObject = SimpleNamespace(nBits=n, aBits=rng.integers(0, 2, n), aBase=rng.integers(0, 2, n), bBase=rng.integers(0, 2, n),
+                              eBase=rng.integers(0, 2, n))
+    vObject.eIntercepts = bb84_eaves.createIntercepts(n, cell["eveInterceptionRate"], rng)
+
+    # The noise model of the cell, set on the module for the protocol run only
+    use_noise = bool(cell["depolarizing_rate"] or cell["readout_rate"])
+    with module_settings(bb84_eaves, depolarizing_rate=cell["depolarizing_rate"], readout_rate=cell["readout_rate"]):
+        if cell["backend"] == "analytic":
+            aKey, bKey = bb84_eaves.bb84_protocol_analytic(vObject, use_noise, rng)
+        elif cell["backend"] == "aer":
+            aKey, bKey = bb84_eaves.bb84_protocol_batched(vObject, use_noise, cell["batch_size"], rng)
+        else:
+            raise ValueError(f"Unknown backend: {cell['backend']}")
+
+    error, _, _, aKey, bKey, interval = spot_checking(aKey, bKey, len(aKey) // cell["sampleDivisor"], cell["seed"])
+    result = {"sifted": len(aKey), "qber": error, "qber_interval": list(interval),
+              "risk": bb84_eaves.calc_risk(error, cell["threshold"]), "aborted": error > cell["threshold"],
+              "leaked_bits": 0, "round_trips": 0, "verification_failed": False, "secret_bits": 0, "secret_key_rate": 0.0}
+    if result["aborted"]:
+        return result, KeyBuffer([]), KeyBuffer([])
+
+    # Keys that still differ after Cascade are discarded, as in the pipeline
+    fixedKey, leaked_bits, round_trips = key_reconciliation.multi_pass_cascade(aKey, bKey, error, seed=cell["seed"])
+    aliceFinal, bobFinal, verified = key_reconciliation.verified_amplification(aKey, fixedKey, error, leaked_bits, cell["seed"])
+    result.update(leaked_bits=leaked_bits, round_trips=round_trips, residual_errors=(fixedKey ^ aKey).popcount(),
+                  verification_failed=not verified, secret_bits=len(bobFinal), secret_key_rate=len(bobFinal) / n)
+    return result, aliceFinal, bobFinal
+
+def main(grid, defaults=DEFAULTS, cache_dir="sweep_cache", workers=None, output=None):
+    results = sweep(run_cell, grid, defaults, cache_dir, workers, CODE_VERSION)
+    print_table(results, COLUMNS)
+    if output:
+        with open(output, "w") as file:
+            json.dump(results, file, indent=1)
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Sweeps BB84 over a grid of parameters")
+    parser.add_argument("grid", nargs="+", help=f"name=value,value,... with names from {', '.join(DEFAULTS)}")
+    parser.add_argument("--cache", default="sweep_cache", help="directory of the cached cells")
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--output", help="JSON file the results are saved to")
+    args = parser.parse_args()
+    main(parse_grid(args.grid), DEFAULTS, args.cache, args.workers, args.output)
@@ -0,0 +1,131 @@
+import argparse
+import numpy as np
+import key_reconciliation
+import analytic
+
+# Monte Carlo trials of whole BB84 sessions, to choose threshold and sampleDivisor from
+# distributions instead of from one error rate. Every session of a chunk is a row of a
+# (trials x qubits) array, measured with analytic.measure_qubits as in analytic.intercept_resend,
+# then sifted and spot checked with the same arithmetic on every row. Reconciliation (multi-pass
+# Cascade) and privacy amplification then run session by session on the keys that are kept.
+# Every trial draws its numbers from its own generator, spawned from the seed, so the results
+# do not depend on how the trials are cut into chunks: max_elements only bounds the memory
+# (about 100 bytes per qubit of a chunk).
+# Usage: python trials.py [--trials 1000] [--nBits 4096] [--sampleDivisors 4 8 16] [--threshold 0.11] [--depolarizing_rate 0.05] ...
+
+# Random numbers drawn per qubit: Alice's bit and basis, Bob's and Eve's bases, whether Eve
+# intercepts, then for Eve's and Bob's measurements whether the qubit depolarizes, its random
+# outcome and the readout flip, and the rank of the qubit in the spot-checking sample
+STREAMS = 12
+
+# Largest number of qubits in a chunk
+MAX_ELEMENTS = 1 << 22
+
+def trial_numbers(seeds, nBits):
+    # Uniform numbers of every trial in a chunk, as a (streams, trials, qubits) array, and the
+    # seed each trial uses for reconciliation
+    rngs = [np.random.default_rng(seed) for seed in seeds]
+    uniforms = np.stack([rng.random((STREAMS, nBits), dtype=np.float32) for rng in rngs], axis=1)
+    return uniforms, [int(rng.integers(1 << 31)) for rng in rngs]
+
+def sample_mask(sifted, ranks, sampleDivisor):
+    # The len // sampleDivisor sifted positions of every row with the lowest rank, as spot_checking
+    # draws them: uniformly without replacement
+    ranks = np.where(sifted, ranks, 2)
+    order = np.argsort(ranks, axis=1, kind="stable")
+    positions = np.empty_like(order)
+    np.put_along_axis(positions, order, np.arange(sifted.shape[1]), axis=1)
+    return positions < (sifted.sum(axis=1) // sampleDivisor)[:, None]
+
+def simulate_chunk(seeds, nBits, sampleDivisor, threshold, depolarizing_rate, readout_rate, eveInterceptionRate, reconcile):
+    u, reconcile_seeds = trial_numbers(seeds, nBits)
+    aBits = (u[0] < 0.5).astype(np.uint8)
+    aBase = (u[1] < 0.5).astype(np.uint8)
+    bBase = (u[2] < 0.5).astype(np.uint8)
+    eBase = (u[3] < 0.5).astype(np.uint8)
+    intercepted = u[4] < eveInterceptionRate
+
+    # Eve measures and resends in the standard basis, and the other qubits reach Bob untouched
+    rates = depolarizing_rate, readout_rate
+    eBits = analytic.measure_qubits(aBits, aBase, eBase, *rates, uniforms=u[5:8])
+    resent = analytic.measure_qubits(eBits, np.zeros_like(eBits), bBase, *rates, uniforms=u[8:11])
+    direct = analytic.measure_qubits(aBits, aBase, bBase, *rates, uniforms=u[8:11])
+    bBits = np.where(intercepted, resent, direct)
+
+    # Sift and spot check every row
+    sifted = aBase == bBase
+    errors = sifted & (aBits != bBits)
+    sample = sample_mask(sifted, u[11], sampleDivisor)
+    nSifted = sifted.sum(axis=1)
+    nSampled = sample.sum(axis=1)
+    estimated = (errors & sample).sum(axis=1) / np.maximum(nSampled, 1)
+    results = {"sifted": nSifted, "sampled": nSampled, "qber": errors.sum(axis=1) / np.maximum(nSifted, 1),
+               "estimated_qber": estimated, "risk": np.minimum(estimated / threshold, 1.0), "aborted": estimated > threshold,
+               "leaked_bits": np.zeros(len(seeds), dtype=np.int64), "final_key_bits": np.zeros(len(seeds), dtype=np.int64)}
+    if not reconcile:
+        return results
+
+    # The key is what is left after the sample
+    kept = sifted & ~sample
+    for trial in np.flatnonzero(~results["aborted"]):
+        aliceKey = aBits[trial][kept[trial]]
+        bobKey = bBits[trial][kept[trial]]
+        _, leaked_bits, _ = key_reconciliation.multi_pass_cascade(aliceKey, bobKey, estimated[trial], seed=reconcile_seeds[trial])
+        results["leaked_bits"][trial] = leaked_bits
+        results["final_key_bits"][trial] = key_reconciliation.privacy_amplification_length(len(aliceKey), estimated[trial], leaked_bits)
+    return results
+
+def run_trials(trials, nBits, sampleDivisor=8, threshold=0.11, depolarizing_rate=0.0, readout_rate=0.0, eveInterceptionRate=0.0,
+               reconcile=True, seed=0, max_elements=MAX_ELEMENTS):
+    # Runs trials sessions of nBits qubits, and returns one array per result with one entry per
+    # trial: sifted and sampled bits, the true and spot-checked error rates, the risk (calc_risk),
+    # whether the session was aborted, and the parity bits leaked and final key length (0 when
+    # aborted, or when reconcile is False)
+    seeds = np.random.SeedSequence(seed).spawn(trials)
+    chunk = max(1, max_elements // max(nBits, 1))
+    chunks = [simulate_chunk(seeds[start:start + chunk], nBits, sampleDivisor, threshold, depolarizing_rate, readout_rate,
+                             eveInterceptionRate, reconcile) for start in range(0, trials, chunk)]
+    return {name: np.concatenate([results[name] for results in chunks]) for name in chunks[0]}
+
+def detection_rates(attacked, clean):
+    # Share of the sessions aborted with Eve (detection probability) and without her (false alarms)
+    return float(np.mean(attacked["aborted"])), float(np.mean(clean["aborted"]))
+
+def threshold_curve(attacked, clean, thresholds):
+    # Detection probability and false-alarm rate for every threshold, from the spot-checked error rates
+    thresholds = np.asarray(thresholds, dtype=float)
+    detection = np.mean(attacked["estimated_qber"][:, None] > thresholds, axis=0)
+    false_alarms = np.mean(clean["estimated_qber"][:, None] > thresholds, axis=0)
+    return detection, false_alarms
+
+def histograms(results, bins=20):
+    # Counts and bin edges of the true and estimated error rates and of the final key lengths
+    return {name: np.histogram(results[name], bins=bins) for name in ["qber", "estimated_qber", "final_key_bits"]}
+
+def main(trials=1000, nBits=4096, sampleDivisors=(4, 8, 16), threshold=0.11, depolarizing_rate=None, readout_rate=None,
+         eveInterceptionRate=1.0, seed=0):
+    # Error rates default to the ones of noise.py, imported here as it loads Qiskit Aer
+    from qkd_common.noise import DEPOLARIZING_RATE, READOUT_RATE
+    depolarizing_rate = DEPOLARIZING_RATE if depolarizing_rate is None else depolarizing_rate
+    readout_rate = READOUT_RATE if readout_rate is None else readout_rate
+    print(f"{'sampleDivisor':>13} {'detection':>10} {'false alarm':>12} {'key p5':>7} {'key p50':>8} {'key p95':>8}")
+    for sampleDivisor in sampleDivisors:
+        options = dict(sampleDivisor=sampleDivisor, threshold=threshold, depolarizing_rate=depolarizing_rate, readout_rate=readout_rate, seed=seed)
+        attacked = run_trials(trials, nBits, eveInterceptionRate=eveInterceptionRate, reconcile=False, **options)
+        clean = run_trials(trials, nBits, **options)
+        detection, false_alarm = detection_rates(attacked, clean)
+        p5, p50, p95 = np.percentile(clean["final_key_bits"], [5, 50, 95])
+        print(f"{sampleDivisor:>13} {detection:>10.4f} {false_alarm:>12.4f} {p5:>7.0f} {p50:>8.0f} {p95:>8.0f}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Monte Carlo trials of BB84 sessions")
+    parser.add_argument("--trials", type=int, default=1000)
+    parser.add_argument("--nBits", type=int, default=4096)
+    parser.add_argument("--sampleDivisors", type=int, nargs="+", default=[4, 8, 16])
+    parser.add_argument("--threshold", type=float, default=0.11)
+    parser.add_argument("--depolarizing_rate", type=float)
+    parser.add_argument("--readout_rate", type=float)
+    parser.add_argument("--eveInterceptionRate", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    main(args.trials, args.nBits, args.sampleDivisors, args.threshold, args.depolarizing_rate, args.readout_rate, args.eveInterceptionRate, args.seed)
@@ -0,0 +1,94 @@
+import argparse
+import numpy as np
+import e91
+import e91_analytic
+import key_reconciliation
+from key_reconciliation.key_buffer import KeyBuffer
+from pipeline import chsh_qber
+from qkd_common.benchmark_harness import timed, record, save_results, compare_results, print_results
+
+# Times every stage of E91 on its own, for each key size and variant: the Aer simulation
+# (pair by pair with send_qubit and grouped by circuit), the analytic simulation, sifting with
+# the CHSH counts (which replace spot checking in E91), Cascade and privacy amplification.
+# Every record gives the pairs sent per second through the stage, and the last one of each
+# run ("total") the secret bits per second.
+# Usage: python benchmark.py [--sizes 100 1000 ...] [--output results.json] [--compare old.json]
+
+# Largest number of pairs simulated on Aer, pair by pair and grouped. Larger runs only time
+# the analytic simulation
+MAX_SINGLE_PAIRS = 1000
+MAX_GROUPED_PAIRS = 10000
+
+SIZES = [10 ** k for k in range(2, 8)]
+VARIANTS = {"clean": (False, False), "noise": (True, False), "eavesdropping": (False, True), "noise+eavesdropping": (True, True)}
+
+def send_single(aliceBases, bobBases, eve_present, eveBases, eveInterceptions, useNoise):
+    # Same loop as e91.measure_all_qubits without grouping
+    for i in range(len(aliceBases)):
+        e91.send_qubit(aliceBases[i], bobBases[i], eve_present, eveBases[i] if eve_present else "",
+                       eveInterceptions[i] if eve_present else 0, useNoise)
+
+def run(nBits, variant, max_single=MAX_SINGLE_PAIRS, max_grouped=MAX_GROUPED_PAIRS, seed=0):
+    # Returns the records of every stage for nBits pairs sent
+    useNoise, eve_present = VARIANTS[variant]
+    rng = np.random.default_rng(seed)
+    bases = np.array(e91_analytic.BASES)
+    aliceBases = bases[rng.integers(0, 3, nBits)]
+    bobBases = bases[rng.integers(1, 4, nBits)]
+    eveBases = bases[rng.integers(1, 3, nBits)] if eve_present else []
+    eveInterceptions = np.ones(nBits, dtype=int) if eve_present else []
+    results = []
+
+    def add(stage, seconds, **extra):
+        results.append(record("e91", stage, variant, nBits, seconds, **extra))
+
+    if nBits <= max_single:
+        add("send_qubit", timed(send_single, aliceBases.tolist(), bobBases.tolist(), eve_present,
+                                list(eveBases), list(eveInterceptions), useNoise)[1])
+    if nBits <= max_grouped:
+        add("measure_all_qubits_grouped", timed(e91.measure_all_qubits_grouped, aliceBases.tolist(), bobBases.tolist(), eve_present,
+                                                list(eveBases), list(eveInterceptions), useNoise, rng)[1])
+    (alicesMeasurement, bobsMeasurement, _), seconds = timed(e91_analytic.measure_all_qubits, aliceBases, bobBases, eve_present, eveBases,
+                                                             eveInterceptions, useNoise, e91.depolarizing_rate, e91.readout_rate, rng)
+    add("analytic", seconds)
+    total = seconds
+
+    (aliceKey, bobKey, _, chsh_counts), seconds = timed(e91_analytic.sift_and_count, aliceBases, bobBases, alicesMeasurement, bobsMeasurement)
+    chsh = float(e91_analytic.chsh_value(chsh_counts))
+    qber = chsh_qber(chsh)
+    add("sift_and_count", seconds, chsh=chsh)
+    total += seconds
+    aliceKey, bobKey = KeyBuffer(aliceKey), KeyBuffer(bobKey)
+
+    # cascade_error_correction with the block size that fits the estimated error rate, then
+    # the multi-pass Cascade, whose leakage is used for privacy amplification
+    block_size = key_reconciliation.qber_block_size(qber, len(aliceKey))
+    add("cascade_error_correction", timed(key_reconciliation.cascade_error_correction, aliceKey, bobKey, block_size)[1])
+    (fixed_key, leaked_bits, _), seconds = timed(key_reconciliation.multi_pass_cascade, aliceKey, bobKey, qber, seed=seed)
+    add("multi_pass_cascade", seconds, leaked_bits=leaked_bits)
+    total += seconds
+
+    final_key, seconds = timed(key_reconciliation.privacy_amplification, fixed_key, qber, leaked_bits, seed)
+    add("privacy_amplification", seconds)
+    total += seconds
+
+    add("total", total, secret_bits=len(final_key), secret_bits_per_second=len(final_key) / total)
+    return results
+
+def main(sizes=SIZES, variants=VARIANTS, output=None, compare=None):
+    results = [r for nBits in sizes for variant in variants for r in run(nBits, variant)]
+    print_results(results)
+    if output:
+        save_results(results, output)
+    if compare:
+        compare_results(compare, results)
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Times every stage of E91")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES, help="numbers of pairs sent")
+    parser.add_argument("--variants", nargs="+", default=list(VARIANTS), choices=list(VARIANTS))
+    parser.add_argument("--output", help="JSON file the results are saved to")
+    parser.add_argument("--compare", help="JSON file of an earlier run to compare with")
+    args = parser.parse_args()
+    main(args.sizes, args.variants, args.output, args.compare)
@@ -1,13 +1,18 @@
-from qiskit import QuantumCircuit, QuantumRegister, ClassicalRegister, transpile
-from qiskit_aer import AerSimulator
+from qiskit import QuantumCircuit, QuantumRegister, ClassicalRegister
 import numpy as np
 import random
-from qiskit_aer.noise import NoiseModel, ReadoutError
-from qiskit_aer.noise.errors import depolarizing_error
 
 import key_reconciliation;
+from qkd_common.circuit_cache import get_transpiled
+from qkd_common.noise import noise_protocol
+import e91_analytic
+from key_reconciliation.key_buffer import KeyBuffer
+from key_reconciliation import metrics
+from qkd_common import backend_selection
 
-simulator = AerSimulator()
+# Target the circuits are transpiled for. The T gates keep them off the stabilizer method, so
+# each job runs on the statevector or density matrix method picked by backend_selection
+simulator = backend_selection.simulator()
 
 # Number of qubits
 n = 64
@@ -22,17 +27,9 @@ bobBases = []
 eveBases = []
 eveIntercepts = []
 
-def noise_protocol():
-    noise_model = NoiseModel()
-    # Gate error
-    error = depolarizing_error(0.01, 1)
-    noise_model.add_all_qubit_quantum_error(error, ['x', 'h'])
-    
-    # Measurement error (5%)
-    read_error = ReadoutError([[0.95, 0.05], [0.05, 0.95]])
-    noise_model.add_all_qubit_readout_error(read_error)
-
-    return noise_model
+# Error rates of the noise model used when useNoise is set
+depolarizing_rate = 0.01
+readout_rate = 0.05
 
 # Bases for Alice and Bob
 def createBases( n, evePresent = False, eveInterceptionRate = 0):
@@ -49,7 +46,7 @@ def createBases( n, evePresent = False, eveInterceptionRate = 0):
             eveIntercepts.append(0 if random.random() > eveInterceptionRate else 1)
     return aliceBases, bobBases, eveBases, eveIntercepts
 
-def send_qubit(alice_base, bobs_base, eve_present = False, eve_base = "", eve_intercepts = 0, useNoise = False):
+def build_circuit(alice_base, bobs_base, eve_present = False, eve_base = "", eve_intercepts = 0):
     
     # Charlie generating entangled particles
     qbits = QuantumRegister(2, 'q')
@@ -101,14 +98,28 @@ def send_qubit(alice_base, bobs_base, eve_present = False, eve_base = "", eve_in
         bell.h(qbits[1])
         bell.measure(qbits[1], measure[1])
 
-    t_bell = transpile(bell, simulator)
+    return bell
+
+def transpiled_circuit(alice_base, bobs_base, eve_present = False, eve_base = "", eve_intercepts = 0):
+    # Eve's base only changes the circuit when she intercepts the qubit
+    eve_key = eve_base if eve_present and eve_intercepts == 1 else None
+    key = ("e91", alice_base, bobs_base, eve_key)
+    return get_transpiled(key, lambda: build_circuit(alice_base, bobs_base, eve_present, eve_base, eve_intercepts), simulator)
 
-    if useNoise:
-        return simulator.run(t_bell, shots=1, memory=True, noise_model = noise_protocol()).result().get_memory(t_bell)[0]
-    else:
-        return simulator.run(t_bell, shots=1, memory=True).result().get_memory(t_bell)[0]
+def send_qubit(alice_base, bobs_base, eve_present = False, eve_base = "", eve_intercepts = 0, useNoise = False):
+    t_bell = transpiled_circuit(alice_base, bobs_base, eve_present, eve_base, eve_intercepts)
+    return run_circuit(t_bell, 1, useNoise)[0]
+
+def run_circuit(t_bell, shots = 1, useNoise = False, rng = None):
+    # One memory string per shot. With rng, the run gets a simulator seed drawn from it
+    seed = {} if rng is None else {"seed_simulator": int(rng.integers(1 << 31))}
+    metrics.active.count("simulator_calls")
+    noise_model = noise_protocol(depolarizing_rate, readout_rate) if useNoise else None
+    return backend_selection.run(t_bell, noise_model, shots, **seed).get_memory(t_bell)
 
-def measure_all_qubits(aliceBases, bobBases, eve_present = False, eveBases = [], eveInterceptions = [], useNoise = False):
+def measure_all_qubits(aliceBases, bobBases, eve_present = False, eveBases = [], eveInterceptions = [], useNoise = False, grouped = False):
+    if grouped:
+        return measure_all_qubits_grouped(aliceBases, bobBases, eve_present, eveBases, eveInterceptions, useNoise)
 
     alicesMeasurement = []
     bobsMeasurement = []
@@ -124,57 +135,64 @@ def measure_all_qubits(aliceBases, bobBases, eve_present = False, eveBases = [],
             else:
                 eveMeasurement.append(np.nan)
         else:
-            output = send_qubit(aliceBases[i],bobBases[i])
+            output = send_qubit(aliceBases[i],bobBases[i], useNoise = useNoise)
             alicesMeasurement.append(1 if not int (output[2]) else 0)
             bobsMeasurement.append(int (output[1]))
             
 
     return alicesMeasurement, bobsMeasurement, eveMeasurement
 
-def sync_bases_and_build_keys(aliceBases, bobBases, eve_present = False, eveBases = [], eveInterceptions = [], useNoise = False):
-    alicesMeasurement, bobsMeasurement, eveMeasurement = measure_all_qubits(aliceBases, bobBases, eve_present, eveBases, eveInterceptions, useNoise)
-    
-    aliceKey = []
-    bobKey = []
-    eveKey = []
-    
+def measure_all_qubits_grouped(aliceBases, bobBases, eve_present = False, eveBases = [], eveInterceptions = [], useNoise = False, rng = None):
+    # Pairs with the same bases run the same circuit, so each distinct circuit is run once
+    # with one shot per pair and the shots are handed back to the pairs in order
+    groups = {}
+    for i in range(len(aliceBases)):
+        eve_intercepts = eveInterceptions[i] if eve_present else 0
+        eve_base = eveBases[i] if eve_present and eve_intercepts == 1 else None
+        groups.setdefault((aliceBases[i], bobBases[i], eve_base), []).append(i)
+
+    alicesMeasurement = [0] * len(aliceBases)
+    bobsMeasurement = [0] * len(aliceBases)
+    eveMeasurement = [np.nan] * len(aliceBases) if eve_present else []
+
+    for (alice_base, bobs_base, eve_base), indices in groups.items():
+        t_bell = transpiled_circuit(alice_base, bobs_base, eve_base is not None, eve_base, 1)
+        memory = run_circuit(t_bell, len(indices), useNoise, rng)
+        for i, output in zip(indices, memory):
+            alicesMeasurement[i] = 1 if not int (output[2]) else 0
+            bobsMeasurement[i] = int (output[1])
+            if eve_present and eveInterceptions[i]:
+                eveMeasurement[i] = int (output[0])
+
+    return alicesMeasurement, bobsMeasurement, eveMeasurement
 
-    chsh_counts = np.zeros((4,4))
+def sync_bases_and_build_keys(aliceBases, bobBases, eve_present = False, eveBases = [], eveInterceptions = [], useNoise = False, backend = "aer", grouped = False, print_keys = False):
+    with metrics.active.stage("quantum"):
+        if backend == "analytic":
+            alicesMeasurement, bobsMeasurement, eveMeasurement = e91_analytic.measure_all_qubits(aliceBases, bobBases, eve_present, eveBases, eveInterceptions, useNoise, depolarizing_rate, readout_rate)
+        elif backend == "aer":
+            alicesMeasurement, bobsMeasurement, eveMeasurement = measure_all_qubits(aliceBases, bobBases, eve_present, eveBases, eveInterceptions, useNoise, grouped)
+        else:
+            raise ValueError(f"Unknown backend: {backend}")
     
     # Compare bases 
-    for i in range(len(aliceBases)):
-        if(aliceBases[i] == bobBases[i]):
-            aliceKey.append(alicesMeasurement[i])
-            bobKey.append(bobsMeasurement[i])   
-            if(eve_present and eveBases[i] == bobBases[i]):
-                eveKey.append(eveMeasurement[i])
-            else:
-                eveKey.append(np.nan)
-        else:
-            if(aliceBases[i] == "X" and bobBases[i] == "Y"):
-                chsh_counts[0][2*alicesMeasurement[i]+bobsMeasurement[i]] += 1
-            elif(aliceBases[i] == "X" and bobBases[i] == "W"):
-                chsh_counts[1][2*alicesMeasurement[i]+bobsMeasurement[i]] += 1
-            elif(aliceBases[i] == "Z" and bobBases[i] == "Y"):
-                chsh_counts[2][2*alicesMeasurement[i]+bobsMeasurement[i]] += 1
-            elif(aliceBases[i] == "Z" and bobBases[i] == "W"):
-                chsh_counts[3][2*alicesMeasurement[i]+bobsMeasurement[i]] += 1
-
-    expectXY = (chsh_counts[0][0] - chsh_counts[0][1] - chsh_counts[0][2] + chsh_counts[0][3])/(sum(chsh_counts[0]) if sum(chsh_counts[0]) else 1)
-    expectXW = (chsh_counts[1][0] - chsh_counts[1][1] - chsh_counts[1][2] + chsh_counts[1][3])/(sum(chsh_counts[1]) if sum(chsh_counts[1]) else 1)
-    expectZY = (chsh_counts[2][0] - chsh_counts[2][1] - chsh_counts[2][2] + chsh_counts[2][3])/(sum(chsh_counts[2]) if sum(chsh_counts[2]) else 1)
-    expectZW = (chsh_counts[3][0] - chsh_counts[3][1] - chsh_counts[3][2] + chsh_counts[3][3])/(sum(chsh_counts[3]) if sum(chsh_counts[3]) else 1)
-
-    corr = expectXY - expectXW + expectZY + expectZW
-
-    misMatchedBits = 0
-    for i in range(len(aliceKey)):
-        if (aliceKey[i] != bobKey[i]):
-            misMatchedBits += 1
-
-    print(f"\nAlice's key: {aliceKey}")
-    print(f"Bob's key  : {bobKey}")
-    if evePresent: print(f"Eve's key  : {eveKey} \n\t(where NaN means eve's value was discarded as she knows it was incorrect)")
+    with metrics.active.stage("sifting"):
+        aliceKey, bobKey, eveKey, chsh_counts = e91_analytic.sift_and_count(aliceBases, bobBases, alicesMeasurement, bobsMeasurement, eve_present, eveBases, eveMeasurement)
+        corr = e91_analytic.chsh_value(chsh_counts)
+
+    misMatchedBits = int(np.sum(aliceKey != bobKey))
+    aliceKey = KeyBuffer(aliceKey)
+    bobKey = KeyBuffer(bobKey)
+    # Positions where Eve does not know the bit are marked as invalid
+    eveKey = KeyBuffer.from_values(eveKey)
+    metrics.active.record("sifting_ratio", len(aliceKey) / max(len(aliceBases), 1))
+    metrics.active.record("qber", misMatchedBits / max(len(aliceKey), 1))
+    metrics.active.record("chsh", float(corr))
+
+    if print_keys:
+        print(f"\nAlice's key: {aliceKey}")
+        print(f"Bob's key  : {bobKey}")
+        if evePresent: print(f"Eve's key  : {eveKey} \n\t(where NaN means eve's value was discarded as she knows it was incorrect)")
 
     print(f"\nNumber of bits sent: {len(aliceBases)}")
     print(f"Number of bits in sifted key: {len(aliceKey)}")
@@ -184,9 +202,10 @@ def sync_bases_and_build_keys(aliceBases, bobBases, eve_present = False, eveBase
 
     if evePresent or useNoise:
         fixed_key, newAliceKey, newBobKey = key_reconciliation.key_reconciliation(aliceKey, bobKey)
+        metrics.active.record("key_rate", len(newAliceKey) / max(len(aliceBases), 1))
 
-        print(f"\nBob's fixed key: {fixed_key}")
-        print(f"Final shared key: {newAliceKey}")
+        if print_keys:
+            print(f"\nBob's fixed key: {fixed_key}")
+            print(f"Final shared key: {newAliceKey}")
         
     return round(corr, 3), misMatchedBits, aliceKey, bobKey, eveKey
-
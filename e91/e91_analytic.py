@@ -0,0 +1,106 @@
+import numpy as np
+
+# Vectorized E91 engine. Instead of simulating one circuit per pair, the joint outcomes of
+# all pairs are sampled at once from the singlet correlation E(a, b) = -cos(a - b), where a
+# and b are the measurement directions of Alice and Bob in the XZ plane of the Bloch sphere.
+
+# Bases are coded as integers, indexing into BASES and the matching direction in ANGLES
+# (the directions measured by the gates in e91.build_circuit)
+BASES = ["X", "Y", "Z", "W"]
+ANGLES = np.array([np.pi / 2, np.pi / 4, 0, -np.pi / 4])
+
+# Row of chsh_counts used by each (Alice, Bob) base pair, -1 if the pair is not part of the CHSH test
+CHSH_ROWS = np.full((4, 4), -1)
+CHSH_ROWS[0, 1] = 0     # X, Y
+CHSH_ROWS[0, 3] = 1     # X, W
+CHSH_ROWS[2, 1] = 2     # Z, Y
+CHSH_ROWS[2, 3] = 3     # Z, W
+
+def encode_bases(bases):
+    bases = np.asarray(bases)
+    codes = np.full(len(bases), -1)
+    for code, base in enumerate(BASES):
+        codes[bases == base] = code
+    return codes
+
+def measure_all_qubits(aliceBases, bobBases, eve_present = False, eveBases = [], eveInterceptions = [], useNoise = False, depolarizing_rate = 0.01, readout_rate = 0.05, rng = None):
+    # Same outputs as e91.measure_all_qubits, as arrays: Alice's (flipped) bits, Bob's bits and
+    # Eve's bits (NaN where she did not intercept, empty if she is not present)
+    rng = np.random.default_rng() if rng is None else rng
+    alice = ANGLES[encode_bases(aliceBases)]
+    bob = ANGLES[encode_bases(bobBases)]
+    n = len(alice)
+
+    if eve_present:
+        eveCodes = encode_bases(eveBases)
+        intercepted = (np.asarray(eveInterceptions) == 1) & (eveCodes >= 0)
+        eve = ANGLES[eveCodes]
+    else:
+        intercepted = np.zeros(n, dtype=bool)
+        eve = np.zeros(n)
+
+    # Without Eve, Alice's outcome is uniform and Bob's is equal to it with probability (1 + E) / 2
+    aliceBits = rng.integers(0, 2, n)
+    same = rng.random(n) < np.sin((alice - bob) / 2) ** 2
+    bobBits = np.where(same, aliceBits, 1 - aliceBits)
+
+    # When Eve measures Bob's qubit first, her outcome is uniform and Alice's qubit collapses to the
+    # opposite state. Eve's basis change is not undone, so Bob receives her outcome in the standard basis
+    eveBits = rng.integers(0, 2, n)
+    aliceSame = rng.random(n) < np.sin((alice - eve) / 2) ** 2
+    bobSame = rng.random(n) < np.cos(bob / 2) ** 2
+    aliceBits = np.where(intercepted, np.where(aliceSame, eveBits, 1 - eveBits), aliceBits)
+    bobBits = np.where(intercepted, np.where(bobSame, eveBits, 1 - eveBits), bobBits)
+
+    if useNoise:
+        # A depolarized qubit gives a uniformly random outcome, and every readout can be flipped
+        aliceBits = np.where(rng.random(n) < depolarizing_rate, rng.integers(0, 2, n), aliceBits)
+        bobBits = np.where(rng.random(n) < depolarizing_rate, rng.integers(0, 2, n), bobBits)
+        aliceBits ^= rng.random(n) < readout_rate
+        bobBits ^= rng.random(n) < readout_rate
+        eveBits ^= rng.random(n) < readout_rate
+
+    # Alice flips her bit, so that her key matches Bob's when they share a base
+    alicesMeasurement = 1 - aliceBits
+    eveMeasurement = np.where(intercepted, eveBits, np.nan) if eve_present else np.array([])
+    return alicesMeasurement, bobBits, eveMeasurement
+
+def sift_and_count(aliceBases, bobBases, alicesMeasurement, bobsMeasurement, eve_present = False, eveBases = [], eveMeasurement = []):
+    aliceCodes = encode_bases(aliceBases)
+    bobCodes = encode_bases(bobBases)
+    alicesMeasurement = np.asarray(alicesMeasurement, dtype=int)
+    bobsMeasurement = np.asarray(bobsMeasurement, dtype=int)
+
+    # Keys are built from the pairs where Alice and Bob share a base
+    sifted = aliceCodes == bobCodes
+    aliceKey = alicesMeasurement[sifted]
+    bobKey = bobsMeasurement[sifted]
+    if eve_present:
+        eveKnows = sifted & (encode_bases(eveBases) == bobCodes)
+        eveKey = np.where(eveKnows, np.asarray(eveMeasurement, dtype=float), np.nan)[sifted]
+    else:
+        eveKey = np.full(len(aliceKey), np.nan)
+
+    # The other pairs are counted per CHSH row and outcome (2 * Alice's bit + Bob's bit)
+    rows = CHSH_ROWS[aliceCodes, bobCodes]
+    used = ~sifted & (rows >= 0)
+    cells = 4 * rows[used] + 2 * alicesMeasurement[used] + bobsMeasurement[used]
+    chsh_counts = np.bincount(cells, minlength=16).reshape(4, 4).astype(float)
+    return aliceKey, bobKey, eveKey, chsh_counts
+
+def expected_chsh(depolarizing_rate=0.0, readout_rate=0.0):
+    # CHSH value of an honest link with the noise of measure_all_qubits: every correlation is
+    # scaled by 1 - depolarizing_rate and 1 - 2 * readout_rate for each of Alice and Bob
+    return 2 * np.sqrt(2) * ((1 - depolarizing_rate) * (1 - 2 * readout_rate)) ** 2
+
+def chsh_value(chsh_counts):
+    # <AB> = (N00 - N01 - N10 + N11) / N for each of XY, XW, ZY and ZW. Leading axes of
+    # chsh_counts, such as the trials of trials.py, give one value each
+    expect = chsh_counts @ np.array([1, -1, -1, 1]) / np.maximum(chsh_counts.sum(axis=-1), 1)
+    return expect[..., 0] - expect[..., 1] + expect[..., 2] + expect[..., 3]
+
+def chsh_qber(chsh):
+    # For a depolarized singlet, S = 2 * sqrt(2) * (1 - 2 * qber). A float for a float, and an
+    # array for an array of CHSH values
+    qber = np.clip((1 - np.asarray(chsh) / (2 * np.sqrt(2))) / 2, 0, 0.5)
+    return float(qber) if qber.ndim == 0 else qber
@@ -1,7 +1,25 @@
 import numpy as np
 import unittest
 import e91
+import e91_analytic
+from qkd_common import circuit_cache
 import key_reconciliation
+import pipeline
+import parallel
+import monitor
+import benchmark
+from key_reconciliation import metrics
+import sweep
+from qkd_common import sweep_engine
+from qkd_common import backend_selection
+from qkd_common import noise
+from key_reconciliation import key_pool
+from key_reconciliation.key_buffer import KeyBuffer
+import trials
+import json
+import os
+import tempfile
+from unittest import mock
 import math
 
 class config():
@@ -24,6 +42,16 @@ class test(unittest.TestCase, config):
         fKey, newBKey, newAKey = key_reconciliation.key_reconciliation(aKey, bKey)
         self.assertEqual(aKey, fKey)
         self.assertEqual(newAKey, newBKey)
+        # Reconciliation without a measured error rate still keeps a key
+        rng = np.random.default_rng(2)
+        aBase, bBase, _, _ = e91.createBases(20000)
+        aBits, bBits, _ = e91_analytic.measure_all_qubits(aBase, bBase, useNoise=True, depolarizing_rate=0.01, readout_rate=0.01, rng=rng)
+        aKey, bKey, _, _ = e91_analytic.sift_and_count(aBase, bBase, aBits, bBits)
+        fKey, newBKey, newAKey = key_reconciliation.key_reconciliation(aKey, bKey, seed=1)
+        print(f"Sifted bits: {len(aKey)}, errors: {np.count_nonzero(aKey != bKey)}, final key bits: {len(newAKey)}")
+        self.assertEqual(fKey, aKey.tolist())
+        self.assertEqual(newAKey, newBKey)
+        self.assertGreater(len(newAKey), len(aKey) / 4)
 
     #Case 3 (e91 with no noise, but with eavesdropping on 50% of the bits)
     def test03(self):
@@ -61,5 +89,232 @@ class test(unittest.TestCase, config):
         self.assertEqual(aKey, fKey)
         self.assertEqual(newAKey, newBKey)
 
+    #Case 6 (transpiled circuits are reused)
+    def test06(self):
+        print("\n\n-------------------------------------------------------------------")
+        print("\n" + "Case 6 (e91: Circuit cache)")
+        circuit_cache.clear_cache()
+        e91.measure_all_qubits(config.aBase[:64], config.bBase[:64], True, config.eBase[:64], config.eIntercepts[:64])
+        info = circuit_cache.cache_info()
+        self.assertLessEqual(info["misses"], 27)
+        self.assertEqual(info["hits"] + info["misses"], 64)
+
+    #Case 7 (e91 analytic backend without noise and eavesdropping)
+    def test07(self):
+        print("\n\n-------------------------------------------------------------------")
+        print("\n" + "Case 7 (e91: Analytic Wo[Noise, Eavesdropping]")
+        chsh, missmatchedBits, aKey, bKey, _ = e91.sync_bases_and_build_keys(config.aBase, config.bBase, backend="analytic")
+        self.assertEqual(aKey, bKey)
+        self.assertGreater(chsh, 2.3)
+
+    #Case 8 (e91 analytic backend with eavesdropping on 100% of the bits)
+    def test08(self):
+        print("\n\n-------------------------------------------------------------------")
+        print("\n" + "Case 8 (e91: Analytic W[Eavesdropping 100% of the time] Wo[Noise]")
+        chsh, missmatchedBits, aKey, bKey, eKey = e91.sync_bases_and_build_keys(config.aBase, config.bBase, eve_present=True, eveBases=config.eBase, eveInterceptions=np.ones(config.nBits), backend="analytic")
+        self.assertLess(chsh, 2)
+
+        for i in range(len(aKey)):
+            if(not math.isnan(eKey[i])):
+                self.assertEqual(aKey[i], eKey[i])
+
+    #Case 9 (e91 grouped Aer simulation with eavesdropping on 50% of the bits)
+    def test09(self):
+        print("\n\n-------------------------------------------------------------------")
+        print("\n" + "Case 9 (e91: Grouped W[Eavesdropping 50% of the time] Wo[Noise]")
+        circuit_cache.clear_cache()
+        chsh, missmatchedBits, aKey, bKey, eKey = e91.sync_bases_and_build_keys(config.aBase, config.bBase, eve_present=True, eveBases=config.eBase, eveInterceptions=config.eIntercepts, grouped=True)
+        info = circuit_cache.cache_info()
+        self.assertLessEqual(info["hits"] + info["misses"], 27)
+        self.assertEqual(len(aKey), sum(1 for i in range(config.nBits) if config.aBase[i] == config.bBase[i]))
+
+        for i in range(len(aKey)):
+            if(not math.isnan(eKey[i])):
+                self.assertEqual(aKey[i], eKey[i])
+
+    #Case 10 (streaming pipeline)
+    def test10(self):
+        print("\n\n-------------------------------------------------------------------")
+        print("\n" + "Case 10 (e91: Streaming pipeline)")
+        blocks = pipeline.key_blocks(10 ** 9, block_size=20000, seed=5)
+        for _ in range(3):
+            block = next(blocks)
+            self.assertGreater(len(block["alice_key"]), 0)
+            self.assertEqual(block["alice_key"], block["bob_key"])
+        for block in pipeline.key_blocks(40000, block_size=20000, eve_present=True, eveInterceptionRate=1, seed=5):
+            self.assertLess(block["chsh"], pipeline.MIN_CHSH)
+            self.assertEqual(len(block["alice_key"]), 0)
+        # A block whose keys still differ after reconciliation fails verification and is dropped
+        uncorrected = lambda aliceKey, bobKey, qber, seed=None: (KeyBuffer(np.array(bobKey)), 0, 0)
+        with mock.patch.object(key_reconciliation, "multi_pass_cascade", uncorrected):
+            block = next(pipeline.key_blocks(20000, block_size=20000, useNoise=True, seed=5))
+        self.assertFalse(block["verified"])
+        self.assertEqual((len(block["alice_key"]), len(block["bob_key"])), (0, 0))
+        self.assertTrue(next(pipeline.key_blocks(20000, block_size=20000, useNoise=True, seed=5))["verified"])
+
+    #Case 11 (sharded runs are reproducible for any number of workers)
+    def test11(self):
+        print("\n\n-------------------------------------------------------------------")
+        print("\n" + "Case 11 (e91: Sharded W[Eavesdropping 50% of the time, Noise]")
+        result = parallel.sync_bases_and_build_keys(config.aBase, config.bBase, True, config.eBase, config.eIntercepts, useNoise=True, workers=1, shard_size=256, seed=11)
+        self.assertEqual(parallel.sync_bases_and_build_keys(config.aBase, config.bBase, True, config.eBase, config.eIntercepts, useNoise=True, workers=2, shard_size=256, seed=11), result)
+        self.assertEqual(len(result[2]), sum(1 for i in range(config.nBits) if config.aBase[i] == config.bBase[i]))
+
+    #Case 12 (sequential test stops an eavesdropped session early)
+    def test12(self):
+        print("\n\n-------------------------------------------------------------------")
+        print("\n" + "Case 12 (e91: Early abort W[Eavesdropping 100% of the time]")
+        result = monitor.monitored_protocol(config.aBase, config.bBase, True, config.eBase, np.ones(config.nBits), chunk_size=128, seed=2)
+        print(f"Pairs sent: {result['pairs_sent']}, saved: {result['pairs_saved']}, CHSH: {result['chsh']}")
+        self.assertTrue(result["aborted"])
+        self.assertGreater(result["pairs_saved"], config.nBits / 2)
+        result = monitor.monitored_protocol(config.aBase, config.bBase, chunk_size=128, seed=2)
+        self.assertFalse(result["aborted"])
+        self.assertEqual(result["pairs_sent"], config.nBits)
+        # alpha bounds the false alarms of whole sessions, however long they are
+        rng = np.random.default_rng(3)
+        aborted = 0
+        for session in range(50):
+            aBase = np.array(["X", "Y", "Z"])[rng.integers(0, 3, 40000)]
+            bBase = np.array(["Y", "Z", "W"])[rng.integers(0, 3, 40000)]
+            aborted += monitor.monitored_protocol(aBase, bBase, useNoise=True, alpha=0.01, seed=session)["aborted"]
+        print(f"Honest sessions aborted: {aborted} of 50, p0: {monitor.honest_loss(True)}")
+        self.assertLessEqual(aborted, 2)
+        eBase = np.array(["Y", "Z"])[rng.integers(0, 2, 40000)]
+        result = monitor.monitored_protocol(aBase, bBase, True, eBase, np.ones(40000), useNoise=True, seed=0)
+        self.assertTrue(result["aborted"])
+
+    #Case 13 (benchmark records every stage and saves them as JSON)
+    def test13(self):
+        print("\n\n-------------------------------------------------------------------")
+        print("\n" + "Case 13 (e91: Benchmark W[Eavesdropping 100% of the time, Noise]")
+        results = benchmark.run(200, "noise+eavesdropping", max_single=0, max_grouped=200)
+        self.assertEqual([r["stage"] for r in results], ["measure_all_qubits_grouped", "analytic", "sift_and_count", "cascade_error_correction",
+                                                         "multi_pass_cascade", "privacy_amplification", "total"])
+        self.assertTrue(all(r["qubits"] == 200 and r["qubits_per_second"] > 0 for r in results))
+        self.assertLess(results[2]["chsh"], 2)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "results.json")
+            benchmark.save_results(results, path)
+            with open(path) as file:
+                self.assertEqual(json.load(file)["results"], results)
+
+    #Case 14 (metrics of a run are recorded)
+    def test14(self):
+        print("\n\n-------------------------------------------------------------------")
+        print("\n" + "Case 14 (e91: Metrics W[Noise]")
+        with metrics.recording(metrics.Recorder()) as recorder:
+            chsh = e91.sync_bases_and_build_keys(config.aBase, config.bBase, useNoise=True, grouped=True)[0]
+        summary = recorder.summary()
+        print(summary)
+        self.assertEqual(set(summary["stages"]), {"quantum", "sifting", "error_correction", "privacy_amplification"})
+        self.assertLessEqual(summary["counts"]["simulator_calls"], 9)
+        # About 57 pairs per CHSH correlation give a spread of 0.2 around 2.25, so the value is
+        # checked against the run and not against the classical bound
+        self.assertAlmostEqual(summary["values"]["chsh"], chsh, places=3)
+        for name in ["sifting_ratio", "qber", "leaked_bits", "final_key_bits", "key_rate"]:
+            self.assertIn(name, summary["values"])
+        self.assertEqual(type(metrics.active), metrics.Metrics)
+
+    #Case 15 (sweeps only compute the cells that are not cached)
+    def test15(self):
+        print("\n\n-------------------------------------------------------------------")
+        print("\n" + "Case 15 (e91: Sweep W[Eavesdropping, Noise]")
+        with tempfile.TemporaryDirectory() as directory:
+            results = sweep.main({"eveInterceptionRate": [0, 1]}, sweep.DEFAULTS, directory, workers=1)
+            self.assertGreater(results[0]["chsh"], 2.7)
+            self.assertTrue(results[1]["aborted"])
+            sweep_engine.save_cell(directory, {**sweep.DEFAULTS, "depolarizing_rate": 0.05}, {"cached": True}, sweep.CODE_VERSION)
+            extended = sweep.sweep(sweep.run_cell, {"depolarizing_rate": [0, 0.05, 0.1]}, sweep.DEFAULTS, directory, 1, sweep.CODE_VERSION)
+            self.assertEqual(extended[0], results[0])
+            self.assertTrue(extended[1]["cached"])
+            self.assertLess(extended[2]["secret_key_rate"], results[0]["secret_key_rate"])
+            self.assertEqual(len(os.listdir(directory)), 4)
+            # Results of another version of the code are not taken
+            self.assertNotIn("cached", sweep.sweep(sweep.run_cell, {"depolarizing_rate": [0.05]}, sweep.DEFAULTS, directory, 1, "former")[0])
+        # A cell only sets the error rates of the protocol for its own run
+        rates = (e91.depolarizing_rate, e91.readout_rate)
+        sweep.cell_keys({**sweep.DEFAULTS, "nBits": 200, "depolarizing_rate": 0.2, "readout_rate": 0.1, "backend": "aer"})
+        self.assertEqual((e91.depolarizing_rate, e91.readout_rate), rates)
+        # A cell whose keys still differ after reconciliation keeps no key
+        self.assertFalse(results[0]["verification_failed"])
+        uncorrected = lambda aliceKey, bobKey, qber, seed=None: (KeyBuffer(np.array(bobKey)), 0, 0)
+        with mock.patch.object(key_reconciliation, "multi_pass_cascade", uncorrected):
+            result, aliceKey, bobKey = sweep.cell_keys({**sweep.DEFAULTS, "depolarizing_rate": 0.05})
+        self.assertTrue(result["verification_failed"])
+        self.assertEqual((result["secret_bits"], len(aliceKey), len(bobKey)), (0, 0, 0))
+
+    #Case 16 (E91 circuits need statevector, or density matrix with noise and many shots)
+    def test16(self):
+        print("\n\n-------------------------------------------------------------------")
+        print("\n" + "Case 16 (e91: Aer method selection W[Eavesdropping, Noise]")
+        circuit = e91.transpiled_circuit("X", "Y", True, "Z", 1)
+        self.assertEqual(backend_selection.select_method(circuit), "statevector")
+        self.assertEqual(backend_selection.select_method(circuit, noise.noise_protocol(), 1), "statevector")
+        self.assertEqual(backend_selection.select_method(circuit, noise.noise_protocol(), 1000), "density_matrix")
+        with metrics.recording(metrics.Recorder()) as recorder:
+            chsh, _, aKey, bKey, _ = parallel.sync_bases_and_build_keys(config.aBase, config.bBase, useNoise=True, workers=1, shard_size=config.nBits, seed=1)
+            e91.measure_all_qubits_grouped(config.aBase, config.bBase, useNoise=True)
+        self.assertEqual(recorder.values["aer_method"], "density_matrix")
+        print(f"CHSH: {chsh}")
+        self.assertGreater(chsh, 2)
+
+    #Case 17 (Cascade over the classical channel)
+    def test17(self):
+        print("\n\n-------------------------------------------------------------------")
+        print("\n" + "Case 17 (e91: reconciliation over the classical channel W[Noise]")
+        aliceBases, bobBases, _, _ = e91.createBases(30000, False, 0)
+        chsh, _, aKey, bKey, _ = parallel.sync_bases_and_build_keys(aliceBases, bobBases, useNoise=True, backend="analytic", workers=1, seed=1)
+        qber = pipeline.chsh_qber(chsh)
+        with metrics.recording(metrics.Recorder()) as recorder:
+            fixedKey, finalKey, _ = key_reconciliation.key_reconciliation(aKey, bKey, qber=qber, seed=1, transport="unix")
+        values = recorder.values
+        print(f"QBER: {qber}, {values}")
+        self.assertEqual(fixedKey, aKey)
+        self.assertEqual(values["final_key_bits"], len(finalKey))
+        self.assertLess(values["round_trips"], 200)
+        self.assertEqual(values["channel_messages"], 2 * values["round_trips"] + 2)
+        self.assertGreater(values["channel_bytes"], values["leaked_bits"] / 8)
+        with self.assertRaises(ValueError):
+            key_reconciliation.key_reconciliation(aKey, bKey, transport="memory")
+
+    #Case 18 (E91 keys stored in Alice's and Bob's key pools)
+    def test18(self):
+        print("\n\n-------------------------------------------------------------------")
+        print("\n" + "Case 18 (e91: persistent key pools")
+        with tempfile.TemporaryDirectory() as directory:
+            alicePool, bobPool = key_pool.open_pools(directory)
+            appended = pipeline.fill_pools(alicePool, bobPool, 2 ** 16, block_size=2 ** 14, seed=0)
+            print(f"Bytes appended: {appended}")
+            self.assertGreater(appended, 100)
+            offset, aliceBytes = alicePool.take(32)
+            self.assertEqual(bytes(bobPool.consume(offset, 32)), bytes(aliceBytes))
+            self.assertEqual(alicePool.available(), appended - 32)
+            alicePool.close()
+            bobPool.close()
+
+    #Case 19 (Monte Carlo trials of whole sessions)
+    def test19(self):
+        print("\n\n-------------------------------------------------------------------")
+        print("\n" + "Case 19 (e91: Monte Carlo trials W[Noise, Eavesdropping]")
+        clean = trials.run_trials(200, 4000, seed=1)
+        attacked = trials.run_trials(200, 4000, eveInterceptionRate=1, reconcile=False, seed=1)
+        detection, false_alarm = trials.detection_rates(attacked, clean)
+        print(f"CHSH: {clean['chsh'].mean()} and {attacked['chsh'].mean()}, detection: {detection}, false alarms: {false_alarm}")
+        self.assertAlmostEqual(clean["chsh"].mean(), 2 * math.sqrt(2), delta=0.02)
+        self.assertEqual((detection, false_alarm), (1.0, 0.0))
+        self.assertTrue(np.all(clean["final_key_bits"] > 0))
+        self.assertTrue(np.all(clean["qber"] == 0))
+        noisy = trials.run_trials(200, 4000, depolarizing_rate=0.01, readout_rate=0.05, seed=1, max_elements=4000 * 64)
+        self.assertAlmostEqual(noisy["estimated_qber"].mean(), noisy["qber"].mean(), delta=0.01)
+        counts, edges = trials.histograms(noisy)["chsh"]
+        self.assertEqual(counts.sum(), 200)
+        self.assertTrue(np.array_equal(noisy["chsh"], trials.run_trials(200, 4000, depolarizing_rate=0.01, readout_rate=0.05, seed=1)["chsh"]))
+        # e91_analytic gives one CHSH value and error rate per row of stacked counts
+        counts = np.random.default_rng(1).integers(1, 100, (3, 4, 4)).astype(float)
+        self.assertTrue(np.allclose(e91_analytic.chsh_value(counts), [e91_analytic.chsh_value(row) for row in counts]))
+        self.assertEqual(list(e91_analytic.chsh_qber(np.array([2 * math.sqrt(2), 0.0]))), [0.0, 0.5])
+        self.assertIsInstance(e91_analytic.chsh_qber(2.5), float)
+
 if __name__ == '__main__':
     unittest.main()
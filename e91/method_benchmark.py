@@ -0,0 +1,39 @@
+import sys
+import time
+import e91
+from qkd_common import backend_selection
+from qkd_common.noise import noise_protocol
+
+# Compares the Aer methods on the grouped E91 circuits (one circuit per combination of bases,
+# with one shot per pair), with the one backend_selection picks marked. "automatic" is the
+# method of the default AerSimulator() used before backend_selection. Prints the pairs
+# simulated per second. Usage: python method_benchmark.py [pairs]
+
+def timed_groups(method, groups, noise_model):
+    # Runs every group as in e91.measure_all_qubits_grouped, on the given method (None: the selected one)
+    options = {} if noise_model is None else {"noise_model": noise_model}
+    start = time.perf_counter()
+    for circuit, shots in groups:
+        simulator = backend_selection.simulator(method or backend_selection.select_method(circuit, noise_model, shots))
+        simulator.run(circuit, shots=shots, memory=True, seed_simulator=0, **options).result()
+    return time.perf_counter() - start
+
+def main(nBits=10000):
+    print(f"{'eve':<6} {'noise':<6} {'method':<36} {'pairs/s':>10}")
+    for eve_present in [False, True]:
+        aliceBases, bobBases, eveBases, eveInterceptions = e91.createBases(nBits, eve_present, 1)
+        counts = {}
+        for i in range(nBits):
+            eve_base = eveBases[i] if eve_present else None
+            counts[(aliceBases[i], bobBases[i], eve_base)] = counts.get((aliceBases[i], bobBases[i], eve_base), 0) + 1
+        groups = [(e91.transpiled_circuit(a, b, e is not None, e, 1), shots) for (a, b, e), shots in counts.items()]
+
+        for useNoise in [False, True]:
+            noise_model = noise_protocol(e91.depolarizing_rate, e91.readout_rate) if useNoise else None
+            chosen = {backend_selection.select_method(circuit, noise_model, shots) for circuit, shots in groups}
+            for method in ["automatic", "statevector", "density_matrix", None]:
+                label = method or "selected: " + "/".join(sorted(chosen))
+                print(f"{str(eve_present):<6} {str(useNoise):<6} {label:<36} {nBits / timed_groups(method, groups, noise_model):>10.0f}")
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
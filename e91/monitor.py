@@ -0,0 +1,74 @@
+import numpy as np
+import e91
+import e91_analytic
+from key_reconciliation.key_buffer import KeyBuffer
+from qkd_common.sequential_test import SequentialTest
+
+# Early abort for E91. The pairs are measured in chunks and the CHSH outcomes of every chunk
+# update a running CHSH value as they arrive. Each CHSH pair is a round of the CHSH game, won
+# with probability 1/2 + S/8: about 0.85 for an undisturbed singlet and at most 0.75 without
+# entanglement. A sequential probability ratio test on the lost rounds stops the session as soon
+# as the link is more likely to have lost its entanglement than not
+
+def chsh_loss(chsh):
+    # Share of CHSH rounds lost for a CHSH value
+    return 0.5 - chsh / 8
+
+# Share of CHSH rounds lost by an ideal link (S = 2 * sqrt(2)), and at the classical bound (S = 2)
+HONEST_LOSS = chsh_loss(2 * np.sqrt(2))
+CLASSICAL_LOSS = chsh_loss(2)
+
+def honest_loss(useNoise):
+    # p0 of the sequential test: the share of rounds the noise of e91.py makes an honest link lose
+    if not useNoise:
+        return HONEST_LOSS
+    return chsh_loss(e91_analytic.expected_chsh(e91.depolarizing_rate, e91.readout_rate))
+
+# Sign of each CHSH row in S = <XY> - <XW> + <ZY> + <ZW>: a round is won when the product of the
+# outcomes has this sign. Cells of a row are ordered 00, 01, 10, 11 (Alice's bit, Bob's bit)
+LOST_CELLS = np.array([[0, 1, 1, 0], [1, 0, 0, 1], [0, 1, 1, 0], [0, 1, 1, 0]], dtype=bool)
+
+def monitored_protocol(aliceBases, bobBases, eve_present=False, eveBases=[], eveInterceptions=[], useNoise=False,
+                       backend="analytic", chunk_size=1024, p0=None, p1=CLASSICAL_LOSS, alpha=0.01, beta=0.01, seed=None):
+    # Runs the E91 measurements chunk by chunk. Returns whether the session was aborted, the
+    # number of pairs sent and saved, the running CHSH value, and the key bits gathered until
+    # then. alpha is the false alarm rate of the whole session
+    p0 = honest_loss(useNoise) if p0 is None else p0
+    rng = np.random.default_rng(seed)
+    test = SequentialTest(p0, p1, alpha, beta)
+    chsh_counts = np.zeros((4, 4))
+    aliceKeys = []
+    bobKeys = []
+    sent = 0
+    aborted = False
+
+    for start in range(0, len(aliceBases), chunk_size):
+        chunk = slice(start, start + chunk_size)
+        aBases, bBases = list(aliceBases[chunk]), list(bobBases[chunk])
+        eBases = list(eveBases[chunk]) if eve_present else []
+        eIntercepts = list(eveInterceptions[chunk]) if eve_present else []
+        if backend == "analytic":
+            alicesMeasurement, bobsMeasurement, _ = e91_analytic.measure_all_qubits(
+                aBases, bBases, eve_present, eBases, eIntercepts, useNoise, e91.depolarizing_rate, e91.readout_rate, rng)
+        elif backend == "aer":
+            alicesMeasurement, bobsMeasurement, _ = e91.measure_all_qubits_grouped(aBases, bBases, eve_present, eBases, eIntercepts, useNoise, rng)
+        else:
+            raise ValueError(f"Unknown backend: {backend}")
+        sent += len(aBases)
+
+        aliceKey, bobKey, _, counts = e91_analytic.sift_and_count(aBases, bBases, alicesMeasurement, bobsMeasurement)
+        aliceKeys.append(KeyBuffer(aliceKey))
+        bobKeys.append(KeyBuffer(bobKey))
+        chsh_counts += counts
+        if test.update(int(counts[LOST_CELLS].sum()), int(counts.sum())):
+            aborted = True
+            break
+
+    return {
+        "aborted": aborted,
+        "pairs_sent": sent,
+        "pairs_saved": len(aliceBases) - sent,
+        "chsh": float(e91_analytic.chsh_value(chsh_counts)),
+        "alice_key": KeyBuffer.concatenate(aliceKeys),
+        "bob_key": KeyBuffer.concatenate(bobKeys),
+    }
@@ -0,0 +1,51 @@
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import numpy as np
+import e91
+import e91_analytic
+from key_reconciliation.key_buffer import KeyBuffer
+
+# Runs the E91 measurements over shards of the pairs in separate processes, each with its own
+# copy of the simulator. Every shard gets a seed spawned from the master seed, for the
+# simulator (Aer) or the random generator (analytic). Each shard sifts its pairs and counts its
+# CHSH outcomes, then the keys are joined in order and the counts added. Shards are cut by
+# shard_size and not by the number of workers, so the results only depend on the seed
+
+# Number of pairs per shard
+SHARD_SIZE = 1 << 12
+
+def sync_bases_and_build_keys(aliceBases, bobBases, eve_present=False, eveBases=[], eveInterceptions=[], useNoise=False,
+                              backend="aer", workers=None, shard_size=SHARD_SIZE, seed=None):
+    # Same results as e91.sync_bases_and_build_keys (with grouped Aer runs), without printing
+    if backend not in ("aer", "analytic"):
+        raise ValueError(f"Unknown backend: {backend}")
+    starts = range(0, len(aliceBases), shard_size)
+    seeds = np.random.SeedSequence(seed).spawn(len(starts))
+    shards = [(list(aliceBases[start:start + shard_size]), list(bobBases[start:start + shard_size]),
+               list(eveBases[start:start + shard_size]) if eve_present else [],
+               list(eveInterceptions[start:start + shard_size]) if eve_present else []) for start in starts]
+
+    # Workers are spawned, as forking a process that already runs simulator threads can deadlock
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        results = list(executor.map(run_shard, shards, seeds, [eve_present] * len(shards),
+                                    [useNoise] * len(shards), [backend] * len(shards)))
+
+    aliceKey = KeyBuffer.concatenate([result[0] for result in results])
+    bobKey = KeyBuffer.concatenate([result[1] for result in results])
+    eveKey = KeyBuffer.concatenate([result[2] for result in results])
+    chsh_counts = sum((result[3] for result in results), np.zeros((4, 4)))
+    corr = e91_analytic.chsh_value(chsh_counts)
+    misMatchedBits = (aliceKey ^ bobKey).popcount()
+    return round(corr, 3), misMatchedBits, aliceKey, bobKey, eveKey
+
+def run_shard(shard, seed, eve_present, useNoise, backend):
+    aliceBases, bobBases, eveBases, eveInterceptions = shard
+    rng = np.random.default_rng(seed)
+    if backend == "analytic":
+        alicesMeasurement, bobsMeasurement, eveMeasurement = e91_analytic.measure_all_qubits(aliceBases, bobBases, eve_present, eveBases, eveInterceptions,
+                                                                                              useNoise, e91.depolarizing_rate, e91.readout_rate, rng)
+    else:
+        alicesMeasurement, bobsMeasurement, eveMeasurement = e91.measure_all_qubits_grouped(aliceBases, bobBases, eve_present, eveBases, eveInterceptions, useNoise, rng)
+    aliceKey, bobKey, eveKey, chsh_counts = e91_analytic.sift_and_count(aliceBases, bobBases, alicesMeasurement, bobsMeasurement,
+                                                                            eve_present, eveBases, eveMeasurement)
+    return KeyBuffer(aliceKey), KeyBuffer(bobKey), KeyBuffer.from_values(eveKey), chsh_counts
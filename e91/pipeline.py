@@ -0,0 +1,76 @@
+import numpy as np
+import e91
+import e91_analytic
+import key_reconciliation
+from key_reconciliation.key_buffer import KeyBuffer
+from key_reconciliation import key_pool
+from e91_analytic import chsh_qber
+
+# Streaming version of e91.sync_bases_and_build_keys. The pairs are processed in blocks of
+# block_size: each block is measured, sifted, checked with CHSH, reconciled and amplified
+# before the next one is generated, so memory depends on block_size and not on nBits
+
+# Number of pairs sent per block
+BLOCK_SIZE = 1 << 16
+
+# Blocks that do not violate the classical CHSH bound are discarded
+MIN_CHSH = 2
+
+def key_blocks(nBits, block_size=BLOCK_SIZE, eve_present=False, eveInterceptionRate=0, useNoise=False,
+               backend="analytic", grouped=True, min_chsh=MIN_CHSH, seed=None):
+    # Yields one dict per block: its index, the CHSH value, the error rate estimated from it,
+    # the number of sifted bits, whether the reconciled keys passed verification, and Alice's
+    # and Bob's final keys (empty when the block was discarded for its CHSH value or because
+    # its keys still differ after reconciliation)
+    rng = np.random.default_rng(seed)
+    bases = np.array(e91_analytic.BASES)
+
+    for index, start in enumerate(range(0, nBits, block_size)):
+        n = min(block_size, nBits - start)
+        # Same choices as e91.createBases
+        aliceBases = bases[rng.integers(0, 3, n)]
+        bobBases = bases[rng.integers(1, 4, n)]
+        eveBases = bases[rng.integers(1, 3, n)] if eve_present else []
+        eveInterceptions = (rng.random(n) < eveInterceptionRate).astype(int) if eve_present else []
+
+        # Generate
+        if backend == "analytic":
+            alicesMeasurement, bobsMeasurement, _ = e91_analytic.measure_all_qubits(
+                aliceBases, bobBases, eve_present, eveBases, eveInterceptions, useNoise, e91.depolarizing_rate, e91.readout_rate, rng)
+        elif backend == "aer":
+            alicesMeasurement, bobsMeasurement, _ = e91.measure_all_qubits(
+                aliceBases.tolist(), bobBases.tolist(), eve_present, list(eveBases), list(eveInterceptions), useNoise, grouped)
+        else:
+            raise ValueError(f"Unknown backend: {backend}")
+
+        # Sift and check
+        aliceKey, bobKey, _, chsh_counts = e91_analytic.sift_and_count(aliceBases, bobBases, alicesMeasurement, bobsMeasurement)
+        chsh = float(e91_analytic.chsh_value(chsh_counts))
+        qber = chsh_qber(chsh)
+        result = {"block": index, "chsh": chsh, "qber": qber, "sifted": len(aliceKey), "verified": False}
+        if chsh <= min_chsh:
+            result["alice_key"] = result["bob_key"] = KeyBuffer([])
+            yield result
+            continue
+
+        # Reconcile, verify and amplify
+        block_seed = int(rng.integers(1 << 31))
+        aliceKey = KeyBuffer(aliceKey)
+        fixedKey, leaked_bits, _ = key_reconciliation.multi_pass_cascade(aliceKey, KeyBuffer(bobKey), qber, seed=block_seed)
+        result["alice_key"], result["bob_key"], result["verified"] = key_reconciliation.verified_amplification(
+            aliceKey, fixedKey, qber, leaked_bits, block_seed)
+        yield result
+
+def secret_key_stream(nBits, **options):
+    # Only the final keys, as Alice sees them
+    for result in key_blocks(nBits, **options):
+        yield result["alice_key"]
+
+def fill_pools(alice_pool, bob_pool, nBits, **options):
+    # Appends the final keys of every block that passed verification to Alice's and Bob's key
+    # pools (key_pool.KeyPool) as soon as the block is done, and returns the number of bytes appended
+    appended = 0
+    for result in key_blocks(nBits, **options):
+        if result["verified"]:
+            appended += key_pool.append_keys(alice_pool, bob_pool, result["alice_key"], result["bob_key"])[0]
+    return appended
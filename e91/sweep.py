@@ -0,0 +1,95 @@
+import argparse
+import json
+import sys
+import numpy as np
+import e91
+import e91_analytic
+import key_reconciliation
+import qkd_common
+from key_reconciliation.key_buffer import KeyBuffer
+from e91_analytic import chsh_qber
+from qkd_common.sweep_engine import sweep, parse_grid, print_table, code_version, module_settings
+
+# Parameter sweeps over E91. Every cell measures the pairs with its error rates and interception
+# rate, sifts them and counts the CHSH outcomes, then runs the multi-pass Cascade and privacy
+# amplification with the error rate estimated from the CHSH value, and stores the CHSH value,
+# the error rates, the bits leaked and the secret key rate.
+# Usage: python sweep.py depolarizing_rate=0,0.01,0.05 eveInterceptionRate=0,0.5,1 [--cache sweep_cache] [--output results.json]
+
+# Parameters of a cell that are not swept
+DEFAULTS = {
+    "protocol": "e91",
+    "nBits": 10000,
+    "depolarizing_rate": 0.0,
+    "readout_rate": 0.0,
+    "eveInterceptionRate": 0.0,
+    "min_chsh": 2,
+    "backend": "analytic",
+    "seed": 0,
+}
+
+COLUMNS = ["depolarizing_rate", "readout_rate", "eveInterceptionRate", "nBits", "chsh", "qber", "leaked_bits", "secret_key_rate"]
+
+# Version of the code the cells run, part of the cache key
+CODE_VERSION = code_version(sys.modules[__name__], e91, e91_analytic, key_reconciliation, qkd_common)
+
+def run_cell(cell):
+    return cell_keys(cell)[0]
+
+def cell_keys(cell):
+    # The results of a cell, and Alice's and Bob's final keys (empty when the cell was aborted)
+    rng = np.random.default_rng(cell["seed"])
+    n = cell["nBits"]
+    # Same choices as e91.createBases
+    bases = np.array(e91_analytic.BASES)
+    aliceBases = bases[rng.integers(0, 3, n)]
+    bobBases = bases[rng.integers(1, 4, n)]
+    eveBases = bases[rng.integers(1, 3, n)]
+    eveInterceptions = (rng.random(n) < cell["eveInterceptionRate"]).astype(int)
+    eve_present = bool(cell["eveInterceptionRate"])
+
+    # The noise model of the cell: passed to the analytic engine, and set on the module for the Aer run only
+    useNoise = bool(cell["depolarizing_rate"] or cell["readout_rate"])
+    if cell["backend"] == "analytic":
+        alicesMeasurement, bobsMeasurement, _ = e91_analytic.measure_all_qubits(aliceBases, bobBases, eve_present, eveBases, eveInterceptions,
+                                                                                 useNoise, cell["depolarizing_rate"], cell["readout_rate"], rng)
+    elif cell["backend"] == "aer":
+        with module_settings(e91, depolarizing_rate=cell["depolarizing_rate"], readout_rate=cell["readout_rate"]):
+            alicesMeasurement, bobsMeasurement, _ = e91.measure_all_qubits_grouped(aliceBases.tolist(), bobBases.tolist(), eve_present,
+                                                                                   eveBases.tolist(), eveInterceptions.tolist(), useNoise, rng)
+    else:
+        raise ValueError(f"Unknown backend: {cell['backend']}")
+
+    aliceKey, bobKey, _, chsh_counts = e91_analytic.sift_and_count(aliceBases, bobBases, alicesMeasurement, bobsMeasurement)
+    aliceKey, bobKey = KeyBuffer(aliceKey), KeyBuffer(bobKey)
+    chsh = float(e91_analytic.chsh_value(chsh_counts))
+    qber = chsh_qber(chsh)
+    result = {"sifted": len(aliceKey), "chsh": chsh, "qber": qber, "measured_qber": (aliceKey ^ bobKey).popcount() / max(len(aliceKey), 1),
+              "aborted": chsh <= cell["min_chsh"], "leaked_bits": 0, "round_trips": 0, "verification_failed": False,
+              "secret_bits": 0, "secret_key_rate": 0.0}
+    if result["aborted"]:
+        return result, KeyBuffer([]), KeyBuffer([])
+
+    # Keys that still differ after Cascade are discarded, as in the pipeline
+    fixedKey, leaked_bits, round_trips = key_reconciliation.multi_pass_cascade(aliceKey, bobKey, qber, seed=cell["seed"])
+    aliceFinal, bobFinal, verified = key_reconciliation.verified_amplification(aliceKey, fixedKey, qber, leaked_bits, cell["seed"])
+    result.update(leaked_bits=leaked_bits, round_trips=round_trips, residual_errors=(fixedKey ^ aliceKey).popcount(),
+                  verification_failed=not verified, secret_bits=len(bobFinal), secret_key_rate=len(bobFinal) / n)
+    return result, aliceFinal, bobFinal
+
+def main(grid, defaults=DEFAULTS, cache_dir="sweep_cache", workers=None, output=None):
+    results = sweep(run_cell, grid, defaults, cache_dir, workers, CODE_VERSION)
+    print_table(results, COLUMNS)
+    if output:
+        with open(output, "w") as file:
+            json.dump(results, file, indent=1)
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Sweeps E91 over a grid of parameters")
+    parser.add_argument("grid", nargs="+", help=f"name=value,value,... with names from {', '.join(DEFAULTS)}")
+    parser.add_argument("--cache", default="sweep_cache", help="directory of the cached cells")
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--output", help="JSON file the results are saved to")
+    args = parser.parse_args()
+    main(parse_grid(args.grid), DEFAULTS, args.cache, args.workers, args.output)
@@ -0,0 +1,131 @@
+import argparse
+import numpy as np
+import key_reconciliation
+import e91_analytic
+from e91_analytic import ANGLES, CHSH_ROWS
+
+# Monte Carlo trials of whole E91 sessions, to see how the CHSH value used to detect Eve and
+# the key length vary between runs. Every session of a chunk is a row of a (trials x pairs)
+# array, sampled as in e91_analytic.measure_all_qubits, then sifted and counted for CHSH with
+# the same arithmetic on every row. Sessions with a CHSH value at or below min_chsh are
+# aborted. The others are reconciled (multi-pass Cascade) and amplified one by one, with the
+# error rate estimated from the CHSH value with e91_analytic.chsh_qber, as in pipeline.py.
+# Every trial draws its numbers from its own generator, spawned from the seed, so the results
+# do not depend on how the trials are cut into chunks: max_elements only bounds the memory
+# (about 100 bytes per pair of a chunk).
+# Usage: python trials.py [--trials 1000] [--nBits 4096] [--min_chsh 2] [--depolarizing_rate 0.01] ...
+
+# Random numbers drawn per pair: the bases of Alice, Bob and Eve, whether Eve intercepts,
+# Alice's outcome and whether Bob's agrees, Eve's outcome and whether Alice's and Bob's agree
+# with it, then for Alice and Bob whether the qubit depolarizes, its random outcome and the
+# readout flip
+STREAMS = 15
+
+# Largest number of pairs in a chunk
+MAX_ELEMENTS = 1 << 22
+
+def trial_numbers(seeds, nBits):
+    # Uniform numbers of every trial in a chunk, as a (streams, trials, pairs) array, and the
+    # seed each trial uses for reconciliation
+    rngs = [np.random.default_rng(seed) for seed in seeds]
+    uniforms = np.stack([rng.random((STREAMS, nBits), dtype=np.float32) for rng in rngs], axis=1)
+    return uniforms, [int(rng.integers(1 << 31)) for rng in rngs]
+
+def simulate_chunk(seeds, nBits, min_chsh, depolarizing_rate, readout_rate, eveInterceptionRate, reconcile):
+    u, reconcile_seeds = trial_numbers(seeds, nBits)
+    trials = len(seeds)
+    # Same choices as e91.createBases: Alice X, Y or Z, Bob Y, Z or W and Eve Y or Z
+    aliceCodes = np.minimum((u[0] * 3).astype(np.int64), 2)
+    bobCodes = 1 + np.minimum((u[1] * 3).astype(np.int64), 2)
+    eveCodes = 1 + np.minimum((u[2] * 2).astype(np.int64), 1)
+    intercepted = u[3] < eveInterceptionRate
+    alice, bob, eve = ANGLES[aliceCodes], ANGLES[bobCodes], ANGLES[eveCodes]
+
+    aliceBits = (u[4] < 0.5).astype(np.uint8)
+    bobBits = np.where(u[5] < np.sin((alice - bob) / 2) ** 2, aliceBits, 1 - aliceBits)
+    # Eve measures Bob's qubit first and resends her outcome in the standard basis
+    eveBits = (u[6] < 0.5).astype(np.uint8)
+    aliceBits = np.where(intercepted, np.where(u[7] < np.sin((alice - eve) / 2) ** 2, eveBits, 1 - eveBits), aliceBits)
+    bobBits = np.where(intercepted, np.where(u[8] < np.cos(bob / 2) ** 2, eveBits, 1 - eveBits), bobBits)
+
+    aliceBits = np.where(u[9] < depolarizing_rate, u[10] < 0.5, aliceBits).astype(np.uint8) ^ (u[13] < readout_rate)
+    bobBits = np.where(u[11] < depolarizing_rate, u[12] < 0.5, bobBits).astype(np.uint8) ^ (u[14] < readout_rate)
+    # Alice flips her bit, so that her key matches Bob's when they share a base
+    aliceBits = 1 - aliceBits
+
+    # Sift and count the CHSH outcomes of every row
+    sifted = aliceCodes == bobCodes
+    rows = CHSH_ROWS[aliceCodes, bobCodes]
+    used = ~sifted & (rows >= 0)
+    cells = 16 * np.arange(trials)[:, None] + 4 * rows + 2 * aliceBits + bobBits
+    chsh_counts = np.bincount(cells[used], minlength=16 * trials).reshape(trials, 4, 4).astype(float)
+    chsh = e91_analytic.chsh_value(chsh_counts)
+    nSifted = sifted.sum(axis=1)
+    estimated = e91_analytic.chsh_qber(chsh)
+    results = {"sifted": nSifted, "chsh": chsh, "qber": (sifted & (aliceBits != bobBits)).sum(axis=1) / np.maximum(nSifted, 1),
+               "estimated_qber": estimated, "aborted": chsh <= min_chsh,
+               "leaked_bits": np.zeros(trials, dtype=np.int64), "final_key_bits": np.zeros(trials, dtype=np.int64)}
+    if not reconcile:
+        return results
+
+    for trial in np.flatnonzero(~results["aborted"]):
+        aliceKey = aliceBits[trial][sifted[trial]]
+        bobKey = bobBits[trial][sifted[trial]]
+        _, leaked_bits, _ = key_reconciliation.multi_pass_cascade(aliceKey, bobKey, estimated[trial], seed=reconcile_seeds[trial])
+        results["leaked_bits"][trial] = leaked_bits
+        results["final_key_bits"][trial] = key_reconciliation.privacy_amplification_length(len(aliceKey), estimated[trial], leaked_bits)
+    return results
+
+def run_trials(trials, nBits, min_chsh=2, depolarizing_rate=0.0, readout_rate=0.0, eveInterceptionRate=0.0,
+               reconcile=True, seed=0, max_elements=MAX_ELEMENTS):
+    # Runs trials sessions of nBits pairs, and returns one array per result with one entry per
+    # trial: sifted bits, the CHSH value, the true and estimated error rates, whether the
+    # session was aborted, and the parity bits leaked and final key length (0 when aborted, or
+    # when reconcile is False)
+    seeds = np.random.SeedSequence(seed).spawn(trials)
+    chunk = max(1, max_elements // max(nBits, 1))
+    chunks = [simulate_chunk(seeds[start:start + chunk], nBits, min_chsh, depolarizing_rate, readout_rate,
+                             eveInterceptionRate, reconcile) for start in range(0, trials, chunk)]
+    return {name: np.concatenate([results[name] for results in chunks]) for name in chunks[0]}
+
+def detection_rates(attacked, clean):
+    # Share of the sessions aborted with Eve (detection probability) and without her (false alarms)
+    return float(np.mean(attacked["aborted"])), float(np.mean(clean["aborted"]))
+
+def threshold_curve(attacked, clean, thresholds):
+    # Detection probability and false-alarm rate for every min_chsh
+    thresholds = np.asarray(thresholds, dtype=float)
+    detection = np.mean(attacked["chsh"][:, None] <= thresholds, axis=0)
+    false_alarms = np.mean(clean["chsh"][:, None] <= thresholds, axis=0)
+    return detection, false_alarms
+
+def histograms(results, bins=20):
+    # Counts and bin edges of the CHSH values, the true error rates and the final key lengths
+    return {name: np.histogram(results[name], bins=bins) for name in ["chsh", "qber", "final_key_bits"]}
+
+def main(trials=1000, nBits=4096, min_chsh=2, depolarizing_rate=None, readout_rate=None, eveInterceptionRates=(0.25, 0.5, 1.0), seed=0):
+    # Error rates default to the ones of e91.py, imported here as it loads Qiskit
+    import e91
+    depolarizing_rate = e91.depolarizing_rate if depolarizing_rate is None else depolarizing_rate
+    readout_rate = e91.readout_rate if readout_rate is None else readout_rate
+    options = dict(min_chsh=min_chsh, depolarizing_rate=depolarizing_rate, readout_rate=readout_rate, seed=seed)
+    clean = run_trials(trials, nBits, **options)
+    p5, p50, p95 = np.percentile(clean["final_key_bits"], [5, 50, 95])
+    print(f"No Eve: CHSH {np.mean(clean['chsh']):.3f} +- {np.std(clean['chsh']):.3f}, false alarms {np.mean(clean['aborted']):.4f}, "
+          f"key bits p5 {p5:.0f}, p50 {p50:.0f}, p95 {p95:.0f}")
+    for eveInterceptionRate in eveInterceptionRates:
+        attacked = run_trials(trials, nBits, eveInterceptionRate=eveInterceptionRate, reconcile=False, **options)
+        print(f"Eve intercepting {eveInterceptionRate:.0%}: CHSH {np.mean(attacked['chsh']):.3f} +- {np.std(attacked['chsh']):.3f}, "
+              f"detection {detection_rates(attacked, clean)[0]:.4f}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Monte Carlo trials of E91 sessions")
+    parser.add_argument("--trials", type=int, default=1000)
+    parser.add_argument("--nBits", type=int, default=4096)
+    parser.add_argument("--min_chsh", type=float, default=2)
+    parser.add_argument("--depolarizing_rate", type=float)
+    parser.add_argument("--readout_rate", type=float)
+    parser.add_argument("--eveInterceptionRates", type=float, nargs="+", default=[0.25, 0.5, 1.0])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    main(args.trials, args.nBits, args.min_chsh, args.depolarizing_rate, args.readout_rate, args.eveInterceptionRates, args.seed)
@@ -0,0 +1,46 @@
+# Key reconciliation and privacy amplification, shared by BB84 and E91 (the protocol folders
+# link to this package), with the key type and metrics hooks every stage uses. Importing it
+# only loads NumPy: asyncio is imported when a reconciliation runs over a classical channel,
+# and nothing here needs Qiskit.
+#     import key_reconciliation
+#     fixed_key, final_key, alice_final_key = key_reconciliation.key_reconciliation(alice_key, bob_key, qber=0.03)
+# Submodules: reconciliation (the functions below), classical_channel, key_buffer, key_pool, metrics
+
+from .key_buffer import KeyBuffer, as_key
+from .reconciliation import (
+    key_reconciliation,
+    cascade_error_correction,
+    cascade_with_leakage,
+    cascade_error_correction_reference,
+    multi_pass_cascade,
+    adaptive_cascade,
+    verify_keys,
+    verified_amplification,
+    qber_block_size,
+    prefix_parities,
+    ldpc_reconciliation,
+    ldpc_rate,
+    privacy_amplification,
+    privacy_amplification_length,
+    toeplitz_hash,
+)
+
+__all__ = [
+    "KeyBuffer",
+    "as_key",
+    "key_reconciliation",
+    "cascade_error_correction",
+    "cascade_with_leakage",
+    "cascade_error_correction_reference",
+    "multi_pass_cascade",
+    "adaptive_cascade",
+    "verify_keys",
+    "verified_amplification",
+    "qber_block_size",
+    "prefix_parities",
+    "ldpc_reconciliation",
+    "ldpc_rate",
+    "privacy_amplification",
+    "privacy_amplification_length",
+    "toeplitz_hash",
+]
@@ -0,0 +1,313 @@
+import asyncio
+import os
+import struct
+import sys
+import tempfile
+import time
+import numpy as np
+from . import reconciliation
+from .key_buffer import KeyBuffer
+
+# The authenticated classical channel between Alice and Bob, for reconciliation. Alice and Bob
+# run as two asyncio tasks that only share the messages sent over a transport:
+# - "memory": a pair of asyncio queues
+# - "tcp" or "unix": a local socket, the messages framed by their length
+# Every transport can delay the messages it sends by latency seconds (one way).
+#
+# reconcile() runs the multi-pass Cascade over it. Bob only knows his key and the parities
+# Alice sends him. Every parity query that does not depend on another one goes in the same
+# message: all blocks of a pass, then one level of the binary search of every odd block at a
+# time. So a pass takes a handful of round trips instead of one per parity.
+# Usage: python -m key_reconciliation.classical_channel [bits] [qber] [latency_ms]
+
+# Message kinds
+START, BLOCKS, RANGES, REPLY, DONE = range(5)
+
+# One byte per array for its type, in the message header
+DTYPES = {b"B": np.uint8, b"I": np.uint32, b"Q": np.uint64}
+
+def encode(kind, *arrays):
+    # Kind and number of arrays, then the type and length of every array and their contents
+    header = struct.pack("<BB", kind, len(arrays))
+    body = b""
+    for array in arrays:
+        code = next(code for code, dtype in DTYPES.items() if array.dtype == dtype)
+        header += code + struct.pack("<I", len(array))
+        body += array.tobytes()
+    return header + body
+
+def decode(data):
+    kind, count = struct.unpack_from("<BB", data)
+    offset = 2 + 5 * count
+    arrays = []
+    for i in range(count):
+        code = data[2 + 5 * i:3 + 5 * i]
+        length, = struct.unpack_from("<I", data, 3 + 5 * i)
+        array = np.frombuffer(data, dtype=DTYPES[code], count=length, offset=offset)
+        offset += array.nbytes
+        arrays.append(array)
+    return kind, arrays
+
+class QueueTransport:
+    # One end of an in-memory channel
+    def __init__(self, inbox, outbox, latency=0.0):
+        self.inbox = inbox
+        self.outbox = outbox
+        self.latency = latency
+
+    async def send(self, data):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        await self.outbox.put(data)
+
+    async def receive(self):
+        return await self.inbox.get()
+
+    async def close(self):
+        pass
+
+class StreamTransport:
+    # One end of a socket, every message preceded by its length
+    def __init__(self, reader, writer, latency=0.0):
+        self.reader = reader
+        self.writer = writer
+        self.latency = latency
+
+    async def send(self, data):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.writer.write(struct.pack("<I", len(data)) + data)
+        await self.writer.drain()
+
+    async def receive(self):
+        length, = struct.unpack("<I", await self.reader.readexactly(4))
+        return await self.reader.readexactly(length)
+
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+
+async def open_transports(transport="memory", latency=0.0):
+    # Returns Alice's and Bob's ends of a new channel, and a coroutine function that closes it
+    if transport == "memory":
+        to_alice, to_bob = asyncio.Queue(), asyncio.Queue()
+        async def close():
+            pass
+        return QueueTransport(to_alice, to_bob, latency), QueueTransport(to_bob, to_alice, latency), close
+    if transport not in ("tcp", "unix"):
+        raise ValueError(f"Unknown transport: {transport}")
+
+    # Alice listens and Bob connects
+    accepted = asyncio.get_running_loop().create_future()
+    def accept(reader, writer):
+        accepted.set_result(StreamTransport(reader, writer, latency))
+    if transport == "tcp":
+        server = await asyncio.start_server(accept, "127.0.0.1", 0)
+        reader, writer = await asyncio.open_connection(*server.sockets[0].getsockname()[:2])
+    else:
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "channel.sock")
+        server = await asyncio.start_unix_server(accept, path)
+        reader, writer = await asyncio.open_unix_connection(path)
+    bob = StreamTransport(reader, writer, latency)
+    alice = await accepted
+
+    async def close():
+        await bob.close()
+        await alice.close()
+        server.close()
+        await server.wait_closed()
+        if transport == "unix":
+            os.remove(path)
+            os.rmdir(directory)
+    return alice, bob, close
+
+class ChannelStats:
+    # Messages and bytes sent and received by one end, and the round trips it waited for
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+        self.round_trips = 0
+
+    def summary(self):
+        return {"messages": self.messages, "bytes": self.bytes, "round_trips": self.round_trips}
+
+class Endpoint:
+    def __init__(self, transport):
+        self.transport = transport
+        self.stats = ChannelStats()
+
+    async def send(self, kind, *arrays):
+        data = encode(kind, *arrays)
+        self.stats.messages += 1
+        self.stats.bytes += len(data)
+        await self.transport.send(data)
+
+    async def receive(self):
+        data = await self.transport.receive()
+        self.stats.messages += 1
+        self.stats.bytes += len(data)
+        return decode(data)
+
+    async def request(self, kind, *arrays):
+        # Sends a query and waits for the reply
+        await self.send(kind, *arrays)
+        _, reply = await self.receive()
+        self.stats.round_trips += 1
+        return reply
+
+def pass_order(p, key_length, rng):
+    # Order of the key in pass p, the same for Alice and Bob (and multi_pass_cascade) with the same seed
+    return np.arange(key_length) if p == 0 else rng.permutation(key_length)
+
+def pass_size(p, block_size, key_length):
+    return min(block_size * 2 ** p, key_length)
+
+def parity_bits(parities):
+    # Parities are sent eight to a byte
+    return np.packbits(np.asarray(parities, dtype=np.uint8))
+
+def range_parities(prefixes, passes, starts, ends):
+    # Parity of the range [start, end) of the key in the order of pass p, for every query
+    parities = np.empty(len(passes), dtype=np.uint8)
+    for p in np.unique(passes):
+        queries = passes == p
+        parities[queries] = prefixes[p][ends[queries]] ^ prefixes[p][starts[queries]]
+    return parities
+
+async def alice(endpoint, alice_key):
+    # Answers Bob's parity queries about alice_key until he is done
+    alice_bits = np.asarray(alice_key, dtype=np.uint8)
+    key_length = len(alice_bits)
+    prefixes = []
+    while True:
+        kind, arrays = await endpoint.receive()
+        if kind == DONE:
+            return
+        if kind == START:
+            seed, block_size = (int(value) for value in arrays[0])
+            rng = np.random.default_rng(seed)
+            prefixes = []
+        elif kind == BLOCKS:
+            # Parities of every block of a pass. Passes are asked for in order
+            p = int(arrays[0][0])
+            while len(prefixes) <= p:
+                order = pass_order(len(prefixes), key_length, rng)
+                prefixes.append(reconciliation.prefix_parities(alice_bits[order]))
+            starts = np.arange(0, key_length, pass_size(p, block_size, key_length))
+            ends = np.minimum(starts + pass_size(p, block_size, key_length), key_length)
+            await endpoint.send(REPLY, parity_bits(prefixes[p][ends] ^ prefixes[p][starts]))
+        elif kind == RANGES:
+            passes, starts, ends = arrays
+            await endpoint.send(REPLY, parity_bits(range_parities(prefixes, passes, starts, ends)))
+        else:
+            raise ValueError(f"Unexpected message: {kind}")
+
+async def bob(endpoint, bob_key, qber, passes=4, seed=None):
+    # Multi-pass Cascade as in multi_pass_cascade, with the same blocks for the same seed, from
+    # Bob's side. Returns his corrected key and the number of parity bits disclosed
+    bob_bits = np.array(bob_key, dtype=np.uint8)  # Create a copy to avoid modifying the original
+    key_length = len(bob_bits)
+    if key_length == 0:
+        await endpoint.send(DONE)
+        return KeyBuffer(bob_bits), 0
+    # The permutations are public, so Alice draws them from the seed Bob sends her
+    if seed is None:
+        seed = int(np.random.default_rng().integers(1 << 63))
+    rng = np.random.default_rng(seed)
+    block_size = reconciliation.qber_block_size(qber, key_length)
+    await endpoint.send(START, np.array([seed, block_size], dtype=np.uint64))
+
+    # For every pass: the order of the key, the block of each position and which blocks have
+    # another parity than Alice's
+    orders = []
+    blocks = []
+    odd = []
+    leaked_bits = 0
+
+    for p in range(passes):
+        order = pass_order(p, key_length, rng)
+        size = pass_size(p, block_size, key_length)
+        block_of = np.empty(key_length, dtype=np.int64)
+        block_of[order] = np.arange(key_length) // size
+        starts = np.arange(0, key_length, size)
+        reply, = await endpoint.request(BLOCKS, np.array([p], dtype=np.uint32))
+        alice_parity = np.unpackbits(reply, count=len(starts))
+        orders.append(order)
+        blocks.append(block_of)
+        odd.append(alice_parity ^ np.bitwise_xor.reduceat(bob_bits[order], starts))
+        leaked_bits += len(starts)
+
+        # Every odd block of every pass so far is searched at the same time. The errors found
+        # flip the parity of their blocks in every pass, and the blocks that become odd are
+        # searched in the next wave (the back-cascade)
+        while True:
+            searched = [(q, b) for q in range(p + 1) for b in np.flatnonzero(odd[q]).tolist()]
+            if not searched:
+                break
+            errors, queries = await search_errors(endpoint, bob_bits, orders, searched, block_size)
+            leaked_bits += queries
+            errors = np.unique(errors)
+            bob_bits[errors] ^= 1
+            for q in range(p + 1):
+                np.bitwise_xor.at(odd[q], blocks[q][errors], 1)
+
+    await endpoint.send(DONE)
+    return KeyBuffer(bob_bits), leaked_bits
+
+async def search_errors(endpoint, bob_bits, orders, searched, block_size):
+    # Binary search of the (pass, block) pairs in searched, one level of all of them per message.
+    # Returns the position of an error in each of them and the number of parities asked for
+    key_length = len(bob_bits)
+    passes = np.array([q for q, _ in searched], dtype=np.uint32)
+    sizes = np.array([pass_size(q, block_size, key_length) for q, _ in searched])
+    starts = np.array([b for _, b in searched]) * sizes
+    low = np.zeros(len(searched), dtype=np.int64)
+    high = np.minimum(starts + sizes, key_length) - starts - 1
+    prefixes = {q: reconciliation.prefix_parities(bob_bits[orders[q]]) for q in np.unique(passes).tolist()}
+    queries = 0
+    while np.any(low < high):
+        searching = low < high
+        mid = (low + high) // 2
+        ends = starts + mid + 1
+        reply, = await endpoint.request(RANGES, passes[searching], starts[searching].astype(np.uint32), ends[searching].astype(np.uint32))
+        count = int(np.sum(searching))
+        queries += count
+        left_odd = np.zeros(len(searched), dtype=bool)
+        left_odd[searching] = (np.unpackbits(reply, count=count) ^ range_parities(prefixes, passes[searching], starts[searching], ends[searching])) == 1
+        high = np.where(searching & left_odd, mid, high)
+        low = np.where(searching & ~left_odd, mid + 1, low)
+    return np.array([orders[q][start] for q, start in zip(passes.tolist(), (starts + low).tolist())]), queries
+
+async def reconcile_async(alice_key, bob_key, qber, passes=4, seed=None, transport="memory", latency=0.0):
+    alice_transport, bob_transport, close = await open_transports(transport, latency)
+    alice_end, bob_end = Endpoint(alice_transport), Endpoint(bob_transport)
+    try:
+        _, (fixed_key, leaked_bits) = await asyncio.gather(alice(alice_end, alice_key), bob(bob_end, bob_key, qber, passes, seed))
+    finally:
+        await close()
+    return fixed_key, leaked_bits, bob_end.stats
+
+def reconcile(alice_key, bob_key, qber, passes=4, seed=None, transport="memory", latency=0.0):
+    # Returns Bob's corrected key, the number of parity bits disclosed and the ChannelStats of
+    # Bob's end (every message of the session passes through it). From code already running an
+    # event loop, await reconcile_async() instead
+    return asyncio.run(reconcile_async(alice_key, bob_key, qber, passes, seed, transport, latency))
+
+def main(nBits=100000, qber=0.03, latency=0.01):
+    rng = np.random.default_rng(0)
+    alice_key = rng.integers(0, 2, nBits, dtype=np.uint8)
+    bob_key = alice_key ^ (rng.random(nBits) < qber).astype(np.uint8)
+    _, leaked_bits, round_trips = reconciliation.multi_pass_cascade(alice_key, bob_key, qber, seed=0)
+    print(f"multi_pass_cascade: {leaked_bits} bits leaked, {round_trips} round trips, {2 * latency * round_trips:.1f} s of latency")
+    for transport in ["memory", "tcp", "unix"]:
+        start = time.perf_counter()
+        fixed_key, leaked_bits, stats = reconcile(alice_key, bob_key, qber, seed=0, transport=transport, latency=latency)
+        errors = (fixed_key ^ KeyBuffer(alice_key)).popcount()
+        print(f"{transport}: {leaked_bits} bits leaked, {stats.round_trips} round trips, {stats.messages} messages, "
+              f"{stats.bytes} bytes, {errors} errors left, {time.perf_counter() - start:.1f} s")
+
+if __name__ == '__main__':
+    arguments = sys.argv[1:]
+    main(int(arguments[0]) if len(arguments) > 0 else 100000, float(arguments[1]) if len(arguments) > 1 else 0.03,
+         float(arguments[2]) / 1000 if len(arguments) > 2 else 0.01)
@@ -0,0 +1,199 @@
+import math
+import numpy as np
+
+# Keys are passed between the protocol stages as a KeyBuffer: the bits packed eight per byte
+# (np.packbits order, first bit in the high bit), instead of a Python int per bit in a list, and
+# an optional validity mask packed the same way for positions whose value is unknown (Eve's key,
+# where she discarded her measurement). A buffer is a window of length bits starting offset bits
+# into its words, so contiguous slices are views sharing memory with the original buffer. XOR,
+# popcount and comparison work on the packed bytes; bits gives the unpacked np.uint8 array for
+# the stages that gather or flip single bits (Cascade, the spot check), which is a copy. The
+# buffer behaves like a list of ints for indexing, iteration, comparison and printing, with NaN
+# at invalid positions
+
+# Number of bits set in every byte value
+POPCOUNT = np.array([bin(value).count("1") for value in range(256)], dtype=np.uint8)
+
+class KeyBuffer:
+    __slots__ = ("words", "offset", "length", "valid")
+
+    def __init__(self, bits, valid=None):
+        bits = np.asarray(bits)
+        self.words = np.packbits(bits if bits.dtype.kind in "biu" else bits.astype(np.uint8))
+        self.offset = 0
+        self.length = len(bits)
+        self.valid = None if valid is None else np.packbits(np.asarray(valid, dtype=bool))
+
+    @classmethod
+    def view(cls, words, offset, length, valid=None):
+        # A buffer over packed words, without copying them
+        key = cls.__new__(cls)
+        key.words = words
+        key.offset = offset
+        key.length = length
+        key.valid = valid
+        return key
+
+    @classmethod
+    def from_values(cls, values):
+        # From a sequence of bits with NaN where the value is unknown
+        values = np.asarray(values, dtype=float)
+        valid = ~np.isnan(values)
+        bits = np.where(valid, values, 0).astype(np.uint8)
+        return cls(bits, None if valid.all() else valid)
+
+    @classmethod
+    def concatenate(cls, keys):
+        # Joins keys end to end, keeping the validity masks
+        keys = [as_key(key) for key in keys]
+        bits = np.concatenate([key.bits for key in keys]) if keys else np.zeros(0, dtype=np.uint8)
+        if all(key.valid is None for key in keys):
+            return cls(bits)
+        return cls(bits, np.concatenate([key.mask() for key in keys]))
+
+    @classmethod
+    def unpack(cls, data, length):
+        # Inverse of pack(). The bytes are copied, so the key does not hold on to the buffer
+        return cls.view(np.frombuffer(data, dtype=np.uint8)[:(length + 7) // 8].copy(), 0, length)
+
+    def pack(self):
+        # Eight bits per byte, to store or send the key
+        return clear_tail(aligned(self.words, self.offset, self.length).copy(), self.length).tobytes()
+
+    @property
+    def bits(self):
+        # One np.uint8 per bit, unpacked from the words
+        start = self.offset // 8
+        shift = self.offset % 8
+        return np.unpackbits(self.words[start:(self.offset + self.length + 7) // 8])[shift:shift + self.length]
+
+    def __len__(self):
+        return self.length
+
+    def position(self, index):
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError("KeyBuffer index out of range")
+        return self.offset + index
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.length)
+            if step == 1:
+                return KeyBuffer.view(self.words, self.offset + start, max(stop - start, 0), self.valid)
+            return KeyBuffer(self.bits[index], None if self.valid is None else self.mask()[index])
+        position = self.position(index)
+        if self.valid is not None and not bit(self.valid, position):
+            return math.nan
+        return bit(self.words, position)
+
+    def __setitem__(self, index, value):
+        # Sets one bit, in every view of the same words
+        position = self.position(index)
+        if value:
+            self.words[position // 8] |= 0x80 >> (position % 8)
+        else:
+            self.words[position // 8] &= ~np.uint8(0x80 >> (position % 8))
+
+    def __iter__(self):
+        return iter(self.tolist())
+
+    def __array__(self, dtype=None, copy=None):
+        # NumPy's copy protocol: the bits are packed, so an array of them is always a copy, and
+        # copy=False raises
+        if copy is False:
+            raise ValueError("KeyBuffer holds packed bits and cannot be viewed as an array without a copy")
+        bits = self.bits
+        return bits if dtype is None else bits.astype(dtype)
+
+    def __eq__(self, other):
+        if not isinstance(other, KeyBuffer):
+            try:
+                other = as_key(other)
+            except (TypeError, ValueError):
+                return NotImplemented
+        if len(self) != len(other):
+            return False
+        if (self.valid is not None or other.valid is not None) and not np.array_equal(self.packed_mask(), other.packed_mask()):
+            return False
+        return (self ^ other).popcount() == 0
+
+    __hash__ = None
+
+    def __xor__(self, other):
+        other = as_key(other)
+        if len(self) != len(other):
+            raise ValueError(f"Cannot XOR keys of {len(self)} and {len(other)} bits")
+        words = aligned(self.words, self.offset, self.length) ^ aligned(other.words, other.offset, other.length)
+        if self.valid is None and other.valid is None:
+            return KeyBuffer.view(words, 0, self.length)
+        return KeyBuffer.view(words, 0, self.length, self.packed_mask() & other.packed_mask())
+
+    __rxor__ = __xor__
+
+    def mask(self):
+        if self.valid is None:
+            return np.ones(self.length, dtype=bool)
+        start = self.offset // 8
+        shift = self.offset % 8
+        return np.unpackbits(self.valid[start:(self.offset + self.length + 7) // 8])[shift:shift + self.length].astype(bool)
+
+    def packed_mask(self):
+        # The validity mask packed from the first bit of the key, zeros past the end
+        if self.valid is None:
+            return clear_tail(np.full((self.length + 7) // 8, 0xFF, dtype=np.uint8), self.length)
+        return clear_tail(aligned(self.valid, self.offset, self.length).copy(), self.length)
+
+    def popcount(self):
+        # Number of valid bits set to 1, counted a byte at a time
+        words = aligned(self.words, self.offset, self.length)
+        words = words & self.packed_mask() if self.valid is not None else words.copy()
+        return int(POPCOUNT[clear_tail(words, self.length)].sum(dtype=np.int64))
+
+    def parity(self):
+        return self.popcount() & 1
+
+    def copy(self):
+        valid = None if self.valid is None else aligned(self.valid, self.offset, self.length).copy()
+        return KeyBuffer.view(aligned(self.words, self.offset, self.length).copy(), 0, self.length, valid)
+
+    def tolist(self):
+        if self.valid is None:
+            return self.bits.tolist()
+        return np.where(self.mask(), self.bits, np.nan).tolist()
+
+    def __repr__(self):
+        return repr(self.tolist())
+
+def bit(words, position):
+    return int(words[position // 8] >> (7 - position % 8)) & 1
+
+def aligned(words, offset, length):
+    # The bytes holding bits offset to offset + length, shifted so that the first one is the high
+    # bit of the first byte. A view when offset is a whole number of bytes. Bits past the end are
+    # left as they are
+    start = offset // 8
+    shift = offset % 8
+    count = (length + 7) // 8
+    if shift == 0:
+        return words[start:start + count]
+    span = np.zeros(count + 1, dtype=np.uint16)
+    chunk = words[start:start + count + 1]
+    span[:len(chunk)] = chunk
+    return ((span[:-1] << shift | span[1:] >> (8 - shift)) & 0xFF).astype(np.uint8)
+
+def clear_tail(words, length):
+    # Sets the bits past the end of the key to 0, in place
+    if length % 8:
+        words[-1] &= (0xFF << (8 - length % 8)) & 0xFF
+    return words
+
+def as_key(key):
+    # Wraps bits (a list, array or KeyBuffer), and returns a KeyBuffer as it is
+    if isinstance(key, KeyBuffer):
+        return key
+    values = np.asarray(key)
+    if values.dtype.kind == "f":
+        return KeyBuffer.from_values(values)
+    return KeyBuffer(values)
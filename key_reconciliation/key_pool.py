@@ -0,0 +1,139 @@
+import fcntl
+import mmap
+import os
+import struct
+import time
+import numpy as np
+from .key_buffer import KeyBuffer, as_key
+
+# Persistent store for the final keys, so that key material gathered over long runs can be
+# handed out to applications. A pool is a directory with two files:
+# - "keys": the key bytes (eight bits per byte), only ever appended to
+# - "index": the number of bytes committed and the number of bytes taken so far, as two
+#   little-endian uint64, memory-mapped by every process that opens the pool
+# append() writes the new bytes after the committed ones and flushes them to disk before
+# it commits them in the index, so after a crash the pool holds every key committed before it,
+# and bytes written but not committed are overwritten by the next append. The index is updated
+# under an exclusive lock (fcntl.flock), so several processes can take keys while the
+# generator keeps appending. Reads return memoryviews of a read-only mapping of "keys", without
+# copying. Alice and Bob each have a pool (open_pools()), filled with the same number of bits:
+# Alice's application takes key and sends its offset, and Bob's consumes the same bytes.
+
+INDEX = struct.Struct("<QQ")
+
+class KeyPool:
+    def __init__(self, path):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.keys = os.open(os.path.join(path, "keys"), os.O_RDWR | os.O_CREAT, 0o600)
+        self.index_file = os.open(os.path.join(path, "index"), os.O_RDWR | os.O_CREAT, 0o600)
+        with self.locked():
+            if os.fstat(self.index_file).st_size < INDEX.size:
+                os.ftruncate(self.index_file, INDEX.size)
+        self.index = mmap.mmap(self.index_file, INDEX.size)
+        self.mapping = None
+        # Bits appended by this process that do not fill a byte yet
+        self.pending = np.zeros(0, dtype=np.uint8)
+
+    def locked(self):
+        return PoolLock(self.index_file)
+
+    def committed(self):
+        return INDEX.unpack_from(self.index)[0]
+
+    def taken(self):
+        return INDEX.unpack_from(self.index)[1]
+
+    def __len__(self):
+        # Bytes committed, taken or not
+        return self.committed()
+
+    def available(self):
+        committed, taken = INDEX.unpack_from(self.index)
+        return committed - taken
+
+    def append(self, key):
+        # Appends the bits of key and returns the number of bytes committed. Bits left over
+        # after the last full byte are kept for the next append
+        bits = np.concatenate([self.pending, as_key(key).bits])
+        full = len(bits) - len(bits) % 8
+        self.pending = bits[full:]
+        if full == 0:
+            return 0
+        data = np.packbits(bits[:full]).tobytes()
+        with self.locked():
+            committed, taken = INDEX.unpack_from(self.index)
+            os.pwrite(self.keys, data, committed)
+            os.fsync(self.keys)
+            INDEX.pack_into(self.index, 0, committed + len(data), taken)
+            self.index.flush()
+        return len(data)
+
+    def read(self, offset, length):
+        # The committed bytes [offset, offset + length), without copying
+        if offset < 0 or offset + length > self.committed():
+            raise ValueError(f"Bytes {offset} to {offset + length} are not in the pool")
+        if length == 0:
+            return memoryview(b"")
+        if self.mapping is None or offset + length > len(self.mapping):
+            # Views of an earlier mapping keep it open until they are released
+            self.mapping = mmap.mmap(self.keys, os.fstat(self.keys).st_size, access=mmap.ACCESS_READ)
+        return memoryview(self.mapping)[offset:offset + length]
+
+    def take(self, length, timeout=None):
+        # Takes the next length bytes nobody has taken, and returns their offset and the bytes.
+        # Waits up to timeout seconds for the generator to append them (None: does not wait)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self.locked():
+                committed, taken = INDEX.unpack_from(self.index)
+                if committed - taken >= length:
+                    INDEX.pack_into(self.index, 0, committed, taken + length)
+                    self.index.flush()
+                    return taken, self.read(taken, length)
+            if deadline is None or time.monotonic() >= deadline:
+                raise ValueError(f"Only {committed - taken} bytes of key left, {length} asked for")
+            time.sleep(0.01)
+
+    def consume(self, offset, length):
+        # Bob's side of take(): the bytes at the offset Alice took, marked as taken
+        view = self.read(offset, length)
+        with self.locked():
+            committed, taken = INDEX.unpack_from(self.index)
+            INDEX.pack_into(self.index, 0, committed, max(taken, offset + length))
+            self.index.flush()
+        return view
+
+    def close(self):
+        self.index.close()
+        os.close(self.index_file)
+        os.close(self.keys)
+
+class PoolLock:
+    # Exclusive lock on the index of a pool, between processes
+    def __init__(self, file):
+        self.file = file
+
+    def __enter__(self):
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+
+    def __exit__(self, *exc):
+        fcntl.flock(self.file, fcntl.LOCK_UN)
+
+def open_pools(directory):
+    # Alice's and Bob's pools
+    return KeyPool(os.path.join(directory, "alice")), KeyPool(os.path.join(directory, "bob"))
+
+def append_keys(alice_pool, bob_pool, alice_key, bob_key):
+    # Both pools must stay aligned and hand out the same pads, so both keys must be the same.
+    # Nothing is appended otherwise
+    alice_key, bob_key = as_key(alice_key), as_key(bob_key)
+    if len(alice_key) != len(bob_key):
+        raise ValueError("Alice's and Bob's keys have different lengths")
+    if alice_key != bob_key:
+        raise ValueError("Alice's and Bob's keys differ")
+    return alice_pool.append(alice_key), bob_pool.append(bob_key)
+
+def key_bits(view):
+    # The bits of bytes read from a pool
+    return KeyBuffer.unpack(view, len(view) * 8)
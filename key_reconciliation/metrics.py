@@ -0,0 +1,85 @@
+import time
+from contextlib import contextmanager, nullcontext
+
+# Metrics hooks. The protocols report the wall time of their stages, counters (simulator calls,
+# transpile cache hits) and measured values (sifting ratio, QBER, CHSH, bits leaked, key rate)
+# to the active recorder. The default one does nothing, so a run nobody observes only pays an
+# attribute lookup and a method call per report. To collect them:
+#     with metrics.recording(metrics.Recorder()) as recorder:
+#         bb84.main(vObject)
+#     print(recorder.summary())
+# Stages do not nest, so that every one of them can be profiled on its own
+
+class Metrics:
+    # Discards everything
+    def stage(self, name):
+        return NULL_STAGE
+
+    def count(self, name, value=1):
+        pass
+
+    def record(self, name, value):
+        pass
+
+NULL_STAGE = nullcontext()
+
+class Recorder(Metrics):
+    # Adds up the time spent in every stage and the counters, and keeps the last value recorded
+    # under every name
+    def __init__(self):
+        self.stages = {}
+        self.counts = {}
+        self.values = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+
+    def count(self, name, value=1):
+        self.counts[name] = self.counts.get(name, 0) + value
+
+    def record(self, name, value):
+        self.values[name] = value
+
+    def summary(self):
+        return {"stages": dict(self.stages), "counts": dict(self.counts), "values": dict(self.values)}
+
+class Profiler(Recorder):
+    # Also runs cProfile over every stage, with one profile per stage name
+    def __init__(self):
+        super().__init__()
+        self.profiles = {}
+
+    @contextmanager
+    def stage(self, name):
+        # cProfile and pstats are imported here, as most runs never profile
+        import cProfile
+        profile = self.profiles.setdefault(name, cProfile.Profile())
+        with super().stage(name):
+            profile.enable()
+            try:
+                yield
+            finally:
+                profile.disable()
+
+    def print_stats(self, name, sort="cumulative", limit=20):
+        import pstats
+        pstats.Stats(self.profiles[name]).sort_stats(sort).print_stats(limit)
+
+# Recorder the protocols report to
+active = Metrics()
+
+@contextmanager
+def recording(recorder):
+    # Makes recorder the active one until the block ends
+    global active
+    previous = active
+    active = recorder
+    try:
+        yield recorder
+    finally:
+        active = previous
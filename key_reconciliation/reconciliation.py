@@ -0,0 +1,494 @@
+import heapq
+import math
+import numpy as np
+from bisect import bisect_left, insort
+from functools import lru_cache
+from .key_buffer import KeyBuffer
+from . import metrics
+
+# Error rate the multi-pass Cascade sizes its first blocks for when the caller has not
+# measured one (adaptive_cascade). The rate used for privacy amplification is then the share of
+# bits corrected
+ASSUMED_QBER = 0.05
+
+# Length of the hash Alice and Bob compare to confirm their keys agree after reconciliation
+# (verify_keys). Keys that still differ pass with probability 2^-VERIFICATION_BITS
+VERIFICATION_BITS = 32
+
+def key_reconciliation(alice_key, bob_key, block_size=None, rounds=4, qber=None, seed=None, method="cascade", rate=None, transport=None, latency=0.0):
+    # method is "cascade" (interactive) or "ldpc" (one-way, needs the qber). Cascade runs the
+    # multi-pass version, with blocks sized from the qber (or from the errors it finds without
+    # one, see adaptive_cascade), or the original fixed blocks doubling from block_size when it
+    # is given. With a transport
+    # ("memory", "tcp" or "unix"), the multi-pass Cascade exchanges its parities over
+    # classical_channel instead, with latency seconds added to every message
+    if method == "ldpc" and qber is None:
+        raise ValueError("LDPC reconciliation needs the qber")
+    if transport is not None and (method != "cascade" or qber is None):
+        raise ValueError("Reconciliation over a channel needs the Cascade method and the qber")
+    if method not in ("cascade", "ldpc"):
+        raise ValueError(f"Unknown reconciliation method: {method}")
+    # The public seed of every step (permutations, LDPC code, verification hash and privacy
+    # amplification). Without one, a fresh seed is drawn and shared by all of them
+    if seed is None:
+        seed = int(np.random.default_rng().integers(1 << 31))
+    with metrics.active.stage("error_correction"):
+        if method == "ldpc":
+            fixed_key, leaked_bits, failed_frames, round_trips = ldpc_reconciliation(alice_key, bob_key, qber, rate, seed=seed)
+            # One message for the syndromes, and the Cascade of every frame that did not converge
+            metrics.active.record("round_trips", round_trips)
+            metrics.active.record("ldpc_failed_frames", failed_frames)
+        elif transport is not None:
+            # Imported here, so that asyncio is only loaded for reconciliation over a channel
+            from . import classical_channel
+            fixed_key, leaked_bits, stats = classical_channel.reconcile(alice_key, bob_key, qber, rounds, seed, transport, latency)
+            metrics.active.record("round_trips", stats.round_trips)
+            metrics.active.record("channel_messages", stats.messages)
+            metrics.active.record("channel_bytes", stats.bytes)
+        elif block_size is not None:
+            fixed_key, leaked_bits = cascade_with_leakage(alice_key, bob_key, block_size, rounds)
+        elif qber is not None:
+            fixed_key, leaked_bits, round_trips = multi_pass_cascade(alice_key, bob_key, qber, rounds, seed)
+            metrics.active.record("round_trips", round_trips)
+        else:
+            fixed_key, leaked_bits, round_trips = adaptive_cascade(alice_key, bob_key, rounds, seed)
+            metrics.active.record("round_trips", round_trips)
+    metrics.active.record("leaked_bits", leaked_bits)
+
+    # Without a measured qber, the share of bits corrected is used instead
+    if qber is None:
+        qber = np.count_nonzero(np.asarray(fixed_key) != np.asarray(bob_key)) / max(len(fixed_key), 1)
+    with metrics.active.stage("privacy_amplification"):
+        new_alice_key, final_key, verified = verified_amplification(alice_key, fixed_key, qber, leaked_bits, seed)
+    metrics.active.record("verified", verified)
+    metrics.active.record("final_key_bits", len(final_key))
+    return fixed_key, final_key, new_alice_key
+
+def verify_keys(alice_key, bob_key, seed=None):
+    # Alice sends a VERIFICATION_BITS Toeplitz hash of her key and Bob compares it with the hash
+    # of his. The hash is drawn from a seed spawned from the public one, so that it is not the
+    # start of the privacy amplification matrix of the same seed
+    hash_seed = np.random.SeedSequence(seed).spawn(1)[0]
+    return np.array_equal(toeplitz_hash(alice_key, VERIFICATION_BITS, hash_seed), toeplitz_hash(bob_key, VERIFICATION_BITS, hash_seed))
+
+def verified_amplification(alice_key, fixed_key, qber, leaked_bits, seed=0):
+    # The last step of every reconciliation: Alice and Bob verify that Bob's corrected key is
+    # Alice's (verify_keys), and only then amplify both, with the hash counted as disclosed.
+    # Keys that fail are discarded. Returns Alice's and Bob's final keys (empty when discarded)
+    # and whether the keys passed
+    if not verify_keys(alice_key, fixed_key, seed):
+        return KeyBuffer([]), KeyBuffer([]), False
+    leaked_bits += VERIFICATION_BITS
+    return (privacy_amplification(alice_key, qber, leaked_bits, seed),
+            privacy_amplification(fixed_key, qber, leaked_bits, seed), True)
+
+def cascade_error_correction(alice_key, bob_key, initial_block_size=1, rounds=4):
+    # Same passes as cascade_error_correction_reference, and the same corrections, but the
+    # parities come from a prefix-parity index of the differences between the keys
+    return cascade_with_leakage(alice_key, bob_key, initial_block_size, rounds)[0]
+
+def cascade_with_leakage(alice_key, bob_key, initial_block_size=1, rounds=4):
+    # Returns Bob's corrected key and the number of parity bits disclosed
+    alice = np.asarray(alice_key, dtype=np.uint8)
+    bob = np.array(bob_key, dtype=np.uint8)  # Create a copy to avoid modifying the original
+    key_length = len(alice)
+    leaked_bits = 0
+
+    for round in range(rounds):
+        block_size = initial_block_size * (2 ** round)
+        prefix = prefix_parities(alice ^ bob)
+        leaked_bits += -(-key_length // block_size)
+        if round == 0:
+            # Blocks are disjoint and nothing cascades, so every block is searched at once
+            errors, queries, _ = first_pass_errors(prefix, key_length, block_size)
+            bob[errors] ^= 1
+        else:
+            corrections, queries = cascade_pass(prefix, key_length, block_size, initial_block_size)
+            for error_index in corrections:
+                bob[error_index] ^= 1
+        leaked_bits += queries
+    return KeyBuffer(bob), leaked_bits
+
+def prefix_parities(diff):
+    # prefix[i] is the parity of the differences in [0, i)
+    prefix = np.zeros(len(diff) + 1, dtype=np.uint8)
+    np.bitwise_xor.accumulate(diff, out=prefix[1:])
+    return prefix
+
+def first_pass_errors(prefix, key_length, block_size):
+    # Binary search over all blocks with odd parity at the same time
+    starts = np.arange(0, key_length, block_size)
+    ends = np.minimum(starts + block_size, key_length)
+    odd = (prefix[ends] ^ prefix[starts]) == 1
+    starts = starts[odd]
+    low = np.zeros(len(starts), dtype=np.int64)
+    high = ends[odd] - starts - 1
+    queries = 0
+    levels = 0
+    while np.any(low < high):
+        mid = (low + high) // 2
+        left_odd = (prefix[starts + mid + 1] ^ prefix[starts]) == 1
+        searching = low < high
+        queries += int(np.sum(searching))
+        levels += 1
+        high = np.where(searching & left_odd, mid, high)
+        low = np.where(searching & ~left_odd, mid + 1, low)
+    # Also returns the number of parities asked for during the search, and the number of levels
+    # of the search (one message per level, with the parities of every block still searched)
+    return starts + low, queries, levels
+
+def cascade_pass(prefix, key_length, block_size, min_block_size):
+    # Blocks of this pass with odd parity, in order. Corrections in later blocks add them again
+    starts = np.arange(0, key_length, block_size)
+    pending = np.flatnonzero(prefix[np.minimum(starts + block_size, key_length)] ^ prefix[starts]).tolist()
+
+    # Corrections made during the pass are kept sorted, so the parity of any range is
+    # the prefix parity flipped once per correction inside it
+    prefix = prefix.tobytes()
+    corrections = []
+    queries = 0
+
+    def range_parity(start, end):
+        return (prefix[end] ^ prefix[start] ^ (bisect_left(corrections, end) - bisect_left(corrections, start))) & 1
+
+    def find_error(start, end):
+        nonlocal queries
+        low, high = 0, end - start - 1
+        while low < high:
+            mid = (low + high) // 2
+            queries += 1
+            if range_parity(start, start + mid + 1):
+                high = mid
+            else:
+                low = mid + 1
+        return start + low
+
+    current = -1
+    while pending:
+        block = heapq.heappop(pending)
+        if block <= current:
+            continue
+        current = block
+        start = block * block_size
+        end = min(start + block_size, key_length)
+        if not range_parity(start, end):
+            continue
+        error_index = find_error(start, end)
+        insort(corrections, error_index)
+
+        # Cascade effect
+        size = key_length // 2
+        while size >= min_block_size:
+            block_start = (error_index // size) * size
+            block_end = min(block_start + size, key_length)
+            queries += 1
+            if range_parity(block_start, block_end):
+                new_error_index = find_error(block_start, block_end)
+                insort(corrections, new_error_index)
+                if new_error_index // block_size > current:
+                    heapq.heappush(pending, new_error_index // block_size)
+            size //= 2
+    # Also returns the number of parities asked for
+    return corrections, queries
+
+def multi_pass_cascade(alice_key, bob_key, qber, passes=4, seed=None):
+    # Cascade as in Brassard and Salvail: the first block size follows from the QBER and doubles
+    # every pass, and every pass after the first works on a seeded random permutation of the key.
+    # Returns Bob's corrected key, the number of parity bits disclosed and the number of round trips
+    alice = np.asarray(alice_key, dtype=np.uint8)
+    bob = np.array(bob_key, dtype=np.uint8)  # Create a copy to avoid modifying the original
+    key_length = len(alice)
+    if key_length == 0:
+        return KeyBuffer(bob), 0, 0
+    rng = np.random.default_rng(seed)
+    block_size = qber_block_size(qber, key_length)
+
+    # For every pass: the order of the key, the block of each position and the parity of each block
+    orders = []
+    blocks = []
+    parities = []
+    leaked_bits = 0
+    round_trips = 0
+
+    for p in range(passes):
+        order = np.arange(key_length) if p == 0 else rng.permutation(key_length)
+        size = min(block_size * 2 ** p, key_length)
+        block_of = np.empty(key_length, dtype=np.int64)
+        block_of[order] = np.arange(key_length) // size
+        diff = (alice ^ bob)[order]
+        starts = np.arange(0, key_length, size)
+        parity = np.bitwise_xor.reduceat(diff, starts)
+        orders.append(order)
+        blocks.append(block_of)
+        parities.append(parity)
+
+        # Alice sends the parity of every block of the pass in one message
+        leaked_bits += len(starts)
+        round_trips += 1
+
+        if p == 0:
+            errors, queries, levels = first_pass_errors(prefix_parities(diff), key_length, size)
+            bob[errors] ^= 1
+            parity[:] = 0
+            leaked_bits += queries
+            round_trips += levels
+            continue
+
+        # Correcting a bit flips the parity of its block in every pass so far, and the blocks
+        # that become odd are searched in turn (the back-cascade). The odd blocks known at a time
+        # are searched together, one round trip per level of their longest binary search
+        pending = [(p, b) for b in np.flatnonzero(parity).tolist()]
+        while pending:
+            wave, pending = pending, []
+            levels = 0
+            for q, b in wave:
+                if not parities[q][b]:
+                    continue
+                size_q = min(block_size * 2 ** q, key_length)
+                positions = orders[q][b * size_q:(b + 1) * size_q]
+                offset, queries = binary_search_prefix(np.bitwise_xor.accumulate(alice[positions] ^ bob[positions]))
+                leaked_bits += queries
+                levels = max(levels, queries)
+                error_index = positions[offset]
+                bob[error_index] ^= 1
+                for r in range(p + 1):
+                    block = blocks[r][error_index]
+                    parities[r][block] ^= 1
+                    if parities[r][block]:
+                        pending.append((r, block))
+            round_trips += levels
+
+    return KeyBuffer(bob), leaked_bits, round_trips
+
+def adaptive_cascade(alice_key, bob_key, passes=4, seed=None):
+    # Multi-pass Cascade for keys whose error rate was not measured. The first run sizes its
+    # blocks for ASSUMED_QBER, then Alice and Bob compare a hash of their keys. While it differs,
+    # Cascade runs again on Bob's corrected key, sized for the share of bits corrected so far
+    # and at least twice the rate of the run before, so the blocks shrink until they find every
+    # error. Returns the same as multi_pass_cascade, the hashes counted as disclosed bits
+    alice = np.asarray(alice_key, dtype=np.uint8)
+    bob = np.asarray(bob_key, dtype=np.uint8)
+    fixed = KeyBuffer(bob)
+    qber = ASSUMED_QBER
+    leaked_bits = 0
+    round_trips = 0
+    attempt = 0
+    while True:
+        fixed, leaked, trips = multi_pass_cascade(alice, fixed, qber, passes, None if seed is None else seed + attempt)
+        leaked_bits += leaked + VERIFICATION_BITS
+        round_trips += trips + 1
+        if verify_keys(alice, fixed, None if seed is None else seed + attempt):
+            return fixed, leaked_bits, round_trips
+        corrected = np.count_nonzero(fixed.bits != bob) / len(alice)
+        qber = max(corrected, 2 * qber)
+        attempt += 1
+
+def qber_block_size(qber, key_length):
+    # First block size of the Cascade passes, so that a block holds about 0.73 errors
+    if qber <= 0:
+        return key_length
+    return int(min(max(math.ceil(0.73 / qber), 1), key_length))
+
+def binary_search_prefix(prefix):
+    # prefix[i] is the parity of the differences in the first i + 1 bits of an odd block.
+    # Returns the offset of an error and the number of parities Bob had to ask for
+    low, high = 0, len(prefix) - 1
+    queries = 0
+    while low < high:
+        mid = (low + high) // 2
+        queries += 1
+        if prefix[mid]:
+            high = mid
+        else:
+            low = mid + 1
+    return low, queries
+
+def ldpc_reconciliation(alice_key, bob_key, qber, rate=None, frame_size=16384, seed=0, max_iterations=50):
+    # One-way reconciliation: Alice sends the syndrome of every frame of her key under a sparse
+    # parity-check matrix, and Bob decodes it against his own key with belief propagation.
+    # Frames that do not converge are reconciled with the multi-pass Cascade instead.
+    # Returns Bob's corrected key, the number of bits disclosed, the number of failed frames and
+    # the number of round trips (one for the syndromes, and those of every fallback Cascade)
+    alice = np.asarray(alice_key, dtype=np.uint8)
+    bob = np.array(bob_key, dtype=np.uint8)  # Create a copy to avoid modifying the original
+    key_length = len(alice)
+    rate = ldpc_rate(qber) if rate is None else rate
+    leaked_bits = 0
+    failed_frames = 0
+    round_trips = 1 if key_length else 0
+
+    # Full frames are decoded together, the remaining bits as one shorter frame
+    full = key_length - key_length % frame_size
+    for start, end, length in [(0, full, frame_size), (full, key_length, key_length - full)]:
+        if end == start:
+            continue
+        code = ldpc_matrix(length, rate, seed)
+        alice_frames = alice[start:end].reshape(-1, length)
+        bob_frames = bob[start:end].reshape(-1, length)
+        syndromes = ldpc_syndromes(alice_frames, code)
+        leaked_bits += syndromes.size
+
+        decoded, converged = ldpc_decode(syndromes, bob_frames, qber, code, max_iterations)
+        for f in np.flatnonzero(~converged):
+            fixed_frame, cascade_leak, cascade_round_trips = multi_pass_cascade(alice_frames[f], bob_frames[f], max(qber, 1 / length), seed=seed)
+            decoded[f] = fixed_frame.bits
+            leaked_bits += cascade_leak
+            round_trips += cascade_round_trips
+            failed_frames += 1
+        bob[start:end] = decoded.ravel()
+    return KeyBuffer(bob), leaked_bits, failed_frames, round_trips
+
+# Efficiency (bits disclosed over the Shannon limit h(qber)) per QBER, at which frames of 16384
+# bits converge with the codes of ldpc_matrix: every one of 16 frames from 1% up (plus a margin of
+# 0.05), and all but a few percent below, where the checks get long and these simple codes need
+# more redundancy
+LDPC_EFFICIENCY = ((0.002, 2.3), (0.005, 1.85), (0.01, 1.7), (0.02, 1.55), (0.03, 1.5), (0.05, 1.4), (0.12, 1.4))
+
+def ldpc_rate(qber, efficiency=None):
+    # Code rate that discloses efficiency times the Shannon limit h(qber) per bit, by default
+    # interpolated from LDPC_EFFICIENCY
+    qber = min(max(qber, 1e-3), 0.5 - 1e-3)
+    if efficiency is None:
+        efficiency = float(np.interp(qber, *zip(*LDPC_EFFICIENCY)))
+    entropy = -qber * math.log2(qber) - (1 - qber) * math.log2(1 - qber)
+    return max(1 - efficiency * entropy, 0.05)
+
+@lru_cache(maxsize=16)
+def ldpc_matrix(frame_size, rate, seed=0, column_weight=4):
+    # Random sparse parity-check matrix with column_weight ones per column, spread as evenly as
+    # possible over the rows. Returned as the number of checks and the (row, column) of every one,
+    # sorted by row. Alice and Bob build the same matrix from the shared seed
+    checks = max(1, int(round(frame_size * (1 - rate))))
+    rng = np.random.default_rng(seed)
+    cols = np.repeat(np.arange(frame_size), column_weight)
+    rows = rng.permutation(np.arange(len(cols)) % checks)
+    # An entry placed twice in the same row cancels out
+    entries, counts = np.unique(rows.astype(np.int64) * frame_size + cols, return_counts=True)
+    entries = entries[counts % 2 == 1]
+    return checks, entries // frame_size, entries % frame_size
+
+def ldpc_syndromes(frames, code):
+    checks, rows, cols = code
+    return np.stack([np.bincount(rows, weights=frame[cols], minlength=checks).astype(np.int64) % 2 for frame in frames]).astype(np.uint8)
+
+def ldpc_decode(syndromes, bob_frames, qber, code, max_iterations=50):
+    # Sum-product belief propagation, run on all frames at once by repeating the
+    # matrix along the diagonal. Returns the decoded frames and which of them converged
+    checks, rows, cols = code
+    frames, length = bob_frames.shape
+    rows = (rows + checks * np.arange(frames)[:, None]).ravel()
+    cols = (cols + length * np.arange(frames)[:, None]).ravel()
+    target = syndromes.ravel()
+
+    qber = min(max(qber, 1e-3), 0.5 - 1e-3)
+    prior = (1 - 2 * bob_frames.ravel().astype(float)) * math.log((1 - qber) / qber)
+    syndrome_sign = 1 - 2 * target[rows].astype(float)
+    # Edges are sorted by row, so every check is a contiguous segment
+    row_starts = np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]])
+    segment = np.cumsum(np.r_[False, rows[1:] != rows[:-1]])
+
+    decoded = bob_frames.copy()
+    converged = np.zeros(frames, dtype=bool)
+    check_to_var = np.zeros(len(rows))
+    for _ in range(max_iterations):
+        total = prior + np.bincount(cols, weights=check_to_var, minlength=frames * length)
+        guess = (total < 0).astype(np.uint8)
+        wrong = np.bincount(rows, weights=guess[cols], minlength=frames * checks).astype(np.int64) % 2 != target
+        done = ~wrong.reshape(frames, checks).any(axis=1) & ~converged
+        decoded[done] = guess.reshape(frames, length)[done]
+        converged |= done
+        if converged.all():
+            break
+
+        var_to_check = total[cols] - check_to_var
+        negative = var_to_check < 0
+        # Sign of the other edges of the check, flipped when the syndrome bit is set
+        negatives = np.add.reduceat(negative.astype(np.int64), row_starts)[segment] - negative
+        sign = syndrome_sign * (1 - 2 * (negatives % 2))
+        # Sum-product rule in the log domain, phi(x) = -log(tanh(x / 2)) is its own inverse
+        phi = phi_function(np.abs(var_to_check))
+        others = np.add.reduceat(phi, row_starts)[segment] - phi
+        check_to_var = sign * phi_function(others)
+    return decoded, converged
+
+def phi_function(x):
+    x = np.clip(x, 1e-12, 50)
+    return -np.log(np.tanh(x / 2))
+
+def cascade_error_correction_reference(alice_key, bob_key, initial_block_size=1, rounds=4):
+    # Original list based version, kept to validate cascade_error_correction against
+    key_length = len(alice_key)
+    bob_key = bob_key.copy()  # Create a copy to avoid modifying the original
+
+    for round in range(rounds):
+        block_size = initial_block_size * (2 ** round)
+     
+        for i in range(0, key_length, block_size):
+            alice_block = alice_key[i:i+block_size]
+            bob_block = bob_key[i:i+block_size]
+         
+            if parity(alice_block) != parity(bob_block):
+                error_index = binary_search_error(alice_block, bob_block)
+                bob_key[i + error_index] = alice_key[i + error_index]
+             
+                # Cascade effect
+                if round > 0:
+                    cascade_to_previous_blocks(alice_key, bob_key, i + error_index, initial_block_size)
+    return bob_key
+
+def parity(block):
+    return sum(block) % 2
+
+def binary_search_error(alice_block, bob_block):
+    start, end = 0, len(alice_block) - 1
+    while start < end:
+        mid = (start + end) // 2
+        if parity(alice_block[:mid+1]) != parity(bob_block[:mid+1]):
+            end = mid
+        else:
+            start = mid + 1
+    return start
+
+def cascade_to_previous_blocks(alice_key, bob_key, error_index, min_block_size):
+    block_size = len(alice_key) // 2
+    while block_size >= min_block_size:
+        block_start = (error_index // block_size) * block_size
+        alice_block = alice_key[block_start:block_start+block_size]
+        bob_block = bob_key[block_start:block_start+block_size]      
+        if parity(alice_block) != parity(bob_block):
+            new_error_index = binary_search_error(alice_block, bob_block)
+            bob_key[block_start + new_error_index] = alice_key[block_start + new_error_index]      
+        block_size //= 2
+
+def privacy_amplification(key, qber=0.0, leaked_bits=0, seed=0, security_bits=32):
+    # Compresses the key with a random Toeplitz matrix (a universal hash) chosen from the public
+    # seed, down to the number of bits an eavesdropper knows nothing about
+    output_length = privacy_amplification_length(len(key), qber, leaked_bits, security_bits)
+    return KeyBuffer(toeplitz_hash(key, output_length, seed))
+
+def privacy_amplification_length(key_length, qber=0.0, leaked_bits=0, security_bits=32):
+    # n * (1 - h(qber)) bits are left after what the errors could have told Eve, minus the bits
+    # disclosed during reconciliation and a security margin
+    if qber <= 0:
+        entropy = 0.0
+    elif qber >= 0.5:
+        entropy = 1.0
+    else:
+        entropy = -qber * math.log2(qber) - (1 - qber) * math.log2(1 - qber)
+    return max(int(key_length * (1 - entropy)) - leaked_bits - security_bits, 0)
+
+def toeplitz_hash(key, output_length, seed=0):
+    # Multiplies the key by an output_length x len(key) Toeplitz matrix over GF(2). The matrix is
+    # set by its first row and column (output_length + len(key) - 1 random bits), and the product
+    # is their convolution with the key, computed with an FFT instead of building the matrix
+    key = np.asarray(key, dtype=np.uint8)
+    key_length = len(key)
+    if output_length == 0 or key_length == 0:
+        return np.zeros(output_length, dtype=np.uint8)
+    diagonals = np.random.default_rng(seed).integers(0, 2, output_length + key_length - 1, dtype=np.uint8)
+    size = 1 << (output_length + 2 * key_length - 2).bit_length()
+    product = np.fft.irfft(np.fft.rfft(diagonals, size) * np.fft.rfft(key, size), size)
+    # Row i of the matrix is diagonals[i:i + key_length] reversed, so its product with the key is
+    # term i + key_length - 1 of the convolution
+    counts = np.rint(product[key_length - 1:key_length - 1 + output_length]).astype(np.int64)
+    return (counts & 1).astype(np.uint8)
@@ -0,0 +1,37 @@
+import math
+import sys
+import time
+import numpy as np
+from . import reconciliation
+
+# Compares Cascade and LDPC reconciliation on random keys. For each QBER, prints the
+# throughput (key bits corrected per second), the efficiency f, the number of bits
+# disclosed divided by the Shannon limit n * h(QBER), the round trips and the LDPC frames that
+# fell back to Cascade. Usage: python -m key_reconciliation.reconciliation_benchmark [key_length]
+
+def entropy(qber):
+    return -qber * math.log2(qber) - (1 - qber) * math.log2(1 - qber)
+
+def run(method, alice_key, bob_key, qber):
+    start = time.perf_counter()
+    if method == "cascade":
+        fixed_key, leaked_bits, round_trips = reconciliation.multi_pass_cascade(alice_key, bob_key, qber, seed=0)
+        failed_frames = 0
+    else:
+        fixed_key, leaked_bits, failed_frames, round_trips = reconciliation.ldpc_reconciliation(alice_key, bob_key, qber)
+    elapsed = time.perf_counter() - start
+    return elapsed, leaked_bits, round_trips, failed_frames, fixed_key == alice_key.tolist()
+
+def main(key_length=100000, qbers=(0.005, 0.01, 0.02, 0.03, 0.05, 0.08)):
+    rng = np.random.default_rng(0)
+    print(f"{'method':<8} {'qber':>5} {'bits/s':>12} {'f':>6} {'round trips':>12} {'failed':>7} {'correct':>8}")
+    for qber in qbers:
+        alice_key = rng.integers(0, 2, key_length, dtype=np.uint8)
+        bob_key = alice_key ^ (rng.random(key_length) < qber)
+        for method in ["cascade", "ldpc"]:
+            elapsed, leaked_bits, round_trips, failed_frames, correct = run(method, alice_key, bob_key, qber)
+            efficiency = leaked_bits / (key_length * entropy(qber))
+            print(f"{method:<8} {qber:>5} {key_length / elapsed:>12.0f} {efficiency:>6.2f} {round_trips:>12} {failed_frames:>7} {str(correct):>8}")
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
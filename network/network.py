@@ -0,0 +1,235 @@
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import numpy as np
+import key_reconciliation
+
+# QKD network of point-to-point links between nodes, with trusted relays. Every link runs its
+# own protocol ("bb84" or "e91") with its own parameters: the parameters of a sweep cell of that
+# protocol (nBits qubits or pairs per block, error rates, eveInterceptionRate, backend...), on
+# top of its sweep.DEFAULTS. Links are simulated block by block in worker processes shared by
+# the whole network, so the protocols' module settings (noise rates, simulators) stay separate:
+# a worker runs one block at a time and sets them for it, as the sweeps do. A scheduler decides
+# which link gets the next free worker:
+# - "fair": the link that has used the least worker time so far, relative to its weight
+# - "priority": the links with the highest priority first, fair share between equal ones
+# The final keys of every link are kept by both of its nodes. relay() builds a key between
+# two nodes along the shortest path of links: every intermediate node publishes the XOR of the
+# keys of its two links, and the destination removes them from its key with the next node.
+# Only blocks whose keys passed verification are kept, and every hop is checked again with a
+# hash before it is relayed, so a corrupted link fails the route instead of giving a wrong key
+# Usage: python network.py [--blocks 4] [--workers N] [--policy fair|priority]
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROTOCOLS = ("bb84", "e91")
+
+POLICIES = ("fair", "priority")
+
+class Link:
+    def __init__(self, a, b, protocol="bb84", priority=0, weight=1.0, **params):
+        if protocol not in PROTOCOLS:
+            raise ValueError(f"Unknown protocol: {protocol}")
+        self.nodes = (a, b)
+        self.name = f"{a}-{b}"
+        self.protocol = protocol
+        self.priority = priority
+        self.weight = weight
+        self.params = params
+        # Final keys of node a and node b, bits not used by relay() yet
+        self.keys = (np.zeros(0, dtype=np.uint8), np.zeros(0, dtype=np.uint8))
+        self.results = []
+        self.busy = 0.0
+        self.running = 0
+
+    def cell(self, seed):
+        return {**self.params, "protocol": self.protocol, "seed": seed}
+
+    def share(self):
+        # Worker time used, counting running blocks as long as the finished ones took on average
+        average = self.busy / len(self.results) if self.results else 0.0
+        return (self.busy + self.running * average) / self.weight
+
+    def key(self, node):
+        return self.keys[self.nodes.index(node)]
+
+    def secret_bits(self):
+        return sum(result["secret_bits"] for result in self.results)
+
+def use_protocol(protocol):
+    # Worker initializer: the modules of the protocol are imported from its folder
+    sys.path.insert(0, os.path.join(ROOT, protocol))
+
+def run_block(cell):
+    # Runs one block of a link in a worker, and returns the results with Alice's and Bob's final keys
+    import sweep
+    start = time.perf_counter()
+    result, alice_key, bob_key = sweep.cell_keys({**sweep.DEFAULTS, **cell})
+    return result, alice_key.bits, bob_key.bits, time.perf_counter() - start
+
+class Network:
+    def __init__(self, links):
+        self.links = list(links)
+        self.nodes = sorted({node for link in self.links for node in link.nodes})
+        self.elapsed = 0.0
+        self.relayed = {}
+        # Names of the links in the order their blocks were scheduled
+        self.schedule = []
+
+    def link(self, a, b):
+        for link in self.links:
+            if set(link.nodes) == {a, b}:
+                return link
+        raise ValueError(f"No link between {a} and {b}")
+
+    def next_link(self, remaining, policy):
+        candidates = [link for link in self.links if remaining[link.name]]
+        if policy == "priority":
+            highest = max(link.priority for link in candidates)
+            candidates = [link for link in candidates if link.priority == highest]
+        return min(candidates, key=lambda link: (link.share(), self.links.index(link)))
+
+    def run(self, blocks=1, workers=None, policy="fair", seed=0):
+        # Simulates blocks blocks of every link (a number, or a dict from link name to number)
+        # on workers processes, and adds their final keys to the links. Every block has its own
+        # seed, so the keys do not depend on the order the blocks are run in
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown scheduling policy: {policy}")
+        workers = workers or os.cpu_count()
+        remaining = {link.name: blocks.get(link.name, 0) if isinstance(blocks, dict) else blocks for link in self.links}
+        started = {link.name: len(link.results) for link in self.links}
+        # One pool per protocol, as their modules have the same names. Workers are spawned, as
+        # forking a process that already runs simulator threads can deadlock
+        context = multiprocessing.get_context("spawn")
+        executors = {protocol: ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=use_protocol, initargs=(protocol,))
+                     for protocol in {link.protocol for link in self.links}}
+        running = {}
+        start = time.perf_counter()
+        try:
+            while any(remaining.values()) or running:
+                # At most workers blocks run at the same time, across all pools
+                while any(remaining.values()) and len(running) < workers:
+                    link = self.next_link(remaining, policy)
+                    index = self.links.index(link)
+                    block_seed = int(np.random.SeedSequence([seed, index, started[link.name]]).generate_state(1)[0])
+                    future = executors[link.protocol].submit(run_block, link.cell(block_seed))
+                    running[future] = link
+                    self.schedule.append(link.name)
+                    link.running += 1
+                    remaining[link.name] -= 1
+                    started[link.name] += 1
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    link = running.pop(future)
+                    result, alice_key, bob_key, seconds = future.result()
+                    link.running -= 1
+                    link.busy += seconds
+                    link.results.append(result)
+                    if not result["verification_failed"]:
+                        link.keys = (np.concatenate([link.keys[0], alice_key]), np.concatenate([link.keys[1], bob_key]))
+        finally:
+            for executor in executors.values():
+                executor.shutdown()
+        self.elapsed += time.perf_counter() - start
+
+    def path(self, source, destination):
+        # Nodes of the shortest path of links from source to destination (breadth-first search)
+        previous = {source: None}
+        queue = deque([source])
+        while queue:
+            node = queue.popleft()
+            if node == destination:
+                break
+            for link in self.links:
+                if node in link.nodes:
+                    other = link.nodes[1 - link.nodes.index(node)]
+                    if other not in previous:
+                        previous[other] = node
+                        queue.append(other)
+        if destination not in previous:
+            raise ValueError(f"No path from {source} to {destination}")
+        path = [destination]
+        while path[-1] != source:
+            path.append(previous[path[-1]])
+        return path[::-1]
+
+    def relay(self, source, destination, length):
+        # Takes length bits from every link on the path from source to destination, and returns
+        # the key of the source and the key the destination computes from the XORs published by
+        # the intermediate nodes. Both are the first link's key, which the relays learn
+        path = self.path(source, destination)
+        hops = [self.link(a, b) for a, b in zip(path, path[1:])]
+        for link in hops:
+            if min(len(key) for key in link.keys) < length:
+                raise ValueError(f"Only {min(len(key) for key in link.keys)} bits of key left on link {link.name}, {length} asked for")
+        keys = []
+        for link, (a, b) in zip(hops, zip(path, path[1:])):
+            # Key of each end of the hop, in the order of the path
+            keys.append((link.key(a)[:length], link.key(b)[:length]))
+            link.keys = (link.keys[0][length:], link.keys[1][length:])
+        # Both ends of every hop compare a hash of their keys before anything is published. The
+        # bits taken are dropped either way, as the hash discloses part of them
+        for link, (a_key, b_key) in zip(hops, keys):
+            if not key_reconciliation.verify_keys(a_key, b_key):
+                raise ValueError(f"The keys of link {link.name} differ, no key relayed")
+
+        # Node i publishes the XOR of its key with node i - 1 and its key with node i + 1
+        published = [keys[i - 1][1] ^ keys[i][0] for i in range(1, len(keys))]
+        destination_key = keys[-1][1].copy()
+        for xor in published:
+            destination_key ^= xor
+        self.relayed[(source, destination)] = self.relayed.get((source, destination), 0) + length
+        return keys[0][0], destination_key
+
+    def report(self):
+        # Key throughput of every link and of every relayed pair of nodes, in secret bits per
+        # second of the network's simulation time
+        rows = []
+        for link in self.links:
+            rows.append({"link": link.name, "protocol": link.protocol, "blocks": len(link.results),
+                         "qber": float(np.mean([result["qber"] for result in link.results])) if link.results else None,
+                         "secret_bits": link.secret_bits(), "worker_seconds": link.busy,
+                         "bits_per_second": link.secret_bits() / self.elapsed if self.elapsed else 0.0,
+                         "key_left": int(min(len(key) for key in link.keys))})
+        end_to_end = []
+        for (source, destination), bits in self.relayed.items():
+            path = self.path(source, destination)
+            capacity = min(self.link(a, b).secret_bits() for a, b in zip(path, path[1:]))
+            end_to_end.append({"source": source, "destination": destination, "hops": len(path) - 1, "relayed_bits": bits,
+                               "bits_per_second": capacity / self.elapsed if self.elapsed else 0.0})
+        return rows, end_to_end
+
+    def print_report(self):
+        rows, end_to_end = self.report()
+        print(f"{'link':<10} {'protocol':<8} {'blocks':>6} {'qber':>7} {'secret bits':>12} {'worker s':>9} {'bits/s':>10} {'key left':>9}")
+        for row in rows:
+            qber = f"{row['qber']:.4f}" if row["qber"] is not None else "-"
+            print(f"{row['link']:<10} {row['protocol']:<8} {row['blocks']:>6} {qber:>7} {row['secret_bits']:>12} "
+                  f"{row['worker_seconds']:>9.2f} {row['bits_per_second']:>10.0f} {row['key_left']:>9}")
+        for row in end_to_end:
+            print(f"{row['source']} to {row['destination']} ({row['hops']} hops): {row['relayed_bits']} bits relayed, "
+                  f"up to {row['bits_per_second']:.0f} bits/s")
+
+def example_network():
+    # A chain of two trusted relays between Alice and Bob, with an eavesdropped side link
+    return Network([Link("Alice", "R1", "bb84", nBits=20000, depolarizing_rate=0.01),
+                    Link("R1", "R2", "e91", nBits=20000, priority=1),
+                    Link("R2", "Bob", "bb84", nBits=20000, readout_rate=0.02),
+                    Link("R1", "Carol", "bb84", nBits=20000, eveInterceptionRate=0.5, weight=0.5)])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Simulates a QKD network with trusted relays")
+    parser.add_argument("--blocks", type=int, default=4, help="blocks simulated per link")
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--policy", default="fair", choices=POLICIES)
+    args = parser.parse_args()
+    network = example_network()
+    network.run(args.blocks, args.workers, args.policy)
+    length = min(len(network.link(a, b).keys[0]) for a, b in [("Alice", "R1"), ("R1", "R2"), ("R2", "Bob")])
+    aliceKey, bobKey = network.relay("Alice", "Bob", length)
+    print(f"Alice and Bob share {length} bits, {int(np.count_nonzero(aliceKey != bobKey))} of them different")
+    network.print_report()
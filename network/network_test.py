@@ -0,0 +1,93 @@
+import numpy as np
+import unittest
+import network
+from network import Link, Network
+
+def chain(**options):
+    # Alice and Bob, two trusted relays apart
+    return Network([Link("Alice", "R1", "bb84", nBits=8000, **options),
+                    Link("R1", "R2", "e91", nBits=8000),
+                    Link("R2", "Bob", "bb84", nBits=8000, depolarizing_rate=0.01)])
+
+class test(unittest.TestCase):
+
+    #Case 1 (keys relayed end to end through two trusted relays)
+    def test1(self):
+        print("\n\n-------------------------------------------------------------------")
+        print("\n" + "Case 1 (network: XOR relay over a chain of links)")
+        chainNetwork = chain()
+        chainNetwork.run(blocks=2, workers=2)
+        chainNetwork.print_report()
+        self.assertEqual(chainNetwork.path("Alice", "Bob"), ["Alice", "R1", "R2", "Bob"])
+        for link in chainNetwork.links:
+            self.assertEqual(len(link.results), 2)
+            self.assertTrue(np.array_equal(*link.keys))
+        left = [len(link.keys[0]) for link in chainNetwork.links]
+        aliceKey, bobKey = chainNetwork.relay("Alice", "Bob", 512)
+        self.assertEqual(len(aliceKey), 512)
+        self.assertTrue(np.array_equal(aliceKey, bobKey))
+        self.assertEqual([len(link.keys[0]) for link in chainNetwork.links], [length - 512 for length in left])
+        with self.assertRaises(ValueError):
+            chainNetwork.relay("Alice", "Bob", min(left))
+        rows, end_to_end = chainNetwork.report()
+        self.assertEqual([row["link"] for row in rows], ["Alice-R1", "R1-R2", "R2-Bob"])
+        self.assertEqual(end_to_end[0]["relayed_bits"], 512)
+        self.assertGreater(end_to_end[0]["bits_per_second"], 0)
+
+    #Case 2 (scheduling policies)
+    def test2(self):
+        print("\n\n-------------------------------------------------------------------")
+        print("\n" + "Case 2 (network: priority and fair share scheduling)")
+        priorityNetwork = chain()
+        priorityNetwork.links[2].priority = 1
+        priorityNetwork.run(blocks=2, workers=1, policy="priority")
+        print(priorityNetwork.schedule)
+        self.assertEqual(priorityNetwork.schedule[:2], ["R2-Bob", "R2-Bob"])
+
+        fairNetwork = chain()
+        fairNetwork.run(blocks={"Alice-R1": 3, "R1-R2": 3}, workers=1)
+        print(fairNetwork.schedule)
+        self.assertEqual(sorted(fairNetwork.schedule[:2]), ["Alice-R1", "R1-R2"])
+        self.assertEqual(len(fairNetwork.links[2].results), 0)
+
+        # Blocks are seeded on their own, so the keys do not depend on the schedule
+        for a, b in [("Alice", "R1"), ("R1", "R2")]:
+            self.assertTrue(np.array_equal(priorityNetwork.link(a, b).keys[0], fairNetwork.link(a, b).keys[0][:len(priorityNetwork.link(a, b).keys[0])]))
+
+    #Case 3 (an eavesdropped link gives no key)
+    def test3(self):
+        print("\n\n-------------------------------------------------------------------")
+        print("\n" + "Case 3 (network: eavesdropped link W[Eavesdropping])")
+        eavesdropped = chain(eveInterceptionRate=1)
+        eavesdropped.run(blocks=1, workers=1)
+        self.assertGreater(eavesdropped.links[0].results[0]["qber"], 0.2)
+        self.assertEqual(eavesdropped.links[0].secret_bits(), 0)
+        with self.assertRaises(ValueError):
+            eavesdropped.relay("Alice", "Bob", 1)
+        with self.assertRaises(ValueError):
+            eavesdropped.path("Alice", "Carol")
+
+    #Case 4 (a corrupted link fails the route)
+    def test4(self):
+        print("\n\n-------------------------------------------------------------------")
+        print("\n" + "Case 4 (network: relay over a corrupted link)")
+        chainNetwork = chain()
+        chainNetwork.run(blocks=1, workers=1)
+        aliceKey, bobKey = chainNetwork.relay("Alice", "Bob", 256)
+        self.assertTrue(np.array_equal(aliceKey, bobKey))
+        # One bit of the key of R2 on the middle link is flipped
+        middle = chainNetwork.link("R1", "R2")
+        corrupted = middle.keys[1].copy()
+        corrupted[3] ^= 1
+        middle.keys = (middle.keys[0], corrupted)
+        left = [len(link.keys[0]) for link in chainNetwork.links]
+        with self.assertRaises(ValueError):
+            chainNetwork.relay("Alice", "Bob", 256)
+        self.assertEqual(chainNetwork.relayed[("Alice", "Bob")], 256)
+        self.assertEqual([len(link.keys[0]) for link in chainNetwork.links], [length - 256 for length in left])
+        # The next bits of the link are intact again
+        aliceKey, bobKey = chainNetwork.relay("Alice", "Bob", 256)
+        self.assertTrue(np.array_equal(aliceKey, bobKey))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,6 @@
+# Modules shared by BB84 and E91 that are not about the keys themselves (those are in
+# key_reconciliation): the simulator plumbing both protocols run their circuits through, and the
+# tools their benchmarks, sweeps and monitors are built on. Nothing is imported here, so a
+# module that does not need Qiskit does not load it.
+# Submodules: circuit_cache, noise, sequential_test, benchmark_harness, sweep_engine,
+# backend_selection
@@ -0,0 +1,57 @@
+from qiskit_aer import AerSimulator
+from key_reconciliation import metrics
+
+# Picks the Aer simulation method for every job from the circuits it runs, instead of a
+# default AerSimulator():
+# - circuits made only of Clifford gates, measurements and resets run on the stabilizer method,
+#   which stays exact with the Pauli noise of noise.py (depolarizing and readout errors)
+# - other circuits run on the statevector method, or on the density matrix method when a noise
+#   model is set and the job has more shots than the 2^n amplitudes of its largest circuit:
+#   the density matrix carries the noise exactly, where statevector draws a noise trajectory
+#   for every shot (also faster for E91 with Eve's mid-circuit measurement, see method_benchmark.py)
+# The methods chosen are counted in selected, and reported to the active metrics recorder
+
+CLIFFORD_GATES = {"id", "x", "y", "z", "h", "s", "sdg", "sx", "sxdg", "cx", "cy", "cz", "swap"}
+NON_UNITARY = {"measure", "reset", "barrier", "if_else"}
+
+# Gates Clifford circuits are transpiled to, for circuit_cache.get_transpiled
+STABILIZER_BASIS = tuple(sorted(CLIFFORD_GATES | (NON_UNITARY - {"barrier"})))
+
+# One simulator per method
+simulators = {}
+
+# Number of jobs run with each method
+selected = {}
+
+def simulator(method="automatic"):
+    if method not in simulators:
+        simulators[method] = AerSimulator(method=method)
+    return simulators[method]
+
+def circuit_ops(circuit):
+    # Names of the instructions of a circuit, including the ones inside control flow blocks
+    ops = set()
+    for instruction in circuit.data:
+        ops.add(instruction.operation.name)
+        for block in getattr(instruction.operation, "blocks", ()):
+            ops |= circuit_ops(block)
+    return ops
+
+def select_method(circuits, noise_model=None, shots=1):
+    circuits = circuits if isinstance(circuits, list) else [circuits]
+    ops = set().union(*(circuit_ops(circuit) for circuit in circuits))
+    if ops <= CLIFFORD_GATES | NON_UNITARY:
+        return "stabilizer"
+    qubits = max(circuit.num_qubits for circuit in circuits)
+    if noise_model is not None and shots > 2 ** qubits:
+        return "density_matrix"
+    return "statevector"
+
+def run(circuits, noise_model=None, shots=1, **options):
+    # Runs the circuits as one job on the selected method and returns the result
+    method = select_method(circuits, noise_model, shots)
+    selected[method] = selected.get(method, 0) + 1
+    metrics.active.record("aer_method", method)
+    if noise_model is not None:
+        options["noise_model"] = noise_model
+    return simulator(method).run(circuits, shots=shots, memory=True, **options).result()
@@ -0,0 +1,53 @@
+import json
+import platform
+import subprocess
+import time
+from datetime import datetime, timezone
+import numpy as np
+
+# Shared by the benchmarks of both protocols. Results are records of one stage run on one
+# key size, saved as JSON together with the commit they were measured on, so that two runs
+# can be compared with compare_results()
+
+def timed(function, *args, **kwargs):
+    # Returns the result of the call and the time it took in seconds
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+def record(protocol, stage, variant, qubits, seconds, **extra):
+    result = {"protocol": protocol, "stage": stage, "variant": variant, "qubits": qubits,
+              "seconds": seconds, "qubits_per_second": qubits / seconds if seconds else None}
+    result.update(extra)
+    return result
+
+def save_results(results, path):
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    data = {"commit": commit,
+            "date": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "results": results}
+    with open(path, "w") as file:
+        json.dump(data, file, indent=1)
+
+def compare_results(old_path, results):
+    # Prints the speed of every stage relative to an earlier run (above 1 is faster)
+    with open(old_path) as file:
+        old = {(r["protocol"], r["stage"], r["variant"], r["qubits"]): r for r in json.load(file)["results"]}
+    print(f"{'stage':<28} {'variant':<20} {'qubits':>10} {'speedup':>9}")
+    for r in results:
+        previous = old.get((r["protocol"], r["stage"], r["variant"], r["qubits"]))
+        if previous and previous["seconds"] and r["seconds"]:
+            print(f"{r['stage']:<28} {r['variant']:<20} {r['qubits']:>10} {previous['seconds'] / r['seconds']:>8.2f}x")
+
+def print_results(results):
+    print(f"{'stage':<28} {'variant':<20} {'qubits':>10} {'seconds':>10} {'qubits/s':>12} {'secret bits/s':>14}")
+    for r in results:
+        secret = r.get("secret_bits_per_second")
+        print(f"{r['stage']:<28} {r['variant']:<20} {r['qubits']:>10} {r['seconds']:>10.4f} "
+              f"{r['qubits_per_second'] or 0:>12.0f} {'' if secret is None else f'{secret:.0f}':>14}")
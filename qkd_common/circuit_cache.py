@@ -0,0 +1,38 @@
+from qiskit import transpile
+from key_reconciliation import metrics
+
+# Transpiled circuits, keyed by (circuit configuration, backend). The protocols only
+# ever build a handful of distinct circuits, so each is transpiled once per backend
+# Transpiling is made deterministic (the default optimization level picks between equivalent
+# circuits at random), so that seeded runs give the same outcomes in every process
+cache = {}
+hits = 0
+misses = 0
+
+def get_transpiled(key, build, backend, basis_gates=None):
+    # build() is only called on a miss, to create the untranspiled circuit. With basis_gates,
+    # the circuit is transpiled to these gates instead of the whole target of the backend
+    # (building the target of the stabilizer method takes about a second per call)
+    global hits, misses
+    cacheKey = (key, backend, basis_gates)
+    if cacheKey in cache:
+        hits += 1
+        metrics.active.count("transpile_cache_hits")
+    else:
+        misses += 1
+        metrics.active.count("transpile_cache_misses")
+        if basis_gates:
+            cache[cacheKey] = transpile(build(), basis_gates=list(basis_gates), optimization_level=1, seed_transpiler=0)
+        else:
+            cache[cacheKey] = transpile(build(), backend, optimization_level=1, seed_transpiler=0)
+    return cache[cacheKey]
+
+def cache_info():
+    return {"hits": hits, "misses": misses, "size": len(cache)}
+
+def clear_cache():
+    # Call when the simulator or the noise model changes
+    global hits, misses
+    cache.clear()
+    hits = 0
+    misses = 0
@@ -0,0 +1,27 @@
+from functools import lru_cache
+from qiskit_aer.noise import NoiseModel, ReadoutError
+from qiskit_aer.noise.errors import depolarizing_error
+
+# Default error rates
+DEPOLARIZING_RATE = 0.05
+READOUT_RATE = 0.05
+
+def noise_protocol(depolarizing_rate=DEPOLARIZING_RATE, readout_rate=READOUT_RATE):
+    return build_noise_model(float(depolarizing_rate), float(readout_rate))
+
+@lru_cache(maxsize=None)
+def build_noise_model(depolarizing_rate, readout_rate):
+    # One model is built per set of rates and shared by every caller, so it must not be modified
+    noise_model = NoiseModel()
+    # Gate error
+    error = depolarizing_error(depolarizing_rate, 1)
+    noise_model.add_all_qubit_quantum_error(error, ['x', 'h'])
+
+    # Measurement error
+    read_error = ReadoutError([[1 - readout_rate, readout_rate], [readout_rate, 1 - readout_rate]])
+    noise_model.add_all_qubit_readout_error(read_error)
+
+    return noise_model
+
+def clear_noise_models():
+    build_noise_model.cache_clear()
@@ -0,0 +1,38 @@
+import math
+
+class SequentialTest:
+    # Wald's SPRT between a failure rate p0 (honest) and p1 (compromised), with miss rate beta.
+    # When the link is found honest the test starts over, so the monitor keeps watching for the
+    # rest of the session. alpha is the false alarm rate of the whole session: restart k may only
+    # raise a false alarm with probability alpha / 2^(k + 1), so its upper threshold is
+    # log(2^(k + 1) / alpha) (Ville's inequality), and all restarts together stay under alpha
+    # however long the session is. This only holds when p0 is at least the honest failure rate
+    def __init__(self, p0, p1, alpha=0.01, beta=0.01):
+        self.failure = math.log(p1 / p0)
+        self.success = math.log((1 - p1) / (1 - p0))
+        self.alpha = alpha
+        self.lower = math.log(beta / (1 - alpha))
+        self.restarts = 0
+        self.upper = self.threshold()
+        self.llr = 0.0
+        self.failures = 0
+        self.trials = 0
+
+    def threshold(self):
+        return math.log(2 ** (self.restarts + 1) / self.alpha)
+
+    def update(self, failures, trials):
+        # Returns True as soon as the link is found compromised
+        self.failures += failures
+        self.trials += trials
+        self.llr += failures * self.failure + (trials - failures) * self.success
+        if self.llr >= self.upper:
+            return True
+        if self.llr <= self.lower:
+            self.llr = 0.0
+            self.restarts += 1
+            self.upper = self.threshold()
+        return False
+
+    def rate(self):
+        return self.failures / self.trials if self.trials else 0.0
@@ -0,0 +1,106 @@
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+import glob
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+
+# Runs a cell function over every combination of a parameter grid, in worker processes. The
+# result of every cell is stored as a JSON file named after a hash of the cell (all of its
+# parameters, including the protocol and the seed) and of the version of the code that computes
+# it, so repeating or extending a sweep only computes the cells that are not in the cache yet,
+# and changing the code computes them again
+
+def grid_cells(grid, defaults={}):
+    # One dict per combination of the values in grid, on top of defaults
+    names = list(grid)
+    return [{**defaults, **dict(zip(names, values))} for values in itertools.product(*(grid[name] for name in names))]
+
+def code_version(*modules):
+    # Hash of the source files of modules (every .py file of the folder for a package), to tell
+    # the results of the current code from those of a former one
+    digest = hashlib.sha256()
+    for module in modules:
+        path = module.__file__
+        paths = sorted(glob.glob(os.path.join(os.path.dirname(path), "*.py"))) if os.path.basename(path) == "__init__.py" else [path]
+        for path in paths:
+            with open(path, "rb") as file:
+                digest.update(file.read())
+    return digest.hexdigest()[:16]
+
+def cell_key(cell, version=None):
+    # Integers are hashed as floats, so that 0 and 0.0 give the same cell
+    canonical = {name: float(value) if isinstance(value, int) and not isinstance(value, bool) else value for name, value in cell.items()}
+    if version is not None:
+        canonical = {**canonical, "code_version": version}
+    return hashlib.sha256(json.dumps(canonical, sort_keys=True).encode()).hexdigest()
+
+def load_cell(cache_dir, cell, version=None):
+    path = os.path.join(cache_dir, cell_key(cell, version) + ".json")
+    if not os.path.exists(path):
+        return None
+    with open(path) as file:
+        return json.load(file)["result"]
+
+def save_cell(cache_dir, cell, result, version=None):
+    # Written to a temporary file first, so that an interrupted sweep never leaves half a result
+    path = os.path.join(cache_dir, cell_key(cell, version) + ".json")
+    with open(path + ".tmp", "w") as file:
+        json.dump({"cell": cell, "code_version": version, "result": result}, file)
+    os.replace(path + ".tmp", path)
+
+@contextmanager
+def module_settings(module, **settings):
+    # Sets module level settings (such as the error rates of a protocol) for one cell, and puts
+    # the former values back afterwards, even when the cell fails
+    former = {name: getattr(module, name) for name in settings}
+    for name, value in settings.items():
+        setattr(module, name, value)
+    try:
+        yield module
+    finally:
+        for name, value in former.items():
+            setattr(module, name, value)
+
+def sweep(run_cell, grid, defaults={}, cache_dir=None, workers=None, version=None):
+    # Returns one dict per cell with its parameters and results, in the order of grid_cells().
+    # run_cell must be a module level function, as it is sent to the worker processes. version
+    # (code_version() of the modules run_cell depends on) is part of the cache key
+    cells = grid_cells(grid, defaults)
+    results = [None] * len(cells)
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        results = [load_cell(cache_dir, cell, version) for cell in cells]
+    missing = [i for i, result in enumerate(results) if result is None]
+
+    if missing:
+        # Workers are spawned, as forking a process that already runs simulator threads can deadlock
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            for i, result in zip(missing, executor.map(run_cell, [cells[i] for i in missing])):
+                results[i] = result
+                if cache_dir:
+                    save_cell(cache_dir, cells[i], result, version)
+    return [{**cell, **result} for cell, result in zip(cells, results)]
+
+def parse_grid(items):
+    # "name=value,value,..." items from the command line. Values are read as JSON when they can
+    # be (numbers, true, false, null), and as strings otherwise
+    def value(text):
+        try:
+            return json.loads(text)
+        except ValueError:
+            return text
+    grid = {}
+    for item in items:
+        name, values = item.split("=", 1)
+        grid[name] = [value(text) for text in values.split(",")]
+    return grid
+
+def print_table(results, columns):
+    widths = [max(len(column), 10) for column in columns]
+    print(" ".join(f"{column:>{width}}" for column, width in zip(columns, widths)))
+    for result in results:
+        print(" ".join(f"{result[column]:>{width}.4g}" if isinstance(result[column], float) else f"{str(result[column]):>{width}}"
+                       for column, width in zip(columns, widths)))